@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+import optparse
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+from kvkit import *
+
+
+def get_databases():
+    databases = {
+        'bitcask': lambda path: BitcaskDB(os.path.join(path, 'bench.bc')),
+        'memory': lambda path: MemoryDB(),
+        'sqlite': lambda path: SqliteDB(os.path.join(path, 'bench.db')),
+    }
+    try:
+        from kvkit.backends.kyoto import CacheTreeDB, TreeDB
+    except ImportError:
+        pass
+    else:
+        databases['kyoto'] = lambda path: CacheTreeDB()
+        databases['kyoto-tree'] = lambda path: TreeDB(
+            os.path.join(path, 'bench'))
+    return databases
+
+
+class timed(object):
+    def __init__(self, label, count):
+        self.label = label
+        self.count = count
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        duration = time.time() - self.start
+        print('%-36s %8.3fs %12.0f/s' % (
+            self.label, duration, self.count / max(duration, 1e-9)))
+
+
+def bench_scan(db, n, passes):
+    """
+    Index-style range scans: many short prefix ranges, then one long range.
+    """
+    groups = max(n // 100, 1)
+    db.update(dict(
+        ('idx\xff%06d\xff%08d' % (i % groups, i), str(i))
+        for i in range(n)))
+    prefixes = ['idx\xff%06d\xff' % i for i in range(groups)]
+
+    # A readahead of one reads a record per call into the backend, as
+    # cursors did before records were read in batches.
+    for readahead in (1, 64):
+        label = 'cursor fetch_until (readahead=%s)' % readahead
+        with timed(label, n * passes):
+            for _ in range(passes):
+                cursor = db.cursor(readahead=readahead)
+                for prefix in prefixes:
+                    cursor.seek(prefix)
+                    for item in cursor.fetch_until(prefix + '\xff'):
+                        pass
+                cursor.close()
+
+    with timed('slice', n * passes):
+        for _ in range(passes):
+            for prefix in prefixes:
+                for item in db[prefix:prefix + '\xff']:
+                    pass
+
+    with timed('slice (reverse)', n * passes):
+        for _ in range(passes):
+            for prefix in prefixes:
+                for item in db[prefix + '\xff':prefix:True]:
+                    pass
+
+    if hasattr(db, 'get_prefix'):
+        with timed('get_prefix', n * passes):
+            for _ in range(passes):
+                for prefix in prefixes:
+                    db.get_prefix(prefix)
+
+    with timed('full scan', n * passes):
+        for _ in range(passes):
+            for item in db['idx':'idx\xff\xff']:
+                pass
+
+
+def bench_probe(db, n, passes):
+    """
+    Dedup-style membership tests, most of which are for missing keys, with
+    and without a bloom filter in front of the database.
+    """
+    db.update(dict(('key:%08d' % i, str(i)) for i in range(0, n, 10)))
+    probes = ['key:%08d' % i for i in range(n)]
+    bloom_db = BloomDatabase(db, capacity=n)
+    print('bloom filter: %(bytes)s bytes, %(hashes)s hashes' %
+          bloom_db.stats())
+
+    for label, target in (('in', db), ('in (bloom)', bloom_db)):
+        with timed(label, n * passes):
+            for _ in range(passes):
+                for key in probes:
+                    key in target
+
+    with timed('get_many (bloom)', n * passes):
+        for _ in range(passes):
+            for i in range(0, n, 100):
+                bloom_db.get_many(probes[i:i + 100])
+
+
+def bench_compress(db, n, passes):
+    """
+    Compression ratio and added latency for small, repetitive JSON rows,
+    with plain zlib and with a trained dictionary.
+    """
+    import json
+    import random
+    import zlib
+    rand = random.Random(0)
+    cities = ['Lawrence', 'Topeka', 'Wichita', 'Kansas City', 'St. Louis']
+    rows = [json.dumps({
+        'id': i,
+        'first_name': rand.choice(['huey', 'mickey', 'zaizee', 'charlie']),
+        'last_name': rand.choice(['leifer', 'smith', 'jones']),
+        'email': 'user%s@example.com' % rand.randint(0, 10 ** 6),
+        'city': rand.choice(cities),
+        'state': rand.choice(['KS', 'MO']),
+        'created': '2016-%02d-%02dT12:%02d:00' % (
+            rand.randint(1, 12), rand.randint(1, 28), rand.randint(0, 59)),
+        'tags': rand.sample(['a', 'b', 'c', 'd', 'e', 'f'], 3),
+        'bio': ' '.join(rand.choice(cities) for _ in range(
+            rand.randint(10, 80)))}, sort_keys=True)
+        for i in range(n)]
+    raw = sum(len(row) for row in rows)
+    print('average value size: %d bytes' % (raw // n))
+
+    plain = sum(len(zlib.compress(row)) for row in rows)
+    print('%-36s %8.3f' % ('ratio (zlib)', float(raw) / plain))
+
+    cdb = CompressedDatabase(db)
+    cdb.train(rows[:1000])
+    encoded = [cdb.encode(row) for row in rows]
+    print('%-36s %8.3f' % ('ratio (trained dictionary)',
+                           float(raw) / sum(len(data) for data in encoded)))
+
+    with timed('encode', n * passes):
+        for _ in range(passes):
+            for row in rows:
+                cdb.encode(row)
+
+    with timed('decode', n * passes):
+        for _ in range(passes):
+            for data in encoded:
+                cdb.decode(data)
+
+    db.update(dict(('row:%08d' % i, row) for i, row in enumerate(rows)))
+    cdb.update(dict(('zrow:%08d' % i, row) for i, row in enumerate(rows)))
+    for label, target, prefix in (('get', db, 'row:'),
+                                  ('get (compressed)', cdb, 'zrow:')):
+        with timed(label, n * passes):
+            for _ in range(passes):
+                for i in range(n):
+                    target['%s%08d' % (prefix, i)]
+
+
+def bench_map_reduce(db, n, passes):
+    """
+    Full-table aggregation in one process and on a process pool.
+    """
+    import multiprocessing
+    import operator
+    db.update(dict(('row:%08d' % i, str(i) * 20) for i in range(n)))
+
+    def mapper(key, value):
+        return len(value)
+
+    workers = multiprocessing.cpu_count()
+    for count in sorted(set((1, workers))):
+        with timed('map_reduce (%s workers)' % count, n * passes):
+            for _ in range(passes):
+                db.map_reduce(mapper, operator.add, workers=count)
+
+
+def bench_counters(db, n, passes):
+    """
+    Metrics-style increments to a small set of hot counters, directly and
+    through a counter buffer.
+    """
+    keys = ['counter:%d' % (i % 100) for i in range(n)]
+
+    with timed('incr', n * passes):
+        for _ in range(passes):
+            for key in keys:
+                db.incr(key)
+
+    counters = CounterBuffer(db, max_keys=1000)
+    with timed('incr (buffered)', n * passes):
+        for _ in range(passes):
+            for key in keys:
+                counters.incr(key)
+        counters.flush()
+
+    total = sum(struct.unpack('>q', db[key])[0] for key in set(keys))
+    print('exact totals: %s' % (total == 2 * n * passes))
+
+
+def bench_contention(db, n, passes):
+    """
+    Throughput of a server-style mix of reads, short scans, writes and
+    counter updates, shared between 1 to 32 threads.
+    """
+    import random
+    import threading
+    db.update(dict(('key:%08d' % i, str(i)) for i in range(n)))
+
+    def worker(seed, count):
+        rand = random.Random(seed)
+        for _ in range(count):
+            i = rand.randrange(n)
+            op = i % 10
+            if op < 6:
+                db['key:%08d' % i]
+            elif op < 8:
+                for item in db['key:%08d' % i:'key:%08d' % (i + 10)]:
+                    pass
+            elif op < 9:
+                db['key:%08d' % i] = str(i)
+            else:
+                db.incr('counter:%d' % (i % 16))
+
+    for count in (1, 2, 4, 8, 16, 32):
+        per_thread = n * passes // count
+        threads = [threading.Thread(target=worker, args=(i, per_thread))
+                   for i in range(count)]
+        with timed('%d threads' % count, per_thread * count):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+
+BENCHMARKS = {
+    'compress': bench_compress,
+    'contention': bench_contention,
+    'counters': bench_counters,
+    'map_reduce': bench_map_reduce,
+    'probe': bench_probe,
+    'scan': bench_scan,
+}
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] [benchmark ...]')
+    opt = parser.add_option
+    opt('-d', '--database', dest='database', default='memory',
+        help='one of: %s' % ', '.join(sorted(get_databases())))
+    opt('-n', '--records', dest='records', default=100000, type='int')
+    opt('-p', '--passes', dest='passes', default=3, type='int')
+
+    options, args = parser.parse_args()
+    databases = get_databases()
+    if options.database not in databases:
+        parser.error('unknown database %r' % options.database)
+
+    for name in (args or sorted(BENCHMARKS)):
+        path = tempfile.mkdtemp()
+        db = databases[options.database](path)
+        try:
+            print('%s (%s, %s records)' % (
+                name, options.database, options.records))
+            BENCHMARKS[name](db, options.records, options.passes)
+        finally:
+            db.close()
+            shutil.rmtree(path)
@@ -1,4 +1,5 @@
 from kvkit.exceptions import DatabaseError
+from kvkit.backends.bitcask import BitcaskDB
 
 try:
     from kvkit.backends.berkeleydb import BerkeleyDB
@@ -24,16 +25,25 @@ try:
 except ImportError:
     pass
 
+from kvkit.backends.memory import MemoryDB
+
 try:
     from kvkit.backends.rocks import RocksDB
 except ImportError:
     pass
 
+from kvkit.backends.sqlite import SqliteDB
+
 try:
     from kvkit.backends.sqlite4 import LSM
 except ImportError:
     pass
 
+from kvkit.bloom import BloomDatabase
+from kvkit.buffer import CounterBuffer
+from kvkit.buffer import WriteBuffer
+from kvkit.cache import CachedDatabase
+from kvkit.compress import CompressedDatabase
 from kvkit.graph import Hexastore
 from kvkit.query import DateField
 from kvkit.query import DateTimeField
@@ -41,6 +51,7 @@ from kvkit.query import Field
 from kvkit.query import FloatField
 from kvkit.query import LongField
 from kvkit.query import Model
+from kvkit.shard import ShardedDatabase
 
 
 __version__ = '0.1.2'
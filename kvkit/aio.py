@@ -0,0 +1,335 @@
+import collections
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from kvkit.backends.helpers import snapshot
+from kvkit.backends.helpers import to_bytes
+
+
+# Marks a key that was not found by a batched lookup.
+_missing = object()
+
+try:
+    StopAsyncIteration = StopAsyncIteration
+except NameError:
+    # Python 2 has no `async for`, but slices can still be consumed by
+    # awaiting `__anext__()` until this is raised.
+    class StopAsyncIteration(Exception):
+        pass
+
+
+def _new_future(loop):
+    create_future = getattr(loop, 'create_future', None)
+    if create_future is not None:
+        return create_future()
+    return asyncio.Future(loop=loop)
+
+
+def _resolve(future, fn, source):
+    # Settle `future` with `fn` applied to the result of `source`, or with
+    # its exception. If `fn` returns a future, `future` follows it instead.
+    if future.cancelled():
+        return
+    elif source.cancelled():
+        future.cancel()
+        return
+    exc = source.exception()
+    if exc is not None:
+        future.set_exception(exc)
+        return
+    try:
+        result = fn(source.result())
+    except Exception as exc:
+        future.set_exception(exc)
+        return
+    if isinstance(result, asyncio.Future):
+        result.add_done_callback(
+            functools.partial(_resolve, future, lambda value: value))
+    else:
+        future.set_result(result)
+
+
+def _read_chunk(rows, count):
+    chunk = []
+    for record in rows:
+        chunk.append(record)
+        if len(chunk) == count:
+            break
+    return chunk
+
+
+class AsyncDatabase(object):
+    """
+    Runs the calls of a database on a pool of `workers` threads, so they
+    can be awaited from an asyncio event loop without blocking it. Every
+    method returns a future.
+
+    Lookups made with `get()` during the same pass of the event loop are
+    collected and read with a single bulk lookup, in batches of at most
+    `max_batch` keys. Slices are asynchronous iterators, which read
+    `chunk_size` records at a time and keep up to `prefetch` chunks read
+    ahead of the consumer.
+    """
+    def __init__(self, db, workers=8, loop=None, executor=None,
+                 max_batch=1000, chunk_size=100, prefetch=2):
+        self.db = db
+        self.loop = loop or asyncio.get_event_loop()
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(workers)
+        self.max_batch = max_batch
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+
+        # Maps each key looked up in the current pass of the event loop to
+        # the futures and defaults of the lookups waiting for it.
+        self._batch = None
+        # Number of bulk lookups made.
+        self.batches = 0
+
+    def close(self):
+        """
+        Wait for running calls to finish, then close the database. The
+        thread pool is shut down unless it was passed in.
+        """
+        if self._own_executor:
+            self.executor.shutdown(wait=True)
+        return self.db.close()
+
+    def run(self, fn, *args, **kwargs):
+        """Call `fn` on the thread pool, returning a future of its result."""
+        return self.loop.run_in_executor(
+            self.executor, functools.partial(fn, *args, **kwargs))
+
+    def then(self, future, fn):
+        """
+        Return a future of `fn(result)`, called once `future` has a result.
+        If `fn` returns a future, its result is used.
+        """
+        result = _new_future(self.loop)
+        future.add_done_callback(functools.partial(_resolve, result, fn))
+        return result
+
+    def get(self, key, default=None):
+        future = _new_future(self.loop)
+        if self._batch is None:
+            self._batch = {}
+            self.loop.call_soon(self._dispatch)
+        self._batch.setdefault(to_bytes(key), []).append((future, default))
+        return future
+
+    def _dispatch(self):
+        batch, self._batch = self._batch, None
+        keys = list(batch)
+        for i in range(0, len(keys), self.max_batch):
+            chunk = keys[i:i + self.max_batch]
+            self.batches += 1
+            request = self.run(self.db.__getitem__, chunk)
+            request.add_done_callback(functools.partial(
+                self._deliver, dict((key, batch[key]) for key in chunk)))
+
+    def _deliver(self, batch, request):
+        exc = request.exception()
+        data = {} if exc is not None else request.result()
+        for key, waiters in batch.items():
+            # Some databases return `None` for the keys that do not exist.
+            value = data.get(key)
+            for future, default in waiters:
+                if future.cancelled():
+                    continue
+                elif exc is not None:
+                    future.set_exception(exc)
+                else:
+                    future.set_result(default if value is None else value)
+
+    def get_many(self, keys):
+        return self.run(self.db.__getitem__, list(keys))
+
+    def set(self, key, value):
+        return self.run(self.db.__setitem__, key, value)
+
+    def delete(self, key):
+        return self.run(self.db.__delitem__, key)
+
+    def update(self, _data=None, **kwargs):
+        if _data:
+            if kwargs:
+                _data.update(kwargs)
+        else:
+            _data = kwargs
+        return self.run(self.db.update, _data)
+
+    def incr(self, key, amount=1):
+        return self.run(self.db.incr, key, amount)
+
+    def decr(self, key, amount=1):
+        return self.run(self.db.incr, key, amount * -1)
+
+    def contains(self, key):
+        return self.run(self.db.__contains__, key)
+
+    def get_prefix(self, prefix, max_records=-1):
+        return self.run(self.db.get_prefix, prefix, max_records)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return AsyncSlice(self, key)
+        return self.get(key)
+
+
+class AsyncSlice(object):
+    """
+    Asynchronous iterator over the records of a slice. The slice is read
+    on the thread pool a chunk at a time, one chunk after another, so the
+    underlying iterator is never used by two threads at once.
+    """
+    def __init__(self, adb, key):
+        self.adb = adb
+        self.key = key
+        self._rows = None
+        # Chunks read but not yet consumed, and the records of the current
+        # one.
+        self._chunks = collections.deque()
+        self._records = collections.deque()
+        self._reading = None
+        self._exhausted = False
+        self._closed = False
+        self._error = None
+        self._waiter = None
+
+    def __aiter__(self):
+        return self
+
+    def _read(self):
+        # Read the next chunk, creating the iterator on the first read.
+        if self._rows is None:
+            self._rows = iter(self.adb.db[self.key])
+        return _read_chunk(self._rows, self.adb.chunk_size)
+
+    def _fill(self):
+        if (self._reading is None and not self._exhausted and
+                len(self._chunks) < self.adb.prefetch):
+            self._reading = self.adb.run(self._read)
+            self._reading.add_done_callback(self._on_chunk)
+
+    def _on_chunk(self, request):
+        self._reading = None
+        if self._closed:
+            # Records read after closing are thrown away.
+            pass
+        elif request.cancelled():
+            self._exhausted = True
+            self._error = asyncio.CancelledError()
+        elif request.exception() is not None:
+            # The error is raised once the records read before it have been
+            # consumed.
+            self._exhausted = True
+            self._error = request.exception()
+        else:
+            chunk = request.result()
+            if len(chunk) < self.adb.chunk_size:
+                self._exhausted = True
+            if chunk:
+                self._chunks.append(chunk)
+            self._fill()
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            self._next(waiter)
+
+    def _next(self, future):
+        if future.cancelled():
+            return
+        elif not self._records and self._chunks:
+            self._records.extend(self._chunks.popleft())
+            self._fill()
+        if self._records:
+            future.set_result(self._records.popleft())
+        elif self._exhausted and self._reading is None:
+            future.set_exception(self._error or StopAsyncIteration())
+        else:
+            self._waiter = future
+            self._fill()
+
+    def __anext__(self):
+        future = _new_future(self.adb.loop)
+        self._next(future)
+        return future
+
+    def close(self):
+        """
+        Stop reading and release the underlying iterator, once any read in
+        progress has finished. Returns a future.
+        """
+        self._exhausted = self._closed = True
+        self._chunks.clear()
+        self._records.clear()
+        if self._reading is None:
+            return self._close_rows()
+        finished = _new_future(self.adb.loop)
+        self._reading.add_done_callback(
+            lambda request: finished.set_result(None))
+        return self.adb.then(finished, lambda _: self._close_rows())
+
+    def _close_rows(self):
+        rows, self._rows = self._rows, None
+        return self.adb.run(getattr(rows, 'close', lambda: None))
+
+
+class AsyncModel(object):
+    """
+    Asynchronous access to the instances of a model class, through an
+    `AsyncDatabase` of the model's database. Records are read with `get()`,
+    so the lookups of concurrent loads are read in bulk. Writes and queries
+    run on the thread pool, and each query reads its indexes and records
+    from one snapshot.
+    """
+    def __init__(self, model_class, adb):
+        self.model_class = model_class
+        self.adb = adb
+
+    def load(self, primary_key):
+        model_class = self.model_class
+        keys = model_class._model_data_keys(primary_key)
+        lookups = [self.adb.get(key, _missing) for key in keys]
+
+        def build(values):
+            if _missing in values:
+                raise KeyError(keys[values.index(_missing)])
+            return model_class(**model_class._decode_model_data(values))
+        return self.adb.then(asyncio.gather(*lookups), build)
+
+    def create(self, **kwargs):
+        return self.adb.run(self.model_class.create, **kwargs)
+
+    def save(self, instance, atomic=True):
+        return self.adb.run(instance.save, atomic)
+
+    def delete(self, instance, atomic=True):
+        return self.adb.run(instance.delete, atomic)
+
+    def query(self, expr):
+        model_class = self.model_class
+        database = model_class._meta.database
+
+        def read():
+            # As with `Model.query()`, the indexes and the records are read
+            # from one snapshot, so writes made meanwhile can not tear the
+            # results. The records of every result are read in bulk.
+            with snapshot(database):
+                id_list = sorted(model_class._query_ids(expr))
+                if not id_list:
+                    return []
+                keys = [model_class._model_data_keys(primary_key)
+                        for primary_key in id_list]
+                found = database[[key for group in keys for key in group]]
+            return [model_class(**model_class._decode_model_data(
+                [found[key] for key in group])) for group in keys]
+        return self.adb.run(read)
+
+    def get(self, expr):
+        return self.adb.then(
+            self.query(expr), lambda results: results[0] if results else None)
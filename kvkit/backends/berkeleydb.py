@@ -2,7 +2,11 @@
 import bsddb3
 from bsddb3.db import DBNotFoundError
 
+from kvkit.backends.helpers import BaseCursor
+from kvkit.backends.helpers import clean_delete_slice
+from kvkit.backends.helpers import clean_key_slice
 from kvkit.backends.helpers import KVHelper
+from kvkit.backends.helpers import READAHEAD
 
 
 class BerkeleyDB(KVHelper, bsddb3._DBWithCursor):
@@ -28,54 +32,95 @@ class BerkeleyDB(KVHelper, bsddb3._DBWithCursor):
 
     def __getitem__(self, key):
         if isinstance(key, slice):
-            if key.start > key.stop or key.step:
-                return self.get_slice_rev(key.start, key.stop)
+            start, stop, reverse = clean_key_slice(key)
+            if reverse:
+                return self.get_slice_rev(start, stop)
             else:
-                return self.get_slice(key.start, key.stop)
+                return self.get_slice(start, stop)
         else:
             return super(BerkeleyDB, self).__getitem__(key)
 
-    def get_slice(self, start, end):
-        try:
-            key, value = self.set_location(start)
-        except DBNotFoundError:
-            raise StopIteration
+    def __delitem__(self, key):
+        if isinstance(key, slice):
+            self.delete_range(*clean_delete_slice(key))
         else:
-            if key > end:
-                raise StopIteration
-            yield key, value
+            super(BerkeleyDB, self).__delitem__(key)
 
-        while True:
-            try:
-                key, value = self.next()
-            except DBNotFoundError:
-                raise StopIteration
+    def delete_range(self, start, stop):
+        """
+        Delete the keys from `start` to `stop`, inclusive, using the cursor.
+        Returns the number of keys deleted.
+        """
+        # A cursor of its own, so the position of the shared one used by
+        # the bsddb3 mapping methods is left alone.
+        dbc = self.db.cursor()
+        count = 0
+        try:
+            if start is None:
+                record = dbc.first()
             else:
-                if key > end:
-                    raise StopIteration
-            yield key, value
+                record = dbc.set_range(start)
+            while record is not None:
+                if stop is not None and record[0] > stop:
+                    break
+                dbc.delete()
+                count += 1
+                record = dbc.next()
+        except DBNotFoundError:
+            pass
+        finally:
+            dbc.close()
+        return count
 
-    def get_slice_rev(self, start, end):
-        if start is None or end is None:
-            start, end = end, start
+    def cursor(self, reverse=False, readahead=READAHEAD, key_only=False):
+        return Cursor(self, reverse, readahead, key_only)
 
-        if start is None:
-            key, value = self.last()
-        else:
-            try:
-                key, value = self.set_location(start)
-            except DBNotFoundError:
-                key, value = self.last()
+    # The database is opened without a shared environment, so other
+    # processes would not see pages cached by this one.
+    _reader = None
 
-        if start is None or key <= start:
-            yield key, value
 
-        while True:
-            try:
-                key, value = self.previous()
-            except DBNotFoundError:
-                raise StopIteration
+class Cursor(BaseCursor):
+    # Each cursor has a bsddb3 cursor of its own, as the one kept by the
+    # database is shared by all of its mapping methods.
+    def __init__(self, *args, **kwargs):
+        super(Cursor, self).__init__(*args, **kwargs)
+        self._dbc = self.db.db.cursor()
+
+    def close(self):
+        super(Cursor, self).close()
+        if self._dbc is not None:
+            self._dbc.close()
+            self._dbc = None
+
+    def _read(self, start, reverse, inclusive, count, stop=None):
+        dbc = self._dbc
+        step = dbc.prev if reverse else dbc.next
+        records = []
+        try:
+            if start is None:
+                record = dbc.last() if reverse else dbc.first()
             else:
-                if key < end:
-                    raise StopIteration
-            yield key, value
+                try:
+                    # Finds the first key greater than or equal to `start`.
+                    record = dbc.set_range(start)
+                except DBNotFoundError:
+                    if not reverse:
+                        return records
+                    record = dbc.last()
+                else:
+                    if reverse and record[0] > start:
+                        record = dbc.prev()
+                if not inclusive and record[0] == start:
+                    record = step()
+
+            while len(records) < count:
+                if stop is not None and (
+                        record[0] < stop if reverse else record[0] > stop):
+                    break
+                records.append(record)
+                if len(records) < count:
+                    record = step()
+        except DBNotFoundError:
+            pass
+        return records
@@ -0,0 +1,883 @@
+# Pure-Python, log-structured (Bitcask-style) database, no dependencies.
+import bisect
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+from kvkit.exceptions import DatabaseError
+from kvkit.backends.helpers import BaseCursor
+from kvkit.backends.helpers import clean_delete_slice
+from kvkit.backends.helpers import clean_key_slice
+from kvkit.backends.helpers import KVHelper
+from kvkit.backends.helpers import READAHEAD
+from kvkit.backends.helpers import to_bytes
+from kvkit.backends.helpers import transaction
+from kvkit.backends.memory import read_versions
+from kvkit.backends.memory import SnapshotLocal
+from kvkit.backends.memory import SortedKeys
+from kvkit.backends.memory import union_irange
+from kvkit.backends.memory import versioned_snapshot
+
+
+# Each record is a header of (crc32, sequence, key size, value size) followed
+# by the key and the value. The checksum covers everything after itself.
+HEADER = struct.Struct('>Iqii')
+# Hint file entries are (sequence, key size, value size, value offset),
+# followed by the key.
+HINT = struct.Struct('>qiiQ')
+# Deletes are recorded by writing a record with this value size.
+TOMBSTONE = -1
+# The outermost transaction is bracketed by records with an empty key and
+# these value sizes. Records written after a BEGIN only take effect once the
+# matching COMMIT is read, so a transaction interrupted by a crash is lost.
+BEGIN = -2
+COMMIT = -3
+ROLLBACK = -4
+
+DATA_EXT = '.data'
+HINT_EXT = '.hint'
+
+_missing = object()
+_segment_re = re.compile(r'^(\d+)\.data$')
+
+
+def _sorted_range(keys, start, stop, reverse=False):
+    # Iterate over the keys from `start` to `stop`, inclusive, sorting them
+    # first.
+    keys = sorted(keys)
+    lo = 0
+    hi = len(keys)
+    low, high = (stop, start) if reverse else (start, stop)
+    if low is not None:
+        lo = bisect.bisect_left(keys, low)
+    if high is not None:
+        hi = bisect.bisect_right(keys, high)
+    keys = keys[lo:hi]
+    if reverse:
+        keys.reverse()
+    return iter(keys)
+
+
+def _record_size(key_size, value_size):
+    return HEADER.size + key_size + max(value_size, 0)
+
+
+class Segment(object):
+    """
+    A data file. Records are only ever appended to the active segment, and
+    all segments are read through a read-only memory map, which is re-mapped
+    when a read goes past its end.
+    """
+    def __init__(self, directory, segment_id):
+        self.id = segment_id
+        self.path = os.path.join(directory, '%09d%s' % (segment_id, DATA_EXT))
+        self.hint_path = os.path.join(
+            directory,
+            '%09d%s' % (segment_id, HINT_EXT))
+        self.size = 0
+        self.dead = 0  # Bytes used by records that have been superseded.
+        self.map = None
+        self.fh = None
+
+    def open_for_append(self):
+        self.fh = open(self.path, 'a+b')
+        self.size = os.fstat(self.fh.fileno()).st_size
+
+    def write(self, data, sync=False):
+        offset = self.size
+        self.fh.write(data)
+        if sync:
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+        self.size += len(data)
+        return offset
+
+    def flush(self, hard=False):
+        if self.fh is not None:
+            self.fh.flush()
+            if hard:
+                os.fsync(self.fh.fileno())
+
+    def remap(self):
+        self.flush()
+        old = self.map
+        with open(self.path, 'rb') as fh:
+            size = os.fstat(fh.fileno()).st_size
+            if size:
+                self.map = mmap.mmap(
+                    fh.fileno(),
+                    size,
+                    access=mmap.ACCESS_READ)
+        if self.fh is None:
+            self.size = size
+        if old is not None and old is not self.map:
+            old.close()
+
+    def read(self, offset, size):
+        mapping = self.map
+        try:
+            if mapping is None or offset + size > len(mapping):
+                return None
+            return mapping[offset:offset + size]
+        except ValueError:
+            # The map was closed by a concurrent remap.
+            return None
+
+    def seal(self):
+        """Stop appending to the segment and write its hint file."""
+        self.flush(True)
+        self.fh.close()
+        self.fh = None
+        self.remap()
+        self.write_hints()
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def scan(self, repair=True):
+        """
+        Yield `(sequence, key, value offset, value size)` for each record. A
+        partially-written record at the end of the file is truncated, if
+        `repair` is set.
+        """
+        if self.map is None or self.size > len(self.map):
+            self.remap()
+        mapping = self.map
+        if mapping is None:
+            return
+        offset = 0
+        while offset + HEADER.size <= len(mapping):
+            crc, seq, key_size, value_size = HEADER.unpack_from(
+                mapping,
+                offset)
+            end = offset + _record_size(key_size, value_size)
+            if end > len(mapping) or crc != (
+                    zlib.crc32(mapping[offset + 4:end]) & 0xffffffff):
+                break
+            key_offset = offset + HEADER.size
+            yield (seq, mapping[key_offset:key_offset + key_size],
+                   key_offset + key_size, value_size)
+            offset = end
+
+        if repair and offset < len(mapping):
+            mapping.close()
+            with open(self.path, 'r+b') as fh:
+                fh.truncate(offset)
+            self.remap()
+
+    def read_hints(self):
+        with open(self.hint_path, 'rb') as fh:
+            data = fh.read()
+        offset = 0
+        while offset < len(data):
+            seq, key_size, value_size, value_offset = HINT.unpack_from(
+                data,
+                offset)
+            offset += HINT.size
+            yield (seq, data[offset:offset + key_size], value_offset,
+                   value_size)
+            offset += key_size
+
+    def write_hints(self):
+        tmp_path = self.hint_path + '.tmp'
+        with open(tmp_path, 'wb') as fh:
+            for seq, key, value_offset, value_size in self.scan():
+                fh.write(HINT.pack(seq, len(key), value_size, value_offset))
+                fh.write(key)
+        os.rename(tmp_path, self.hint_path)
+
+    def delete(self):
+        # Readers may still hold a reference to the memory map, so it is left
+        # for the garbage collector to close.
+        self.map = None
+        for path in (self.path, self.hint_path):
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+class BitcaskDB(KVHelper):
+    """
+    Log-structured database. Writes are appended to the active segment file
+    and an in-memory "keydir" maps each key to the location of its latest
+    value, so reads take a single lookup into a memory-mapped segment.
+
+    Each record carries a sequence number, and when the database is opened
+    the record with the highest sequence number wins, so segments can be
+    loaded in any order. Sealed segments have a hint file listing their
+    records, so the data files need not be scanned on restart.
+
+    `compact()` copies the live records of the sealed segments into new
+    segments and deletes the old ones. It can be run periodically in a
+    background thread by specifying a `compaction_interval` (in seconds),
+    in which case it runs whenever the fraction of dead bytes exceeds
+    `compaction_threshold`.
+
+    If `ordered` is set, which is the default, a sorted index of the keys is
+    maintained for slicing. Otherwise slices sort the keys on demand.
+
+    Snapshots keep the keydir entries that writes replace, and compaction
+    preserves the records they point to, so lookups and slices made inside
+    a snapshot read the values it began with.
+
+    With `read_only=True` the segments are loaded without being repaired or
+    written to, which is how forked map/reduce workers read the database.
+    """
+    def __init__(self, filename, ordered=True, max_segment_size=64 << 20,
+                 sync=False, compaction_interval=None,
+                 compaction_threshold=0.5, read_only=False):
+        self.filename = filename
+        self.ordered = ordered
+        self.max_segment_size = max_segment_size
+        self.sync = sync
+        self.compaction_interval = compaction_interval
+        self.compaction_threshold = compaction_threshold
+        self.read_only = read_only
+        self._lock = threading.RLock()
+        self._compaction_lock = threading.Lock()
+        # The `Versions` of each open snapshot, and the one pinned to the
+        # current thread.
+        self._snapshots = []
+        self._local = SnapshotLocal()
+        self._closed = True
+        self.open()
+
+    def open(self):
+        if not self._closed:
+            return False
+        if not os.path.exists(self.filename):
+            os.makedirs(self.filename)
+
+        self._keydir = {}
+        self._segments = {}
+        self._active = None
+        self._seq = 0
+        self._undo = []
+        # The records of a transaction whose COMMIT has not been loaded yet.
+        self._pending = None
+
+        segment_ids = sorted(
+            int(match.group(1)) for match in map(
+                _segment_re.match,
+                os.listdir(self.filename)) if match)
+        for segment_id in segment_ids:
+            self._load_segment(Segment(self.filename, segment_id))
+        self._next_id = (segment_ids[-1] + 1) if segment_ids else 0
+        if self._pending is not None:
+            # The last transaction was interrupted. Close it, so the records
+            # written from now on are not taken to be part of it.
+            self._discard_pending()
+            if not self.read_only:
+                self._append_marker(ROLLBACK)
+
+        # Drop the deleted keys that were kept while loading.
+        for key, entry in list(self._keydir.items()):
+            if entry[2] == TOMBSTONE:
+                del self._keydir[key]
+        self._keys = SortedKeys(self._keydir) if self.ordered else None
+
+        self._closed = False
+        self._stop = threading.Event()
+        if self.compaction_interval and not self.read_only:
+            self._compactor = threading.Thread(target=self._compact_loop)
+            self._compactor.daemon = True
+            self._compactor.start()
+        return True
+
+    def _load_segment(self, segment):
+        # Segments are loaded in order, as a transaction's records may span
+        # several of them.
+        segment.remap()
+        if os.path.exists(segment.hint_path):
+            records = segment.read_hints()
+        else:
+            records = segment.scan(not self.read_only)
+        self._segments[segment.id] = segment
+
+        for seq, key, value_offset, value_size in records:
+            entry = (segment.id, value_offset, value_size, seq)
+            self._seq = max(self._seq, seq)
+            if value_size in (BEGIN, COMMIT, ROLLBACK):
+                self._mark_dead(key, entry)
+                if value_size == BEGIN:
+                    self._pending = []
+                elif value_size == COMMIT and self._pending is not None:
+                    for pending_key, pending_entry in self._pending:
+                        self._load_entry(pending_key, pending_entry)
+                    self._pending = None
+                else:
+                    self._discard_pending()
+            elif self._pending is not None:
+                self._pending.append((key, entry))
+            else:
+                self._load_entry(key, entry)
+
+        if not self.read_only and not os.path.exists(segment.hint_path):
+            segment.write_hints()
+
+    def _load_entry(self, key, entry):
+        # Tombstones are always dead, other records are dead once they have
+        # been superseded.
+        current = self._keydir.get(key)
+        if current is None or current[3] < entry[3]:
+            self._keydir[key] = entry
+            if current is not None and current[2] != TOMBSTONE:
+                self._mark_dead(key, current)
+        elif entry[2] != TOMBSTONE:
+            self._mark_dead(key, entry)
+        if entry[2] == TOMBSTONE:
+            self._mark_dead(key, entry)
+
+    def _discard_pending(self):
+        for key, entry in self._pending or ():
+            self._mark_dead(key, entry)
+        self._pending = None
+
+    def close(self):
+        if self._closed:
+            return False
+        self._stop.set()
+        if self.compaction_interval:
+            self._compactor.join()
+        with self._lock:
+            if self._active is not None:
+                self._active.seal()
+                self._active = None
+            for segment in self._segments.values():
+                segment.close()
+            self._closed = True
+        return True
+
+    def _mark_dead(self, key, entry):
+        segment = self._segments.get(entry[0])
+        if segment is not None:
+            segment.dead += _record_size(len(key), entry[2])
+
+    def _new_segment(self):
+        with self._lock:
+            segment = Segment(self.filename, self._next_id)
+            self._next_id += 1
+        segment.open_for_append()
+        return segment
+
+    def _rotate(self):
+        if self._active is not None:
+            self._active.seal()
+        self._active = self._new_segment()
+        self._segments[self._active.id] = self._active
+
+    def _encode_record(self, seq, key, value, value_size=None):
+        if value_size is None:
+            value_size = TOMBSTONE if value is None else len(value)
+        body = struct.pack('>qii', seq, len(key), value_size) + key
+        if value is not None:
+            body += value
+        return struct.pack('>I', zlib.crc32(body) & 0xffffffff) + body
+
+    def _append(self, key, value, seq=None, marker=None):
+        # Append a record for the key, a tombstone if `value` is `None`, or
+        # the given transaction marker, and return its keydir entry.
+        if self.read_only:
+            raise DatabaseError('Database is read-only.')
+        active = self._active
+        if active is None or active.size >= self.max_segment_size:
+            self._rotate()
+            active = self._active
+        if seq is None:
+            self._seq += 1
+            seq = self._seq
+        value_size = marker
+        if value_size is None:
+            value_size = TOMBSTONE if value is None else len(value)
+        offset = active.write(
+            self._encode_record(seq, key, value, value_size),
+            self.sync)
+        return (active.id, offset + HEADER.size + len(key), value_size, seq)
+
+    def _append_marker(self, marker):
+        self._mark_dead('', self._append('', None, marker=marker))
+
+    def _read(self, entry):
+        segment = self._segments.get(entry[0])
+        if segment is None:
+            return None
+        value = segment.read(entry[1], entry[2])
+        if value is None:
+            # The record was written after the segment was mapped, or the
+            # segment was just removed by a compaction.
+            with self._lock:
+                if self._segments.get(entry[0]) is not segment:
+                    return None
+                segment.remap()
+            value = segment.read(entry[1], entry[2])
+        return value
+
+    def _get(self, key, default=_missing, versions=None):
+        # A compaction may remove the segment between looking up the entry
+        # and reading it, in which case the keydir will have been updated.
+        # If `versions` is given, the entry is read as of that snapshot.
+        while True:
+            entry = self._keydir.get(key)
+            if versions is not None:
+                entry = versions.get(key, entry)
+            if entry is None:
+                return default
+            value = self._read(entry)
+            if value is not None:
+                return value
+
+    def _set(self, key, value):
+        entry = self._append(key, value)
+        old = self._keydir.get(key)
+        for versions in self._snapshots:
+            versions.save(key, old)
+        self._keydir[key] = entry
+        if old is None:
+            if self._keys is not None:
+                self._keys.insert(key)
+        else:
+            self._mark_dead(key, old)
+        if self._undo and key not in self._undo[-1]:
+            self._undo[-1][key] = old or _missing
+
+    def _delete(self, key):
+        old = self._keydir.get(key)
+        if old is None:
+            return False
+        entry = self._append(key, None)
+        for versions in self._snapshots:
+            versions.save(key, old)
+        del self._keydir[key]
+        if self._keys is not None:
+            self._keys.remove(key)
+        self._mark_dead(key, old)
+        self._mark_dead(key, entry)
+        if self._undo and key not in self._undo[-1]:
+            self._undo[-1][key] = old
+        return True
+
+    def __setitem__(self, key, value):
+        key, value = to_bytes(key), to_bytes(value)
+        with self._lock:
+            self._set(key, value)
+
+    def __getitem__(self, key):
+        if isinstance(key, (list, tuple)):
+            return self.get_many(key)
+        elif isinstance(key, slice):
+            start, stop, reverse = clean_key_slice(key)
+            if reverse:
+                return self.get_slice_rev(start, stop)
+            else:
+                return self.get_slice(start, stop)
+        else:
+            value = self._get(to_bytes(key), versions=self._local.versions)
+            if value is _missing:
+                raise KeyError(key)
+            return value
+
+    def __delitem__(self, key):
+        if isinstance(key, (list, tuple)):
+            with self._lock:
+                for k in key:
+                    self._delete(to_bytes(k))
+        elif isinstance(key, slice):
+            self.delete_range(*clean_delete_slice(key))
+        else:
+            with self._lock:
+                self._delete(to_bytes(key))
+
+    def __contains__(self, key):
+        key = to_bytes(key)
+        versions = self._local.versions
+        if versions is not None:
+            return versions.get(key, self._keydir.get(key)) is not None
+        return key in self._keydir
+
+    def __len__(self):
+        return len(self._keydir)
+
+    def get_many(self, keys):
+        """Return a dictionary of the keys that exist and their values."""
+        versions = self._local.versions
+        accum = {}
+        for key in keys:
+            key = to_bytes(key)
+            value = self._get(key, versions=versions)
+            if value is not _missing:
+                accum[key] = value
+        return accum
+
+    def update(self, _data=None, **kwargs):
+        """
+        Update multiple records, returning the number of records updated.
+        """
+        if _data:
+            if kwargs:
+                _data.update(kwargs)
+        else:
+            _data = kwargs
+        items = [(to_bytes(key), to_bytes(value))
+                 for key, value in _data.iteritems()]
+        with self.transaction():
+            for key, value in items:
+                self._set(key, value)
+        return len(items)
+
+    def pop(self, key=None):
+        """
+        Remove the first record, or the record specified by the given key,
+        returning the value.
+        """
+        with self._lock:
+            if key is None:
+                for key, value in self.get_slice(None, None):
+                    self._delete(key)
+                    return (key, value)
+                raise KeyError(key)
+            value = self._get(to_bytes(key))
+            if value is _missing:
+                raise KeyError(key)
+            self._delete(to_bytes(key))
+            return value
+
+    def clear(self):
+        """Remove all records, returning `True` on success."""
+        with self._lock:
+            for key in list(self._keydir):
+                self._delete(key)
+        return True
+
+    def flush(self, hard=True):
+        """Flush the active segment, and if `hard`, sync it to disk."""
+        with self._lock:
+            if self._active is not None:
+                self._active.flush(hard)
+        return True
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            return super(BitcaskDB, self).incr(key, amount)
+
+    def cas(self, key, old, new):
+        with self._lock:
+            return super(BitcaskDB, self).cas(key, old, new)
+
+    def begin(self, hard=False):
+        """
+        Begin a transaction. Transactions may be nested, and other threads
+        are blocked from writing until the outermost transaction ends.
+        Changes are written to the log as they are made, and rolling back
+        writes the original values back. The outermost transaction is marked
+        in the log, so that its changes are ignored on restart unless it was
+        committed.
+        """
+        self._lock.acquire()
+        try:
+            if not self._undo:
+                self._append_marker(BEGIN)
+        except:
+            self._lock.release()
+            raise
+        self._undo.append({})
+        return True
+
+    def commit(self):
+        """
+        Commit a transaction. Returns boolean indicating success.
+        """
+        if not self._undo:
+            raise DatabaseError('No transaction is in progress.')
+        undo = self._undo.pop()
+        try:
+            if self._undo:
+                parent = self._undo[-1]
+                for key, entry in undo.iteritems():
+                    parent.setdefault(key, entry)
+            else:
+                self._append_marker(COMMIT)
+                if self.sync:
+                    self.flush(True)
+        finally:
+            self._lock.release()
+        return True
+
+    def rollback(self):
+        """
+        Rollback a transaction. Returns boolean indicating success.
+        """
+        if not self._undo:
+            raise DatabaseError('No transaction is in progress.')
+        undo = self._undo.pop()
+        saved, self._undo = self._undo, []
+        try:
+            for key, entry in undo.iteritems():
+                if entry is _missing:
+                    self._delete(key)
+                else:
+                    self._set(key, self._read(entry))
+            if not saved:
+                self._append_marker(ROLLBACK)
+        finally:
+            self._undo = saved
+            self._lock.release()
+        return True
+
+    def transaction(self):
+        return transaction(self)
+
+    def snapshot(self):
+        return versioned_snapshot(self)
+
+    def dead_ratio(self):
+        """Return the fraction of bytes in sealed segments that are dead."""
+        with self._lock:
+            sealed = [segment for segment in self._segments.values()
+                      if segment is not self._active]
+        total = sum(segment.size for segment in sealed)
+        if not total:
+            return 0.
+        return float(sum(segment.dead for segment in sealed)) / total
+
+    def compact(self):
+        """
+        Merge the sealed segments, dropping records that have been
+        overwritten or deleted. Writes may continue while the live records
+        are being copied. Returns the number of bytes reclaimed. Compacting
+        inside a transaction raises a `DatabaseError`.
+        """
+        if self.read_only:
+            raise DatabaseError('Database is read-only.')
+        with self._compaction_lock:
+            with self._lock:
+                # The lock is held by a transaction until it ends, so one in
+                # progress here belongs to this thread.
+                if self._undo:
+                    raise DatabaseError(
+                        'Can not compact inside a transaction.')
+                if self._active is not None:
+                    self._active.seal()
+                    self._active = None
+                merging = self._segments.values()
+                merging_ids = set(segment.id for segment in merging)
+                live = [(key, entry) for key, entry in self._keydir.iteritems()
+                        if entry[0] in merging_ids]
+            if not merging:
+                return 0
+
+            # Copy the live records, preserving their sequence numbers.
+            outputs = []
+            moved = {}
+            output = None
+            for key, entry in sorted(live, key=lambda item: item[1][:2]):
+                if output is None or output.size >= self.max_segment_size:
+                    output = self._new_segment()
+                    outputs.append(output)
+                value = self._read(entry)
+                offset = output.write(
+                    self._encode_record(entry[3], key, value))
+                moved[entry] = (output.id, offset + HEADER.size + len(key),
+                                entry[2], entry[3])
+            for output in outputs:
+                output.seal()
+
+            with self._lock:
+                for output in outputs:
+                    self._segments[output.id] = output
+                for key, entry in live:
+                    new_entry = moved[entry]
+                    if self._keydir.get(key) == entry:
+                        self._keydir[key] = new_entry
+                    else:
+                        # Overwritten or deleted while we were copying.
+                        self._mark_dead(key, new_entry)
+                for versions in self._snapshots:
+                    saved = versions.saved
+                    for key, entry in saved.items():
+                        if entry in moved:
+                            saved[key] = moved[entry]
+                        elif entry is not None and entry[0] in merging_ids:
+                            # A snapshot may need to read a value that is no
+                            # longer live. Keep its original sequence number,
+                            # so it does not win on restart.
+                            saved[key] = self._append(
+                                key,
+                                self._read(entry),
+                                entry[3])
+                            self._mark_dead(key, saved[key])
+                            if key not in self._keydir:
+                                # The key's tombstone was not copied, so
+                                # write another, or the copy would bring the
+                                # key back on restart.
+                                self._mark_dead(key, self._append(key, None))
+
+                for segment in merging:
+                    del self._segments[segment.id]
+                    segment.delete()
+
+            before = sum(segment.size for segment in merging)
+            return before - sum(output.size for output in outputs)
+
+    def _compact_loop(self):
+        while not self._stop.wait(self.compaction_interval):
+            if self.dead_ratio() >= self.compaction_threshold:
+                self.compact()
+
+    def delete_range(self, start, stop):
+        """
+        Delete the keys from `start` to `stop`, inclusive, returning the
+        number of keys deleted.
+        """
+        count = 0
+        with self._lock:
+            for key in self._iterate(start, stop):
+                self._delete(key)
+                count += 1
+        return count
+
+    def match_prefix(self, prefix, max_records=-1):
+        accum = []
+        for key in self._iterate(prefix, None):
+            if not key.startswith(prefix) or len(accum) == max_records:
+                break
+            accum.append(key)
+        return accum
+
+    def _iterate(self, start, stop, reverse=False):
+        if self._keys is not None:
+            return self._keys.irange(self._lock, start, stop, reverse)
+        return _sorted_range(self._keydir, start, stop, reverse)
+
+    def _iterate_versions(self, versions, start, stop, reverse=False):
+        # Keys deleted since the snapshot are only found in its own list.
+        if self._keys is not None:
+            keys = union_irange(self._lock, self._keys, versions.keys,
+                                start, stop, reverse)
+        else:
+            with self._lock:
+                keys = set(self._keydir)
+                keys.update(versions.keys)
+            keys = _sorted_range(keys, start, stop, reverse)
+        for key in keys:
+            value = self._get(key, versions=versions)
+            if value is not _missing:
+                yield (key, value)
+
+    def _iterate_items(self, start, stop, reverse=False):
+        for key in self._iterate(start, stop, reverse):
+            value = self._get(key)
+            if value is not _missing:
+                yield (key, value)
+
+    def _slice(self, start, end, reverse):
+        # Values are read as each record is reached, rather than a batch at a
+        # time, so writes made while iterating are always seen. The snapshot
+        # is looked up now, so a slice taken inside one keeps reading it.
+        versions = self._local.versions
+        if versions is not None:
+            return self._iterate_versions(versions, start, end, reverse)
+        return self._iterate_items(start, end, reverse)
+
+    def __iter__(self):
+        return self._iterate(None, None)
+
+    def keys(self):
+        return self._iterate(None, None)
+
+    def itervalues(self):
+        for _, value in self._iterate_items(None, None):
+            yield value
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        return self._iterate_items(None, None)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def cursor(self, reverse=False, readahead=READAHEAD, key_only=False):
+        return Cursor(self, reverse, readahead, key_only)
+
+    def _reader(self):
+        # The locks and maps of this process, and its compactor thread, can
+        # not be used across a fork, so load the segments again, read-only.
+        return type(self)(self.filename, self.ordered, read_only=True)
+
+
+class Cursor(BaseCursor):
+    def __init__(self, *args, **kwargs):
+        super(Cursor, self).__init__(*args, **kwargs)
+        # Unordered databases sort the keys once, when first read.
+        self._sorted = None
+        # A cursor opened inside a snapshot reads from it.
+        self._versions = self.db._local.versions
+
+    def _read_keys(self, start, reverse, inclusive, count, stop):
+        db = self.db
+        if db._keys is not None:
+            with db._lock:
+                return db._keys.batch(start, stop, reverse, inclusive)[:count]
+
+        if self._sorted is None:
+            self._sorted = sorted(db._keydir)
+        keys = self._sorted
+        if reverse:
+            if start is None:
+                hi = len(keys)
+            elif inclusive:
+                hi = bisect.bisect_right(keys, start)
+            else:
+                hi = bisect.bisect_left(keys, start)
+            lo = max(hi - count, 0)
+            if stop is not None:
+                lo = max(lo, bisect.bisect_left(keys, stop))
+            batch = keys[lo:hi]
+            batch.reverse()
+            return batch
+
+        if start is None:
+            lo = 0
+        elif inclusive:
+            lo = bisect.bisect_left(keys, start)
+        else:
+            lo = bisect.bisect_right(keys, start)
+        hi = lo + count
+        if stop is not None:
+            hi = min(hi, bisect.bisect_right(keys, stop))
+        return keys[lo:hi]
+
+    def _read(self, start, reverse, inclusive, count, stop=None):
+        if start is not None:
+            start = to_bytes(start)
+        if stop is not None:
+            stop = to_bytes(stop)
+        if self._versions is not None:
+            return read_versions(self, self._versions, start, reverse,
+                                 inclusive, count, stop)
+        db = self.db
+        records = []
+        while len(records) < count:
+            keys = self._read_keys(
+                start, reverse, inclusive, count - len(records), stop)
+            if not keys:
+                break
+            # Keys deleted since they were read are skipped.
+            for key in keys:
+                if self.key_only:
+                    if key in db._keydir:
+                        records.append((key, None))
+                else:
+                    value = db._get(key)
+                    if value is not _missing:
+                        records.append((key, value))
+            start, inclusive = keys[-1], False
+        return records
@@ -1,5 +1,35 @@
 import contextlib
+import itertools
+import multiprocessing
+import os
 import struct
+import threading
+
+try:
+    unicode
+except NameError:
+    # Python 3.
+    unicode = str
+
+
+# Number of records a cursor reads from the database at a time.
+READAHEAD = 64
+
+# The map/reduce job being run by the worker processes, which inherit it
+# when they are forked, so the mapper and reducer need not be picklable.
+_job = None
+_job_lock = threading.Lock()
+_job_reader = None
+
+# Locks serializing the read-modify-write operations of backends that have
+# no atomic equivalent. A key always maps to the same lock, so threads only
+# wait for each other when updating keys that share one.
+_key_locks = [threading.Lock() for _ in range(64)]
+
+
+def key_lock(key):
+    """Return the lock guarding atomic updates to `key`."""
+    return _key_locks[hash(key) % len(_key_locks)]
 
 
 def clean_key_slice(key):
@@ -20,6 +50,212 @@ def clean_key_slice(key):
     return start, stop, reverse
 
 
+def clean_delete_slice(key):
+    """
+    Return the `(lowest, highest)` keys of the range described by a slice,
+    regardless of the direction of the slice.
+    """
+    start, stop, reverse = clean_key_slice(key)
+    if reverse:
+        return stop, start
+    return start, stop
+
+
+def prefix_upper_bound(prefix):
+    """
+    Return the smallest key that sorts after every key beginning with
+    `prefix`, or `None` if there is no such key.
+    """
+    stripped = prefix.rstrip('\xff')
+    if not stripped:
+        return None
+    return stripped[:-1] + chr(ord(stripped[-1]) + 1)
+
+
+def prefix_slice(db, prefix, max_records=-1):
+    """
+    Return a list of the records of `db` whose key begins with `prefix`, in
+    key order, optionally limited to `max_records`, read from a slice.
+    """
+    accum = []
+    if max_records == 0:
+        return accum
+    rows = db[prefix:prefix_upper_bound(prefix)]
+    for key, value in rows:
+        if not key.startswith(prefix):
+            break
+        accum.append((key, value))
+        if len(accum) == max_records:
+            break
+    if hasattr(rows, 'close'):
+        rows.close()
+    return accum
+
+
+def to_bytes(value):
+    # Keys and values are stored as byte-strings, as with kyotocabinet.
+    if isinstance(value, (str, bytes)):
+        return value
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _reduce_partition(partition):
+    # Map and reduce the records of one partition in a worker process,
+    # returning whether any record was mapped, and the result.
+    global _job_reader
+    db, mapper, reducer = _job
+    if _job_reader is None:
+        _job_reader = db._reader()
+    return _reduce_range(_job_reader, mapper, reducer, *partition)
+
+
+def _reduce_range(db, mapper, reducer, start, stop, inclusive):
+    found = False
+    result = None
+    for key, value in db[start:stop]:
+        if not inclusive and key == stop:
+            break
+        mapped = mapper(key, value)
+        if mapped is None:
+            continue
+        elif found:
+            result = reducer(result, mapped)
+        else:
+            found, result = True, mapped
+    return found, result
+
+
+# Number of bytes of a key, after the prefix shared by two keys, that are
+# used to place keys between them when sampling a range.
+_KEY_BYTES = 16
+
+
+class _RangeSampler(object):
+    # Estimates how many keys lie from `low` to `high` and where, by seeking
+    # a cursor and reading short runs of keys. A segment is bounded by two
+    # keys that exist, holds the run read from its first key, and where the
+    # run stops short of the last key, the keys between are estimated by
+    # interpolating between their positions. The segment with the most
+    # unknown keys is halved until `probes` seeks have been made.
+    #
+    # Keys are placed in a mixed radix, where each byte counts only the
+    # values seen at its offset, so keys made of digits or letters are not
+    # spread over the whole byte range.
+    def __init__(self, cursor, low, high, run):
+        self.cursor = cursor
+        self.low = low
+        self.high = high
+        self.run = max(run, 2)
+        self.alphabet = {}
+
+    def learn(self, key):
+        for offset, byte in enumerate(bytearray(key)):
+            bounds = self.alphabet.get(offset)
+            if bounds is None:
+                self.alphabet[offset] = [byte, byte]
+            elif byte < bounds[0]:
+                bounds[0] = byte
+            elif byte > bounds[1]:
+                bounds[1] = byte
+
+    def radixes(self, start, length):
+        # A digit of zero marks the end of a key.
+        return [(self.alphabet[i][0],
+                 self.alphabet[i][1] - self.alphabet[i][0] + 2)
+                for i in range(start, start + length)]
+
+    def positions(self, keys):
+        prefix = len(os.path.commonprefix([keys[0], keys[-1]]))
+        length = min(max(len(key) for key in keys) - prefix, _KEY_BYTES)
+        radixes = self.radixes(prefix, length)
+        result = []
+        for key in keys:
+            data = bytearray(key[prefix:prefix + length])
+            position = 0
+            for i, (low, radix) in enumerate(radixes):
+                digit = data[i] - low + 1 if i < len(data) else 0
+                position = position * radix + digit
+            result.append(position)
+        return result
+
+    def middle(self, first, last):
+        # A key between `first` and `last`, after `first`.
+        prefix = len(os.path.commonprefix([first, last]))
+        length = min(max(len(first), len(last)) - prefix, _KEY_BYTES)
+        radixes = self.radixes(prefix, length)
+        low, high = self.positions([first, last])
+        position = (low + high) // 2
+        digits = []
+        for low, radix in reversed(radixes):
+            position, digit = divmod(position, radix)
+            digits.append((low, digit))
+        data = bytearray()
+        for low, digit in reversed(digits):
+            if not digit:
+                # Digits after the end of a key can not be sought.
+                break
+            data.append(low + digit - 1)
+        key = first[:prefix] + bytes(data)
+        return key if first < key <= last else last
+
+    def read(self, last):
+        # Read up to `run` keys from the cursor, up to `last`.
+        cursor = self.cursor
+        keys = []
+        key = cursor.key()
+        while key is not None and key <= last and len(keys) < self.run:
+            self.learn(key)
+            keys.append(key)
+            cursor.step()
+            key = cursor.key()
+        return keys
+
+    def unknown(self, keys, last):
+        # Estimate the keys after `keys` up to and including `last`.
+        if keys[-1] == last:
+            return 0.
+        first, read, end = self.positions([keys[0], keys[-1], last])
+        return max(float(len(keys) - 1) * (end - read) / max(read - first, 1),
+                   1.)
+
+    def sample(self, probes):
+        """
+        Return a sorted list of `(key, weight)`, where the weights are the
+        estimated numbers of keys each key read stands for.
+        """
+        self.learn(self.low)
+        self.learn(self.high)
+        self.cursor.seek(self.low)
+        keys = self.read(self.high)
+        # Segments are `[unknown keys, keys read, last key]`.
+        segments = [[self.unknown(keys, self.high), keys, self.high]]
+        probes -= 1
+        while probes > 0:
+            i = max(range(len(segments)), key=lambda i: segments[i][0])
+            unknown, keys, last = segments[i]
+            if not unknown:
+                break
+            cursor = self.cursor
+            cursor.seek(self.middle(keys[-1], last))
+            cursor.step_back()
+            before = cursor.key()
+            cursor.step()
+            after = self.read(last)
+            segments[i:i + 1] = [
+                [self.unknown(keys, before), keys, before],
+                [self.unknown(after, last), after, last]]
+            probes -= 1
+
+        sample = []
+        for unknown, keys, last in segments:
+            sample.extend((key, 1.) for key in keys)
+            if unknown:
+                sample.append((last, unknown))
+        return sample
+
+
 class KVHelper(object):
     def __enter__(self):
         self.open()
@@ -28,19 +264,475 @@ class KVHelper(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
-    def incr(self, key, amount=1):
+    def __contains__(self, key):
         try:
-            value = self[key]
+            self[key]
         except KeyError:
-            value = amount
-        else:
-            value = struct.unpack('>q', value)[0] + amount
-        self[key] = struct.pack('>q', value)
+            return False
+        return True
+
+    # `incr()` and `cas()` are atomic with respect to each other, from any
+    # thread in this process, but not to plain writes of the same key.
+    def incr(self, key, amount=1):
+        with key_lock(key):
+            try:
+                value = self[key]
+            except KeyError:
+                value = amount
+            else:
+                value = struct.unpack('>q', value)[0] + amount
+            self[key] = struct.pack('>q', value)
         return value
 
     def decr(self, key, amount=1):
         return self.incr(key, amount * -1)
 
+    def cas(self, key, old, new):
+        """
+        Conditionally set the new value for the given key, but only if the
+        pre-existing value at the key equals `old`. If `old` is `None` the
+        key must not exist, and if `new` is `None` the key is removed.
+
+        Returns boolean indicating if the value was swapped.
+        """
+        with key_lock(key):
+            try:
+                current = self[key]
+            except KeyError:
+                current = None
+            if current != old:
+                return False
+            if new is None:
+                del self[key]
+            else:
+                self[key] = new
+        return True
+
+    def delete_range(self, start, stop, batch_size=1000):
+        """
+        Delete the keys from `start` to `stop`, inclusive, `batch_size` keys
+        at a time. Returns the number of keys deleted.
+        """
+        count = 0
+        while True:
+            rows = self[start:stop]
+            keys = [key for key, _ in itertools.islice(rows, batch_size)]
+            if hasattr(rows, 'close'):
+                rows.close()
+            if not keys:
+                return count
+            for key in keys:
+                del self[key]
+            count += len(keys)
+            start = keys[-1]
+
+    def apply_batch(self, sets, deletes):
+        """
+        Store the records in the `sets` dictionary and remove the keys in
+        `deletes`, in a single transaction. Keys that do not exist are
+        ignored.
+        """
+        with self.transaction():
+            for key in deletes:
+                try:
+                    del self[key]
+                except KeyError:
+                    pass
+            if sets:
+                self.update(sets)
+
+    def _reader(self):
+        """
+        Return a handle for reading the database from a forked worker
+        process, or `None` if it can not be read from other processes. By
+        default the worker's copy of this handle is used.
+        """
+        return self
+
+    def split_range(self, n, start=None, stop=None, sample_size=None,
+                    run=8):
+        """
+        Return up to `n - 1` keys that split the range from `start` to `stop`
+        into `n` partitions holding roughly equal numbers of keys.
+
+        Rather than reading every key, a cursor is sought to points of the
+        range and reads a run of up to `run` keys from each, at most
+        `sample_size` keys in all. Where a run does not reach the next point,
+        the keys between are estimated from how closely spaced the run was,
+        and the part of the range with the most estimated keys is probed
+        again.
+        """
+        sample_size = sample_size or n * 512
+        cursor = self.cursor(readahead=run + 1, key_only=True)
+        try:
+            found = cursor.seek(start) if start is not None else cursor.first()
+            low = cursor.key() if found else None
+            if stop is not None:
+                found = cursor.seek_for_prev(stop)
+            else:
+                found = cursor.last()
+            high = cursor.key() if found else None
+            if low is None or high is None or low > high:
+                return []
+            sampler = _RangeSampler(cursor, low, high, run)
+            sample = sampler.sample(max(sample_size // run, n))
+        finally:
+            cursor.close()
+
+        total = sum(weight for _, weight in sample)
+        splits = []
+        seen = 0.
+        i = 1
+        for key, weight in sample:
+            seen += weight
+            while i < n and seen > float(i) * total / n:
+                if start != key != stop and (not splits or key > splits[-1]):
+                    splits.append(key)
+                i += 1
+        return splits
+
+    def map_reduce(self, mapper, reducer, start=None, stop=None,
+                   workers=None, default=None):
+        """
+        Call `mapper(key, value)` for each record from `start` to `stop`,
+        inclusive, and combine the results that are not `None` with
+        `reducer(a, b)`, which should be associative. Returns `default` if
+        no record was mapped.
+
+        The range is split into partitions of roughly equal size, which are
+        scanned by a pool of `workers` processes, defaulting to one for each
+        CPU. Each process reduces a partition and the partial results are
+        combined in key order as they arrive. Worker processes are forked,
+        so `mapper` and `reducer` may be any callables, but can not change
+        anything in this process.
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers < 2 or self._reader is None:
+            found, result = _reduce_range(
+                self, mapper, reducer, start, stop, True)
+            return result if found else default
+
+        bounds = [start] + self.split_range(workers * 4, start, stop) + [stop]
+        partitions = [(bounds[i], bounds[i + 1], i == len(bounds) - 2)
+                      for i in range(len(bounds) - 1)]
+
+        # Make sure buffered writes are visible to the workers.
+        flush = getattr(self, 'flush', None)
+        if flush is not None:
+            flush(False)
+
+        global _job
+        found = False
+        result = None
+        with _job_lock:
+            _job = (self, mapper, reducer)
+            pool = multiprocessing.Pool(min(workers, len(partitions)))
+            try:
+                for has_value, value in pool.imap(
+                        _reduce_partition, partitions):
+                    if not has_value:
+                        continue
+                    elif found:
+                        result = reducer(result, value)
+                    else:
+                        found, result = True, value
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+                _job = None
+        return result if found else default
+
+    def get_prefix(self, prefix, max_records=-1):
+        """
+        Return a list of the records whose key begins with `prefix`, in key
+        order, optionally limited to `max_records`.
+        """
+        return prefix_slice(self, prefix, max_records)
+
+    def get_slice(self, start, end):
+        if start is not None and end is not None and start > end:
+            raise ValueError('%s must be less than or equal to %s.' % (
+                start, end))
+        return self._slice(start, end, False)
+
+    def get_slice_rev(self, start, end):
+        if start is not None and end is not None and start < end:
+            raise ValueError('%s must be greater than or equal to %s.' % (
+                start, end))
+        return self._slice(start, end, True)
+
+    def _slice(self, start, end, reverse):
+        cursor = self.cursor(reverse=reverse)
+        try:
+            for records in cursor.scan(start, end):
+                for record in records:
+                    yield record
+        finally:
+            cursor.close()
+
     @contextlib.contextmanager
     def transaction(self):
         yield
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        """
+        Pin the reads made by this thread to the state of the database when
+        the block is entered, so that long scans and multi-key reads see a
+        single consistent view. Databases without snapshots read the latest
+        values.
+        """
+        yield
+
+
+class BaseCursor(object):
+    """
+    Cursor over the records of an ordered database. The cursor is positioned
+    with `seek()` or `seek_for_prev()` and moved with `step()` and
+    `step_back()`. Iterating over it, or calling `next()`, yields the records
+    from the current position onwards, going backwards if `reverse` is set.
+
+    Records are read `readahead` at a time, so a cursor may return values
+    that have since been overwritten. With `key_only=True` the values are
+    not read, and the cursor yields keys.
+
+    Backends implement `_read(start, reverse, inclusive, count, stop)`, and
+    everything else is built on it. It returns a list of `(key, value)`
+    records, in order, beginning with the first key after `start`, or before
+    it if `reverse`, and not going past `stop`. If `inclusive`, a record at
+    `start` itself is included. A `start` of `None` begins at the first or
+    last key. Fewer than `count` records are returned only when no more
+    remain. In `key_only` mode the values may be `None`.
+    """
+    def __init__(self, db, reverse=False, readahead=READAHEAD,
+                 key_only=False):
+        self.db = db
+        self.reverse = reverse
+        self.readahead = readahead
+        self.key_only = key_only
+        self._record = None
+        # Records following the current one, nearest last.
+        self._buffer = []
+        self._buffer_reverse = reverse
+
+    def __enter__(self):
+        if self.reverse:
+            self.last()
+        else:
+            self.first()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._record = None
+        self._buffer = []
+
+    def _is_stale(self):
+        # Whether the records read ahead must be discarded.
+        return False
+
+    def _fill(self, start, reverse, inclusive=True):
+        records = self._read(start, reverse, inclusive, max(self.readahead, 1))
+        records.reverse()
+        self._buffer = records
+        self._buffer_reverse = reverse
+        self._record = records.pop() if records else None
+        return self._record is not None
+
+    def _move(self, reverse):
+        if self._record is None:
+            return False
+        if (self._buffer and self._buffer_reverse == reverse and
+                not self._is_stale()):
+            self._record = self._buffer.pop()
+            return True
+        return self._fill(self._record[0], reverse, False)
+
+    def first(self):
+        return self._fill(None, False)
+
+    def last(self):
+        return self._fill(None, True)
+
+    def seek(self, key):
+        """Move to the first key greater than or equal to `key`."""
+        return self._fill(key, False)
+
+    def seek_for_prev(self, key):
+        """Move to the last key less than or equal to `key`."""
+        return self._fill(key, True)
+
+    def step(self):
+        """Move to the next key, returning whether there is one."""
+        return self._move(False)
+
+    def step_back(self):
+        """Move to the previous key, returning whether there is one."""
+        return self._move(True)
+
+    def next(self):
+        """
+        Return the current record and move on to the next one, going
+        backwards if the cursor is reversed. `StopIteration` is raised when
+        no record is current.
+        """
+        record = self.get()
+        if record is None:
+            raise StopIteration
+        self._move(self.reverse)
+        return record[0] if self.key_only else record
+
+    def prev(self):
+        """
+        Return the current record and move back to the previous one, the
+        opposite way to `next()`. `StopIteration` is raised when no record is
+        current.
+        """
+        record = self.get()
+        if record is None:
+            raise StopIteration
+        self._move(not self.reverse)
+        return record[0] if self.key_only else record
+
+    def is_valid(self):
+        return self.get() is not None
+
+    def get(self):
+        """Return the current `(key, value)` record, or `None`."""
+        return self._record
+
+    def key(self):
+        record = self.get()
+        if record is not None:
+            return record[0]
+
+    def value(self):
+        record = self.get()
+        if record is not None:
+            return record[1]
+
+    def set(self, value, step=False):
+        record = self.get()
+        if record is None:
+            return False
+        self.db[record[0]] = value
+        self._record = (record[0], value)
+        if step:
+            self._move(self.reverse)
+        return True
+
+    def remove(self):
+        """Remove the current record and move on to the next one."""
+        record = self.get()
+        if record is None:
+            return False
+        del self.db[record[0]]
+        self._move(self.reverse)
+        return True
+
+    def pop(self):
+        record = self.get()
+        if record is not None:
+            self.remove()
+        return record
+
+    def __iter__(self):
+        return self.fetch_until(None)
+
+    def scan(self, start, end_key):
+        """
+        Generate lists of the records from `start` to `end_key`, inclusive,
+        going backwards if the cursor is reversed. Records are read a batch
+        at a time, with the end key checked while reading, which makes this
+        the cheapest way to read a range. The cursor is not moved.
+        """
+        reverse = self.reverse
+        count = max(self.readahead, 1)
+        inclusive = True
+        while True:
+            records = self._read(start, reverse, inclusive, count, end_key)
+            if records:
+                yield records
+            if len(records) < count:
+                return
+            start, inclusive = records[-1][0], False
+
+    def fetch_count(self, n):
+        while n > 0:
+            record = self.get()
+            if record is None:
+                break
+            yield record[0] if self.key_only else record
+            self._move(self.reverse)
+            n -= 1
+
+    def fetch_until(self, end_key):
+        reverse = self.reverse
+        while True:
+            record = self.get()
+            if record is None:
+                break
+            if end_key is not None:
+                if reverse and record[0] < end_key:
+                    break
+                elif not reverse and record[0] > end_key:
+                    break
+            yield record[0] if self.key_only else record
+            self._move(reverse)
+
+
+@contextlib.contextmanager
+def _no_snapshot():
+    yield
+
+
+def snapshot(db):
+    """
+    Return `db.snapshot()`, or a context manager that does nothing if the
+    database does not implement snapshots.
+    """
+    fn = getattr(db, 'snapshot', None)
+    if fn is None:
+        return _no_snapshot()
+    return fn()
+
+
+class _callable_context_manager(object):
+    def __call__(self, fn):
+        def inner(*args, **kwargs):
+            with self:
+                return fn(*args, **kwargs)
+        return inner
+
+
+class transaction(_callable_context_manager):
+    def __init__(self, db):
+        self._db = db
+
+    def __enter__(self):
+        self._db.begin()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self._db.rollback()
+        else:
+            try:
+                self._db.commit()
+            except:
+                try:
+                    self._db.rollback()
+                except:
+                    pass
+                raise
+
+    def commit(self):
+        self._db.commit()
+        self._db.begin()
+
+    def rollback(self):
+        self._db.rollback()
+        self._db.begin()
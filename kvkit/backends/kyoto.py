@@ -1,12 +1,22 @@
 # Requires kyotocabinet Python legacy bindings.
-import operator
+import contextlib
 import os
 import struct
+import threading
+import time
+from itertools import repeat
 
 import kyotocabinet as kc
 
 from kvkit.exceptions import DatabaseError
+from kvkit.backends.helpers import BaseCursor
+from kvkit.backends.helpers import clean_delete_slice
 from kvkit.backends.helpers import clean_key_slice
+from kvkit.backends.helpers import KVHelper
+from kvkit.backends.helpers import READAHEAD
+from kvkit.backends.helpers import transaction
+from kvkit.backends.memory import SnapshotLocal
+from kvkit.backends.memory import versioned_snapshot
 
 
 # Generic modes.
@@ -30,6 +40,9 @@ MERGE_PRESERVE = kc.DB.MADD  # Keep existing values.
 MERGE_REPLACE = kc.DB.MREPLACE  # Modify existing records only.
 MERGE_APPEND = kc.DB.MAPPEND  # Append new values.
 
+# Number of idle cursors each thread keeps for reuse.
+CURSOR_POOL_SIZE = 4
+
 # Special filenames
 DB_PROTOTYPE_HASH = '-'
 DB_PROTOTYPE_TREE = '+'
@@ -142,7 +155,27 @@ page size must be specified before the DB is opened and cannot be changed.
 """
 
 
-class Database(object):
+_missing = object()
+
+
+class _Writer(object):
+    # The writes and transaction a thread has underway, which snapshots
+    # opened by other threads wait for. `finished` counts the times the
+    # thread has become idle.
+    def __init__(self):
+        self.writes = 0
+        self.in_transaction = False
+        self.finished = 0
+
+    def busy(self):
+        return bool(self.writes or self.in_transaction)
+
+    def end(self):
+        if not self.busy():
+            self.finished += 1
+
+
+class Database(KVHelper):
     default_flags = kc.DB.OWRITER | kc.DB.OCREATE
     extension = None
 
@@ -165,6 +198,15 @@ class Database(object):
             self.filename = '%s%s' % (self.filename, self.extension)
         self.db = kc.DB(self._config)
         self._closed = True
+        self._local = SnapshotLocal()
+        self._cursors = threading.local()
+        self._open_cursors = {}
+        self._cursors_lock = threading.Lock()
+        # The `Versions` of each open snapshot, the lock guarding them, and
+        # the `_Writer` of each thread that has written.
+        self._snapshots = []
+        self._lock = threading.RLock()
+        self._writers = {}
         if open_database:
             self.open()
 
@@ -178,6 +220,11 @@ class Database(object):
         return True
 
     def close(self):
+        with self._cursors_lock:
+            cursors, self._open_cursors = self._open_cursors, {}
+            self._cursors = threading.local()
+        for cursor in cursors:
+            cursor.disable()
         if not self.db.close():
             raise DatabaseError(self.db.error())
         self._closed = True
@@ -193,12 +240,67 @@ class Database(object):
         except DatabaseError:
             pass
 
+    def _writer(self):
+        writer = getattr(self._local, 'writer', None)
+        if writer is None:
+            writer = self._local.writer = _Writer()
+            with self._lock:
+                self._writers[threading.current_thread()] = writer
+        return writer
+
+    @contextlib.contextmanager
+    def _writing(self, keys=None):
+        # While snapshots are open, a write first saves the values of the
+        # `keys` it is about to change in each of them. Writes that pass no
+        # keys save the records they change themselves.
+        writer = self._writer()
+        writer.writes += 1
+        try:
+            if keys is not None and self._snapshots:
+                self._save(keys)
+            yield
+        finally:
+            writer.writes -= 1
+            writer.end()
+
+    def _save(self, keys):
+        keys = list(keys)
+        if len(keys) == 1:
+            value = self.db.get(keys[0])
+            old = {} if value is None else {keys[0]: value}
+        else:
+            old = self.db.get_bulk(keys, False)
+        self._save_records((key, old.get(key)) for key in keys)
+
+    def _save_records(self, records):
+        # `records` are `(key, value)` pairs, with a value of `None` for keys
+        # that do not exist.
+        records = list(records)
+        with self._lock:
+            for versions in self._snapshots:
+                for key, value in records:
+                    versions.save(key, value)
+
+    def _save_all(self):
+        # For writes that may change any record.
+        self._save_records(self._stream(None))
+
     def __setitem__(self, key, value):
-        self.db.set(key, value)
+        with self._writing((key,)):
+            self.db.set(key, value)
 
     def __getitem__(self, key):
         if isinstance(key, (list, tuple)):
-            return self.db.get_bulk(key, True)
+            data = self.db.get_bulk(key, True)
+            versions = self._local.versions
+            if versions is not None:
+                for k in key:
+                    value = versions.saved.get(k, _missing)
+                    if value is None:
+                        data.pop(k, None)
+                    elif value is not _missing:
+                        data[k] = value
+            return data
         elif isinstance(key, slice):
             start, stop, reverse = clean_key_slice(key)
             if reverse:
@@ -206,20 +308,33 @@ class Database(object):
             else:
                 return self.get_slice(start, stop)
         else:
-            value = self.db.get(key)
+            value = self._get(key)
             if value is None:
                 raise KeyError(key)
             return value
 
+    def _get(self, key):
+        # Return the value, as of the snapshot pinned to this thread if
+        # there is one, or `None`.
+        value = self.db.get(key)
+        versions = self._local.versions
+        if versions is not None:
+            return versions.get(key, value)
+        return value
+
     def __delitem__(self, key):
+        if isinstance(key, slice):
+            return self.delete_range(*clean_delete_slice(key))
         if isinstance(key, (list, tuple)):
-            self.db.remove_bulk(key, True)
-        elif isinstance(key, slice):
-            pass
+            with self._writing(key):
+                self.db.remove_bulk(key, True)
         else:
-            self.db.remove(key)
+            with self._writing((key,)):
+                self.db.remove(key)
 
     def __contains__(self, key):
+        if self._local.versions is not None:
+            return self._get(key) is not None
         return self.db.check(key) != -1
 
     def __len__(self):
@@ -233,9 +348,10 @@ class Database(object):
         if _data:
             if kwargs:
                 _data.update(kwargs)
-            ret = self.db.set_bulk(_data, True)
         else:
-            ret = self.db.set_bulk(kwargs, True)
+            _data = kwargs
+        with self._writing(_data):
+            ret = self.db.set_bulk(_data, True)
         if ret < 0:
             raise DatabaseError('Error updating records: %s' % self.db.error())
         return ret
@@ -246,18 +362,38 @@ class Database(object):
         returning the value.
         """
         if key:
-            ret = self.db.seize(key)
+            with self._writing((key,)):
+                ret = self.db.seize(key)
         else:
-            ret = self.db.shift()
+            with self._writing():
+                ret = self._shift()
 
         if ret is None:
             raise KeyError(key)
 
         return ret
 
+    def _shift(self):
+        if not self._snapshots:
+            return self.db.shift()
+        # The first key must be known to save its value.
+        cursor = self.db.cursor()
+        try:
+            key = cursor.get_key() if cursor.jump() else None
+        finally:
+            cursor.disable()
+        if key is None:
+            return None
+        self._save((key,))
+        value = self.db.seize(key)
+        return None if value is None else (key, value)
+
     def clear(self):
         """Remove all records, returning `True` on success."""
-        return self.db.clear()
+        with self._writing():
+            if self._snapshots:
+                self._save_all()
+            return self.db.clear()
 
     def flush(self, hard=True):
         """Synchronize to disk."""
@@ -270,7 +406,8 @@ class Database(object):
 
         Returns boolean indicating whether value was added.
         """
-        return self.db.add(key, value)
+        with self._writing((key,)):
+            return self.db.add(key, value)
 
     def replace(self, key, value):
         """
@@ -279,14 +416,16 @@ class Database(object):
 
         Returns boolean indicating whether value was replaced.
         """
-        return self.db.replace(key, value)
+        with self._writing((key,)):
+            return self.db.replace(key, value)
 
     def append(self, key, value):
         """
         Append the value to a pre-existing value at the given key. If no
         value exists, this is equivalent to set.
         """
-        return self.db.append(key, value)
+        with self._writing((key,)):
+            return self.db.append(key, value)
 
     def cas(self, key, old, new):
         """
@@ -295,7 +434,8 @@ class Database(object):
 
         Returns boolean indicating if the value was swapped.
         """
-        return self.db.cas(key, old, new)
+        with self._writing((key,)):
+            return self.db.cas(key, old, new)
 
     def copy_to_file(self, dest):
         """
@@ -310,23 +450,127 @@ class Database(object):
 
         Returns boolean indicating success.
         """
-        return self.db.begin_transaction(hard)
+        ret = self.db.begin_transaction(hard)
+        # Snapshots opened by other threads wait for the transaction to end.
+        self._writer().in_transaction = ret
+        return ret
 
     def commit(self):
         """
         Commit a transaction. Returns boolean indicating success.
         """
-        return self.db.end_transaction(True)
+        return self._end_transaction(True)
 
     def rollback(self):
         """
         Rollback a transaction. Returns boolean indicating success.
         """
-        return self.db.end_transaction(False)
+        return self._end_transaction(False)
+
+    def _end_transaction(self, commit):
+        writer = self._writer()
+        try:
+            return self.db.end_transaction(commit)
+        finally:
+            writer.in_transaction = False
+            writer.end()
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        """
+        Pin the lookups, slices and cursors of this thread inside the block
+        to the state of the database when it began. Kyotocabinet has no
+        snapshots, so they are copy-on-write: while one is open, each write
+        first saves the values it replaces.
+
+        Opening a snapshot waits for the writes that other threads have
+        underway, which may not have saved their old values, and for their
+        transactions, which could be rolled back without saving. Writes
+        never wait for snapshots.
+        """
+        if self._local.versions is not None:
+            # Nested snapshots share the outermost one.
+            yield
+            return
+        with versioned_snapshot(self):
+            self._wait_for_writers()
+            yield
+
+    def _wait_for_writers(self):
+        me = threading.current_thread()
+        with self._lock:
+            for thread in [t for t in self._writers if not t.is_alive()]:
+                del self._writers[thread]
+            busy = [(writer, writer.finished)
+                    for thread, writer in self._writers.items()
+                    if thread is not me and writer.busy()]
+        delay = 0.0001
+        while busy:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.01)
+            busy = [(writer, finished) for writer, finished in busy
+                    if writer.busy() and writer.finished == finished]
 
     def transaction(self):
         return transaction(self)
 
+    def delete_range(self, start, stop):
+        """
+        Remove the keys from `start` to `stop`, inclusive, by stepping a
+        cursor through the range. Unless a transaction is already in progress
+        the removal is done in one. Returns the number of keys removed.
+        """
+        if self._writer().in_transaction:
+            return self._delete_range(start, stop)
+        with self.transaction():
+            return self._delete_range(start, stop)
+
+    def apply_batch(self, sets, deletes):
+        """
+        Store the records in the `sets` dictionary and remove the keys in
+        `deletes` using the bulk APIs. Unless a transaction is already in
+        progress, this is done in one.
+        """
+        if self._writer().in_transaction:
+            return self._apply_batch(sets, deletes)
+        with self.transaction():
+            return self._apply_batch(sets, deletes)
+
+    def _apply_batch(self, sets, deletes):
+        with self._writing(list(deletes) + list(sets)):
+            self._write_batch(sets, deletes)
+
+    def _write_batch(self, sets, deletes):
+        if deletes and self.db.remove_bulk(list(deletes), False) < 0:
+            raise DatabaseError(self.db.error())
+        if sets and self.db.set_bulk(sets, False) < 0:
+            raise DatabaseError(self.db.error())
+
+    def _delete_range(self, start, stop):
+        with self._writing():
+            return self._remove_range(start, stop)
+
+    def _remove_range(self, start, stop):
+        count = 0
+        cursor = self.db.cursor()
+        try:
+            if start is None:
+                found = cursor.jump()
+            else:
+                found = cursor.jump(start)
+            while found:
+                key = cursor.get_key()
+                if key is None or (stop is not None and key > stop):
+                    break
+                if self._snapshots:
+                    self._save_records([(key, cursor.get_value())])
+                # Removing the record moves the cursor to the next one.
+                found = cursor.remove()
+                count += 1
+        finally:
+            cursor.disable()
+        return count
+
     def match_prefix(self, prefix, max_records=-1):
         return self.db.match_prefix(prefix, max_records)
 
@@ -344,13 +588,76 @@ class Database(object):
         return self.db.occupy(writable, processor)
 
     def incr(self, key, n=1, initial=0):
-        return self.db.increment(key, n, initial)
+        with self._writing((key,)):
+            return self.db.increment(key, n, initial)
 
     def decr(self, key, n=1, initial=0):
-        return self.db.increment(key, n * -1, initial)
+        return self.incr(key, n * -1, initial)
 
-    def cursor(self, reverse=False):
-        return Cursor(self.db.cursor(), reverse)
+    def incr_many(self, deltas):
+        """
+        Add each amount in the `deltas` dictionary to its counter with the
+        native `increment()`. Unless a transaction is already in progress,
+        this is done in one.
+        """
+        if self._writer().in_transaction:
+            return self._incr_many(deltas)
+        with self.transaction():
+            return self._incr_many(deltas)
+
+    def _incr_many(self, deltas):
+        increment = self.db.increment
+        with self._writing(deltas):
+            for key, amount in deltas.iteritems():
+                increment(key, amount, 0)
+
+    def cursor(self, reverse=False, readahead=READAHEAD, key_only=False):
+        return Cursor(self, reverse, readahead, key_only)
+
+    def _acquire_cursor(self):
+        # Creating a kyotocabinet cursor registers it with the database under
+        # a lock shared by every thread, so each thread keeps the cursors it
+        # has finished with and reuses them.
+        idle = getattr(self._cursors, 'idle', None)
+        if idle:
+            return idle.pop()
+        cursor = self.db.cursor()
+        with self._cursors_lock:
+            # Cursors are kept with their threads, so that those pooled by
+            # threads that have since exited can be disabled.
+            dead = [old for old, thread in self._open_cursors.items()
+                    if not thread.is_alive()]
+            for old in dead:
+                del self._open_cursors[old]
+            self._open_cursors[cursor] = threading.current_thread()
+        for old in dead:
+            old.disable()
+        return cursor
+
+    def _release_cursor(self, cursor):
+        idle = getattr(self._cursors, 'idle', None)
+        if idle is None:
+            idle = self._cursors.idle = []
+        if cursor not in self._open_cursors:
+            # The database was closed while the cursor was in use.
+            return
+        elif len(idle) < CURSOR_POOL_SIZE:
+            idle.append(cursor)
+        else:
+            with self._cursors_lock:
+                self._open_cursors.pop(cursor, None)
+            cursor.disable()
+
+    def _reader(self):
+        # The handle can not be used across a fork, so open the file again,
+        # read-only and without locking, since this process holds the lock.
+        reader = type(self)(
+            self.filename,
+            exceptional=bool(self._config & EXCEPTIONAL),
+            concurrent=bool(self._config & CONCURRENT),
+            open_database=False)
+        reader.open(READER | NOLOCK)
+        return reader
 
     def atomic(self, hard=False):
         """
@@ -364,7 +671,13 @@ class Database(object):
                 return True
 
             def inner():
-                return self.db.transaction(fn_wrapper)
+                writer = self._writer()
+                writer.in_transaction = True
+                try:
+                    return self.db.transaction(fn_wrapper)
+                finally:
+                    writer.in_transaction = False
+                    writer.end()
 
             return inner
         return decorator
@@ -374,16 +687,39 @@ class Database(object):
         Process database using a function. The function should accept
         a key and value.
         """
-        return self.db.iterate(fn)
+        with self._writing():
+            if self._snapshots:
+                fn = self._saving_visitor(fn)
+            return self.db.iterate(fn)
+
+    def _saving_visitor(self, fn):
+        # Save each record the visitor changes, before it is changed.
+        def visit(key, value):
+            result = fn(key, value)
+            if result is not NOP:
+                self._save_records([(key, value)])
+            return result
+        return visit
 
     def cursor_process(self, fn):
         """
         Traverse records by cursor, using the given function.
         """
-        return self.db.cursor_process(fn)
+        with self._writing():
+            if self._snapshots:
+                self._save_all()
+            return self.db.cursor_process(fn)
 
-    def process_items(self, fn, store_result=False):
-        if store_result:
+    def process_items(self, fn, store_result=False, stream=False):
+        """
+        Call `fn(key, value)` for every record, returning a list of the
+        results if `store_result`. With `stream=True`, a generator of the
+        results is returned instead, which reads the records one at a time,
+        so a full scan runs in constant memory.
+        """
+        if stream:
+            return self._stream(fn)
+        elif store_result:
             accum = []
         else:
             accum = None
@@ -404,6 +740,24 @@ class Database(object):
         self.db.cursor_process(process)
         return accum
 
+    def _stream(self, fn):
+        # Driving a cursor from Python, rather than from `cursor_process()`,
+        # lets the scan be suspended between records. Each record is read and
+        # the cursor advanced by a single call, so this is about as fast as
+        # the visitor.
+        cursor = self._acquire_cursor()
+        try:
+            if not cursor.jump():
+                return
+            get = cursor.get
+            while True:
+                record = get(True)
+                if record is None:
+                    break
+                yield record if fn is None else fn(*record)
+        finally:
+            self._release_cursor(cursor)
+
     def __iter__(self):
         return iter(self.db)
 
@@ -411,25 +765,28 @@ class Database(object):
         return iter(self.db)
 
     def itervalues(self):
-        with self.cursor() as cursor:
-            for _, value in cursor:
-                yield value
+        return self._stream(lambda k, v: v)
 
-    def values(self):
+    def values(self, stream=False):
         processor = lambda k, v: v
-        return self.process_items(processor, True)
+        return self.process_items(processor, True, stream)
 
     def iteritems(self):
-        with self.cursor() as cursor:
-            for item in cursor:
-                yield item
+        return self._stream(None)
 
-    def items(self):
+    def items(self, stream=False):
+        if stream:
+            return self._stream(None)
         processor = lambda k, v: (k, v)
         return self.process_items(processor, True)
 
     def merge(self, databases, mode=MERGE_OVERWRITE):
-        return self.db.merge([database.db for database in databases], mode)
+        with self._writing():
+            if self._snapshots:
+                self._save(key for database in databases
+                           for key in database.db)
+            return self.db.merge(
+                [database.db for database in databases], mode)
 
     def __or__(self, rhs):
         return self.merge(rhs)
@@ -446,167 +803,132 @@ class Database(object):
     def _set_float(self, key, value):
         self[key] = struct.pack('>d', value)
 
-    def get_slice(self, start, end):
-        if start and start > end:
-            raise ValueError('%s must be less than or equal to %s.' % (
-                start, end))
-
-        with self.cursor() as cursor:
-            if start is None:
-                cursor.first()
-            else:
-                cursor.seek(start)
-
-            for i, (k, v) in enumerate(cursor.fetch_until(end)):
-                yield (k, v)
-
-    def get_slice_rev(self, start, end):
-        if start and start < end:
-            raise ValueError('%s must be greater than or equal to %s.' % (
-                start, end))
-
-        # Iterating backwards requires a bit more hackery...
-        with self.cursor(reverse=True) as cursor:
-            if start is None:
-                cursor.last()
-            else:
-                if not cursor.seek(start):
-                    cursor.last()
-
-            # When seeking, kyotocabinet may go to the next highest matching
-            # record. For backwards searches, we want the lowest without
-            # going over as the start point. This bit corrects that.
-            res = cursor.get()
-            if res and start and res[0] > start:
-                cursor._previous()
-
-            for i, (k, v) in enumerate(cursor.fetch_until(end)):
-                yield (k, v)
-
-
-class Cursor(object):
-    def __init__(self, cursor, reverse=False):
-        self._cursor = cursor
-        self._reverse = reverse
-        self._consumed = False
-
-    def __enter__(self):
-        if self._reverse:
-            self.last()
-        else:
-            self.first()
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
+    def get_prefix(self, prefix, max_records=-1):
+        """
+        Return a list of the records whose key begins with `prefix`, in key
+        order. Rather than stepping a cursor, the keys are found with
+        `match_prefix()` and the values read with a single `get_bulk()`.
+        """
+        if self._local.versions is not None:
+            # Keys deleted since the snapshot are only found by a cursor.
+            return super(Database, self).get_prefix(prefix, max_records)
+        keys = self.db.match_prefix(prefix, max_records)
+        if not keys:
+            return []
+        data = self.db.get_bulk(keys, False)
+        return [(key, data[key]) for key in sorted(keys) if key in data]
+
+
+class Cursor(BaseCursor):
+    # Every read positions a kyotocabinet cursor from scratch, so one is only
+    # borrowed from the calling thread's pool for the duration of a read, and
+    # a cursor may be handed from one thread to another.
+    def __init__(self, *args, **kwargs):
+        super(Cursor, self).__init__(*args, **kwargs)
+        # A cursor opened inside a snapshot reads from it.
+        self._versions = self.db._local.versions
+
+    def _jump(self, cursor, start, reverse, inclusive):
+        if start is None:
+            return cursor.jump_back() if reverse else cursor.jump()
+        elif not reverse:
+            found = cursor.jump(start)
+            if found and not inclusive and cursor.get_key() == start:
+                found = cursor.step()
+            return found
+        elif cursor.jump(start):
+            # When seeking, kyotocabinet goes to the next highest matching
+            # record. For backwards scans, we want the lowest without going
+            # over as the start point.
+            if inclusive and cursor.get_key() == start:
+                return True
+            return cursor.step_back()
+        return cursor.jump_back()
+
+    def _read(self, start, reverse, inclusive, count, stop=None):
+        if self._versions is not None:
+            return self._read_versions(start, reverse, inclusive, count, stop)
+        return self._read_live(start, reverse, inclusive, count, stop)
+
+    def _read_versions(self, start, reverse, inclusive, count, stop):
+        # The live records are merged with the keys saved by the snapshot,
+        # which include those deleted since. Each step reads a batch of both,
+        # the saved keys last, so that any write made after the live records
+        # were read has saved the value it replaced. Only keys up to the end
+        # of the shorter batch are merged, as the other may hold keys between
+        # them.
+        versions = self._versions
+        records = []
+        while len(records) < count:
+            live = self._read_live(
+                start, reverse, inclusive, count - len(records), stop)
+            with self.db._lock:
+                saved = versions.keys.batch(start, stop, reverse, inclusive)
+            ends = saved[-1:]
+            if len(live) == count - len(records):
+                ends.append(live[-1][0])
+            end = (max if reverse else min)(ends) if ends else None
+
+            values = dict(live)
+            keys = set(values)
+            keys.update(saved)
+            for key in sorted(keys, reverse=reverse):
+                if end is not None and (key < end if reverse else key > end):
+                    break
+                value = versions.saved.get(key, _missing)
+                if value is None:
+                    # The key did not exist when the snapshot was taken.
+                    continue
+                elif value is _missing:
+                    value = values[key]
+                records.append((key, None if self.key_only else value))
+                if len(records) == count:
+                    break
+            if end is None:
+                break
+            start, inclusive = end, False
+        return records
+
+    def _read_live(self, start, reverse, inclusive, count, stop=None):
+        # Records are read in a tight loop, checking the stop key as they are
+        # read, to keep the per-record overhead low.
+        cursor = self.db._acquire_cursor()
         try:
-            self.close()
-        except:
-            pass
-
-    def close(self):
-        self._cursor.disable()
-
-    def first(self):
-        self._consumed = False
-        self._cursor.jump()
-
-    def last(self):
-        self._consumed = False
-        self._cursor.jump_back()
-
-    def seek(self, key):
-        self._consumed = False
-        return self._cursor.jump(key)
-
-    def __iter__(self):
-        self._consumed = False
-        return self
-
-    def next(self):
-        if self._consumed:
-            raise StopIteration
-
-        key_value = self.get()
-        if key_value is None:
-            self._consumed = True
-            raise StopIteration
-
-        if self._reverse:
-            self._consumed = not self._previous()
-        else:
-            self._consumed = not self._next()
-
-        return key_value
-
-    def set(self, value, step=False):
-        return self._cursor.set_value(value, step)
-
-    def get(self):
-        return self._cursor.get()
-
-    def remove(self):
-        return self._cursor.remove()
-
-    def pop(self):
-        return self._cursor.seize()
-
-    def _next(self):
-        return self._cursor.step()
-
-    def _previous(self):
-        return self._cursor.step_back()
-
-    def fetch_count(self, n):
-        while n > 0:
-            yield next(self)
-            n -= 1
-
-    def fetch_until(self, end_key):
-        compare = operator.le if self._reverse else operator.ge
-        for key, value in self:
-            if compare(key, end_key):
-                if key == end_key:
-                    yield (key, value)
-                raise StopIteration
-            else:
-                yield (key, value)
-
-
-class _callable_context_manager(object):
-    def __call__(self, fn):
-        def inner(*args, **kwargs):
-            with self:
-                return fn(*args, **kwargs)
-        return inner
-
-
-class transaction(_callable_context_manager):
-    def __init__(self, db):
-        self._db = db
-
-    def __enter__(self):
-        self._db.begin()
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if exc_type:
-            self._db.rollback()
+            return self._read_records(
+                cursor, start, reverse, inclusive, count, stop)
+        finally:
+            self.db._release_cursor(cursor)
+
+    def _read_records(self, cursor, start, reverse, inclusive, count, stop):
+        records = []
+        if not self._jump(cursor, start, reverse, inclusive):
+            return records
+
+        append = records.append
+        key_only = self.key_only
+        get = cursor.get_key if key_only else cursor.get
+        if reverse:
+            step_back = cursor.step_back
+            for _ in repeat(None, count):
+                record = get()
+                if record is None or (stop is not None and (
+                        record if key_only else record[0]) < stop):
+                    break
+                append(record)
+                if not step_back():
+                    break
         else:
-            try:
-                self._db.commit()
-            except:
-                try:
-                    self._db.rollback()
-                except:
-                    pass
-                raise
-
-    def commit(self):
-        self._db.commit()
-        self._db.begin()
+            for _ in repeat(None, count):
+                # Read the record and advance in a single call.
+                record = get(True)
+                if record is None or (stop is not None and (
+                        record if key_only else record[0]) > stop):
+                    break
+                append(record)
 
-    def rollback(self):
-        self._db.rollback()
-        self._db.begin()
+        if key_only:
+            return [(key, None) for key in records]
+        return records
 
 
 class HashDB(Database):
@@ -637,6 +959,10 @@ class PlainTextDB(Database):
 class _FilenameDatabase(Database):
     filename = None
 
+    def _reader(self):
+        # Volatile databases are read from the worker's copy of the memory.
+        return self
+
     def __init__(self, exceptional=False, concurrent=False, **opts):
         super(_FilenameDatabase, self).__init__(
             self.filename,
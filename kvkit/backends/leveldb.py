@@ -1,11 +1,16 @@
 # Requries plyvel.
 from contextlib import contextmanager
+import itertools
 import struct
+import threading
 
 import plyvel
 
+from kvkit.backends.helpers import BaseCursor
+from kvkit.backends.helpers import clean_delete_slice
 from kvkit.backends.helpers import clean_key_slice
 from kvkit.backends.helpers import KVHelper
+from kvkit.backends.helpers import READAHEAD
 
 
 class LevelDB(KVHelper):
@@ -14,6 +19,12 @@ class LevelDB(KVHelper):
         kwargs.setdefault('create_if_missing', True)
         self.db = plyvel.DB(filename, *args, **kwargs)
         self._closed = False
+        self._local = threading.local()
+
+    def _source(self):
+        # The snapshot pinned to this thread, if any, which can be read
+        # just like the database.
+        return getattr(self._local, 'snapshot', None) or self.db
 
     def __getitem__(self, key):
         if isinstance(key, slice):
@@ -22,16 +33,22 @@ class LevelDB(KVHelper):
                 # LevelDB uses slightly different meaning for start/stop when
                 # reverse than kyotocabinet.
                 start, stop = stop, start
-            return self.db.iterator(
+            return self._source().iterator(
                 start=start,
                 stop=stop,
                 include_start=True,
                 include_stop=True,
                 reverse=reverse)
         elif isinstance(key, (list, tuple)):
-            pass
+            source = self._source()
+            accum = {}
+            for k in key:
+                value = source.get(k)
+                if value is not None:
+                    accum[k] = value
+            return accum
         else:
-            res = self.db.get(key)
+            res = self._source().get(key)
             if res is None:
                 raise KeyError(key)
             return res
@@ -51,21 +68,126 @@ class LevelDB(KVHelper):
         self.db.put(key, value)
 
     def __delitem__(self, key):
-        self.db.delete(key)
+        if isinstance(key, slice):
+            self.delete_range(*clean_delete_slice(key))
+        else:
+            self.db.delete(key)
+
+    def delete_range(self, start, stop, batch_size=1000):
+        """
+        Delete the keys from `start` to `stop`, inclusive, using a write batch
+        for every `batch_size` keys. Returns the number of keys deleted.
+        """
+        count = 0
+        batch = self.db.write_batch()
+        # The iterator reads from an implicit snapshot, so it is unaffected by
+        # the batches written while iterating.
+        for key in self.db.iterator(start=start, stop=stop, include_stop=True,
+                                    include_value=False):
+            batch.delete(key)
+            count += 1
+            if count % batch_size == 0:
+                batch.write()
+                batch = self.db.write_batch()
+        batch.write()
+        return count
+
+    def apply_batch(self, sets, deletes):
+        """
+        Store the records in the `sets` dictionary and remove the keys in
+        `deletes` in a single write batch.
+        """
+        with self.db.write_batch(transaction=True) as batch:
+            for key in deletes:
+                batch.delete(key)
+            for key, value in sets.iteritems():
+                batch.put(key, value)
 
     def update(self, _data=None, **kwargs):
         batch = self.db.write_batch()
         if _data:
-            kwargs.update(_data)
-        for key, value in kwargs.iteritems():
+            if kwargs:
+                _data.update(kwargs)
+        else:
+            _data = kwargs
+        for key, value in _data.iteritems():
             batch.put(key, value)
         batch.write()
 
     def keys(self):
-        return (key for key in self.db.iterator(include_value=False))
+        return (key for key in self._source().iterator(include_value=False))
 
     def values(self):
-        return (value for value in self.db.iterator(include_key=False))
+        return (value for value in self._source().iterator(include_key=False))
 
     def items(self):
-        return (item for item in self.db)
+        return (item for item in self._source().iterator())
+
+    @contextmanager
+    def snapshot(self):
+        """
+        Read from a LevelDB snapshot inside the block, so this thread sees
+        the database as it was when the block began.
+        """
+        if getattr(self._local, 'snapshot', None) is not None:
+            yield
+            return
+        self._local.snapshot = self.db.snapshot()
+        try:
+            yield
+        finally:
+            snapshot, self._local.snapshot = self._local.snapshot, None
+            snapshot.close()
+
+    def cursor(self, reverse=False, readahead=READAHEAD, key_only=False):
+        return Cursor(self, reverse, readahead, key_only)
+
+    # A LevelDB directory can only be opened by one process at a time.
+    _reader = None
+
+
+class Cursor(BaseCursor):
+    # A read that carries on from the last record of the previous one, as
+    # the batches of a scan and steps past the readahead do, reads on from
+    # the same iterator instead of opening and seeking a new one.
+    _iterator = None
+    _position = None
+
+    def close(self):
+        super(Cursor, self).close()
+        self._close_iterator()
+
+    def _close_iterator(self):
+        if self._iterator is not None:
+            self._iterator.close()
+        self._iterator = self._position = None
+
+    def _read(self, start, reverse, inclusive, count, stop=None):
+        if (inclusive or start is None or
+                self._position != (start, reverse, stop)):
+            self._close_iterator()
+            source = self.db._source()
+            if reverse:
+                self._iterator = source.iterator(
+                    start=stop,
+                    stop=start,
+                    include_start=True,
+                    include_stop=inclusive,
+                    include_value=not self.key_only,
+                    reverse=True)
+            else:
+                self._iterator = source.iterator(
+                    start=start,
+                    stop=stop,
+                    include_start=inclusive,
+                    include_stop=True,
+                    include_value=not self.key_only)
+        records = list(itertools.islice(self._iterator, count))
+        if records and len(records) == count:
+            last = records[-1] if self.key_only else records[-1][0]
+            self._position = (last, reverse, stop)
+        else:
+            self._close_iterator()
+        if self.key_only:
+            return [(key, None) for key in records]
+        return records
@@ -0,0 +1,807 @@
+# Pure-Python in-memory ordered database, no dependencies.
+import bisect
+import contextlib
+import re
+import struct
+import threading
+
+from kvkit.exceptions import DatabaseError
+from kvkit.backends.helpers import BaseCursor
+from kvkit.backends.helpers import clean_delete_slice
+from kvkit.backends.helpers import clean_key_slice
+from kvkit.backends.helpers import KVHelper
+from kvkit.backends.helpers import READAHEAD
+from kvkit.backends.helpers import to_bytes
+from kvkit.backends.helpers import transaction
+
+
+# Merge options.
+MERGE_OVERWRITE = 'overwrite'  # Overwrite existing values.
+MERGE_PRESERVE = 'preserve'  # Keep existing values.
+MERGE_REPLACE = 'replace'  # Modify existing records only.
+MERGE_APPEND = 'append'  # Append new values.
+
+_missing = object()
+
+
+def _edit_distance(a, b, limit):
+    # Levenshtein distance between `a` and `b`, or `limit + 1` once it is
+    # known to exceed `limit`.
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = range(len(b) + 1)
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class SortedKeys(object):
+    """
+    Sorted list of keys, stored as a list of sorted chunks of at most
+    `2 * load` keys each, along with the largest key of each chunk. Inserts
+    and deletes only shift the keys of a single chunk.
+    """
+    def __init__(self, keys=None, load=1000):
+        self._load = load
+        self.clear()
+        if keys:
+            keys = sorted(keys)
+            self._chunks = [
+                keys[i:i + load] for i in range(0, len(keys), load)]
+            self._maxes = [chunk[-1] for chunk in self._chunks]
+            self._len = len(keys)
+
+    def clear(self):
+        self._chunks = []
+        self._maxes = []
+        self._len = 0
+        # Incremented whenever a key is added or removed, so that readers can
+        # tell when a position they hold is stale.
+        self.version = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            for key in chunk:
+                yield key
+
+    def insert(self, key):
+        """Insert a key, which must not already be present."""
+        chunks, maxes = self._chunks, self._maxes
+        if not maxes:
+            chunks.append([key])
+            maxes.append(key)
+        else:
+            i = bisect.bisect_left(maxes, key)
+            if i == len(maxes):
+                i -= 1
+                chunks[i].append(key)
+                maxes[i] = key
+            else:
+                bisect.insort(chunks[i], key)
+
+            chunk = chunks[i]
+            if len(chunk) > 2 * self._load:
+                chunks[i:i + 1] = [chunk[:self._load], chunk[self._load:]]
+                maxes[i:i + 1] = [chunk[self._load - 1], chunk[-1]]
+        self._len += 1
+        self.version += 1
+
+    def remove(self, key):
+        """Remove a key, which must be present."""
+        chunks, maxes = self._chunks, self._maxes
+        i = bisect.bisect_left(maxes, key)
+        chunk = chunks[i]
+        del chunk[bisect.bisect_left(chunk, key)]
+        self._len -= 1
+        self.version += 1
+
+        if not chunk:
+            del chunks[i]
+            del maxes[i]
+            return
+        maxes[i] = chunk[-1]
+
+        # Fold small chunks into their neighbor to keep the chunk count low.
+        if len(chunk) < self._load // 2 and len(chunks) > 1:
+            if i == len(chunks) - 1:
+                i -= 1
+            merged = chunks[i] + chunks[i + 1]
+            if len(merged) > 2 * self._load:
+                half = len(merged) // 2
+                chunks[i:i + 2] = [merged[:half], merged[half:]]
+                maxes[i:i + 2] = [merged[half - 1], merged[-1]]
+            else:
+                chunks[i:i + 2] = [merged]
+                maxes[i:i + 2] = [merged[-1]]
+
+    def first(self):
+        if self._chunks:
+            return self._chunks[0][0]
+
+    def last(self):
+        if self._chunks:
+            return self._chunks[-1][-1]
+
+    def batch(self, start=None, stop=None, reverse=False, inclusive=True):
+        """
+        Return the next run of keys, taken from a single chunk, beginning at
+        `start` and not going past `stop`. When `reverse` is set the keys are
+        returned in descending order and `start` is the upper bound. If
+        `inclusive` is false, `start` itself is skipped. An empty list means
+        there are no more keys in the range.
+        """
+        chunks, maxes = self._chunks, self._maxes
+        if not chunks:
+            return []
+
+        if not reverse:
+            if start is None:
+                i = j = 0
+            elif inclusive:
+                i = bisect.bisect_left(maxes, start)
+                if i == len(maxes):
+                    return []
+                j = bisect.bisect_left(chunks[i], start)
+            else:
+                i = bisect.bisect_right(maxes, start)
+                if i == len(maxes):
+                    return []
+                j = bisect.bisect_right(chunks[i], start)
+            chunk = chunks[i]
+            if stop is None or maxes[i] <= stop:
+                return chunk[j:]
+            return chunk[j:bisect.bisect_right(chunk, stop)]
+
+        if start is None:
+            i = len(chunks) - 1
+            j = len(chunks[i])
+        else:
+            i = bisect.bisect_left(maxes, start)
+            if i == len(maxes):
+                i -= 1
+                j = len(chunks[i])
+            elif inclusive:
+                j = bisect.bisect_right(chunks[i], start)
+            else:
+                j = bisect.bisect_left(chunks[i], start)
+            if j == 0:
+                # Every key in the chunk is past `start`, so use the tail of
+                # the previous chunk.
+                i -= 1
+                if i < 0:
+                    return []
+                j = len(chunks[i])
+        chunk = chunks[i]
+        k = 0 if stop is None else bisect.bisect_left(chunk, stop, 0, j)
+        return chunk[j - 1:k - 1 if k else None:-1]
+
+    def irange(self, lock, start=None, stop=None, reverse=False):
+        """
+        Iterate over the keys from `start` to `stop`, inclusive. Keys are read
+        a chunk at a time while holding `lock`. Between chunks the position is
+        recovered from the last key, so writes made while iterating are safe.
+        """
+        with lock:
+            batch = self.batch(start, stop, reverse)
+        while batch:
+            for key in batch:
+                yield key
+            with lock:
+                batch = self.batch(batch[-1], stop, reverse, False)
+
+
+class Versions(object):
+    """
+    The state of a database when a snapshot was taken, recorded lazily.
+    Each key written after the snapshot is saved, before it is changed, with
+    what it held at the time, or `None` if it did not exist. Keys that
+    existed are also kept in a `SortedKeys`, so slices can find records that
+    have since been deleted.
+    """
+    def __init__(self):
+        self.saved = {}
+        self.keys = SortedKeys()
+
+    def save(self, key, old):
+        if key not in self.saved:
+            self.saved[key] = old
+            if old is not None:
+                self.keys.insert(key)
+
+    def get(self, key, current):
+        # `current` must be read before calling, as a write made after the
+        # snapshot saves the old value before changing it.
+        return self.saved.get(key, current)
+
+
+class SnapshotLocal(threading.local):
+    # The `Versions` of the snapshot pinned to each thread, if any.
+    versions = None
+
+
+def union_irange(lock, first, second, start=None, stop=None, reverse=False):
+    """
+    Iterate over the keys of two `SortedKeys` from `start` to `stop`,
+    inclusive, without duplicates. Each step reads a batch from both while
+    holding `lock`, and only keys up to the end of the shorter batch are
+    yielded, as the other may hold keys between them.
+    """
+    inclusive = True
+    while True:
+        with lock:
+            a = first.batch(start, stop, reverse, inclusive)
+            b = second.batch(start, stop, reverse, inclusive)
+        if not a or not b:
+            end = (a or b or [None])[-1]
+        elif reverse:
+            end = max(a[-1], b[-1])
+        else:
+            end = min(a[-1], b[-1])
+        if end is None:
+            return
+        if reverse:
+            keys = set(key for key in a + b if key >= end)
+        else:
+            keys = set(key for key in a + b if key <= end)
+        for key in sorted(keys, reverse=reverse):
+            yield key
+        start, inclusive = end, False
+
+
+def read_versions(cursor, versions, start, reverse, inclusive, count, stop):
+    """
+    Implements `BaseCursor._read()` for a cursor opened inside a snapshot,
+    on a database with `_iterate_versions()`, so that its records are read
+    as of the snapshot.
+    """
+    records = []
+    if count <= 0:
+        return records
+    rows = cursor.db._iterate_versions(versions, start, stop, reverse)
+    for key, value in rows:
+        if key == start and not inclusive:
+            continue
+        records.append((key, None if cursor.key_only else value))
+        if len(records) == count:
+            break
+    return records
+
+
+@contextlib.contextmanager
+def versioned_snapshot(db):
+    """
+    Implements `snapshot()` for databases whose writes save the old value of
+    each key, while holding `db._lock`, in the `Versions` listed in
+    `db._snapshots`, as `_set()` and `_delete()` do here. The versions are
+    pinned to the current thread in `db._local`, a `SnapshotLocal`.
+    """
+    if db._local.versions is not None:
+        # Nested snapshots share the outermost one.
+        yield
+        return
+    versions = Versions()
+    with db._lock:
+        db._snapshots.append(versions)
+    db._local.versions = versions
+    try:
+        yield
+    finally:
+        db._local.versions = None
+        with db._lock:
+            db._snapshots.remove(versions)
+
+
+class MemoryDB(KVHelper):
+    """
+    Ordered in-memory database. Values are kept in a dictionary, so lookups
+    are O(1), and the keys are kept in a `SortedKeys` list for slicing and
+    cursors. Transactions are implemented with an undo log, and may be
+    nested. All writes are serialized by a re-entrant lock, which is also
+    held for the duration of a transaction.
+
+    Snapshots are copy-on-write: while one is open, each write first saves
+    the value it replaces, so lookups and slices made inside the snapshot
+    can still read it.
+    """
+    def __init__(self, filename=None, load=1000):
+        self.filename = filename
+        self._data = {}
+        self._keys = SortedKeys(load=load)
+        self._lock = threading.RLock()
+        # Stack of undo logs, one per open transaction, mapping each key
+        # modified to its value when the transaction began.
+        self._undo = []
+        # The `Versions` of each open snapshot, and the one pinned to the
+        # current thread.
+        self._snapshots = []
+        self._local = SnapshotLocal()
+
+    def open(self):
+        return True
+
+    def close(self):
+        # Data lives for as long as the object does, so closing is a no-op.
+        return True
+
+    def _set(self, key, value):
+        old = self._data.get(key, _missing)
+        for versions in self._snapshots:
+            versions.save(key, None if old is _missing else old)
+        if old is _missing:
+            self._keys.insert(key)
+        if self._undo and key not in self._undo[-1]:
+            self._undo[-1][key] = old
+        self._data[key] = value
+
+    def _delete(self, key):
+        old = self._data.get(key, _missing)
+        if old is _missing:
+            return False
+        for versions in self._snapshots:
+            versions.save(key, old)
+        del self._data[key]
+        self._keys.remove(key)
+        if self._undo and key not in self._undo[-1]:
+            self._undo[-1][key] = old
+        return True
+
+    def __setitem__(self, key, value):
+        key, value = to_bytes(key), to_bytes(value)
+        with self._lock:
+            self._set(key, value)
+
+    def __getitem__(self, key):
+        if isinstance(key, (list, tuple)):
+            return self.get_many(key)
+        elif isinstance(key, slice):
+            start, stop, reverse = clean_key_slice(key)
+            if reverse:
+                return self.get_slice_rev(start, stop)
+            else:
+                return self.get_slice(start, stop)
+        else:
+            value = self._get(to_bytes(key))
+            if value is None:
+                raise KeyError(key)
+            return value
+
+    def _get(self, key):
+        # Return the value, as of the snapshot pinned to this thread if
+        # there is one, or `None`.
+        value = self._data.get(key)
+        versions = self._local.versions
+        if versions is not None:
+            return versions.get(key, value)
+        return value
+
+    def __delitem__(self, key):
+        if isinstance(key, (list, tuple)):
+            with self._lock:
+                for k in key:
+                    self._delete(to_bytes(k))
+        elif isinstance(key, slice):
+            self.delete_range(*clean_delete_slice(key))
+        else:
+            with self._lock:
+                self._delete(to_bytes(key))
+
+    def __contains__(self, key):
+        return self._get(to_bytes(key)) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_many(self, keys):
+        """Return a dictionary of the keys that exist and their values."""
+        if self._local.versions is not None:
+            get = self._get
+        else:
+            get = self._data.get
+        accum = {}
+        for key in keys:
+            key = to_bytes(key)
+            value = get(key)
+            if value is not None:
+                accum[key] = value
+        return accum
+
+    def update(self, _data=None, **kwargs):
+        """
+        Update multiple records atomically. Returns the number of records
+        updated.
+        """
+        if _data:
+            if kwargs:
+                _data.update(kwargs)
+        else:
+            _data = kwargs
+        items = [(to_bytes(key), to_bytes(value))
+                 for key, value in _data.items()]
+        with self._lock:
+            for key, value in items:
+                self._set(key, value)
+        return len(items)
+
+    def pop(self, key=None):
+        """
+        Remove the first record, or the record specified by the given key,
+        returning the value.
+        """
+        with self._lock:
+            if key is None:
+                first = self._keys.first()
+                if first is None:
+                    raise KeyError(key)
+                ret = (first, self._data[first])
+                self._delete(first)
+            else:
+                ret = self._data.get(to_bytes(key), _missing)
+                if ret is _missing:
+                    raise KeyError(key)
+                self._delete(to_bytes(key))
+        return ret
+
+    def clear(self):
+        """Remove all records, returning `True` on success."""
+        with self._lock:
+            if self._undo or self._snapshots:
+                for key in list(self._keys):
+                    self._delete(key)
+            else:
+                self._data.clear()
+                self._keys.clear()
+        return True
+
+    def flush(self, hard=True):
+        return True
+
+    def add(self, key, value):
+        """
+        Add the key/value pair to the database. If the key already exists, then
+        no change is made to the existing value.
+
+        Returns boolean indicating whether value was added.
+        """
+        key, value = to_bytes(key), to_bytes(value)
+        with self._lock:
+            if key in self._data:
+                return False
+            self._set(key, value)
+            return True
+
+    def replace(self, key, value):
+        """
+        Replace the value at the given key. If the key does not exist, then
+        no change is made.
+
+        Returns boolean indicating whether value was replaced.
+        """
+        key, value = to_bytes(key), to_bytes(value)
+        with self._lock:
+            if key not in self._data:
+                return False
+            self._set(key, value)
+            return True
+
+    def append(self, key, value):
+        """
+        Append the value to a pre-existing value at the given key. If no
+        value exists, this is equivalent to set.
+        """
+        key, value = to_bytes(key), to_bytes(value)
+        with self._lock:
+            self._set(key, self._data.get(key, '') + value)
+        return True
+
+    def cas(self, key, old, new):
+        """
+        Conditionally set the new value for the given key, but only if the
+        pre-existing value at the key equals `old`. If `old` is `None` the
+        key must not exist, and if `new` is `None` the key is removed.
+
+        Returns boolean indicating if the value was swapped.
+        """
+        key = to_bytes(key)
+        with self._lock:
+            current = self._data.get(key)
+            if current != (old if old is None else to_bytes(old)):
+                return False
+            if new is None:
+                self._delete(key)
+            else:
+                self._set(key, to_bytes(new))
+            return True
+
+    def begin(self, hard=False):
+        """
+        Begin a transaction. Transactions may be nested, and other threads
+        are blocked from writing until the outermost transaction ends.
+
+        Returns boolean indicating success.
+        """
+        self._lock.acquire()
+        self._undo.append({})
+        return True
+
+    def commit(self):
+        """
+        Commit a transaction. Returns boolean indicating success.
+        """
+        if not self._undo:
+            raise DatabaseError('No transaction is in progress.')
+        undo = self._undo.pop()
+        if self._undo:
+            # Roll the changes up into the enclosing transaction.
+            parent = self._undo[-1]
+            for key, value in undo.items():
+                parent.setdefault(key, value)
+        self._lock.release()
+        return True
+
+    def rollback(self):
+        """
+        Rollback a transaction. Returns boolean indicating success.
+        """
+        if not self._undo:
+            raise DatabaseError('No transaction is in progress.')
+        undo = self._undo.pop()
+        saved, self._undo = self._undo, []
+        try:
+            for key, value in undo.items():
+                if value is _missing:
+                    self._delete(key)
+                else:
+                    self._set(key, value)
+        finally:
+            self._undo = saved
+            self._lock.release()
+        return True
+
+    def transaction(self):
+        return transaction(self)
+
+    def snapshot(self):
+        return versioned_snapshot(self)
+
+    def atomic(self, hard=False):
+        """
+        Perform transaction via function `fn`. If the function returns
+        `False` or raises an exception, the changes are rolled back.
+        """
+        def decorator(fn):
+            def inner():
+                self.begin(hard)
+                try:
+                    result = fn()
+                except:
+                    self.rollback()
+                    raise
+                if result is False:
+                    self.rollback()
+                    return False
+                self.commit()
+                return True
+            return inner
+        return decorator
+
+    def delete_range(self, start, stop):
+        """
+        Delete the keys from `start` to `stop`, inclusive, returning the
+        number of keys deleted.
+        """
+        count = 0
+        with self._lock:
+            for key in self._iterate(start, stop):
+                self._delete(key)
+                count += 1
+        return count
+
+    def match_prefix(self, prefix, max_records=-1):
+        accum = []
+        for key in self._iterate(prefix, None):
+            if not key.startswith(prefix) or len(accum) == max_records:
+                break
+            accum.append(key)
+        return accum
+
+    def match_regex(self, regex, max_records=-1):
+        search = re.compile(regex).search
+        accum = []
+        for key in self._iterate(None, None):
+            if len(accum) == max_records:
+                break
+            if search(key):
+                accum.append(key)
+        return accum
+
+    def match(self, query, acceptable_distance=1, utf8=False, max_records=-1):
+        if utf8:
+            query = to_bytes(query).decode('utf-8')
+        accum = []
+        for key in self._iterate(None, None):
+            if len(accum) == max_records:
+                break
+            other = key.decode('utf-8') if utf8 else key
+            distance = _edit_distance(query, other, acceptable_distance)
+            if distance <= acceptable_distance:
+                accum.append(key)
+        return accum
+
+    def incr(self, key, n=1, initial=0):
+        key = to_bytes(key)
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                value = initial + n
+            else:
+                value = struct.unpack('>q', value)[0] + n
+            self._set(key, struct.pack('>q', value))
+        return value
+
+    def decr(self, key, n=1, initial=0):
+        return self.incr(key, n * -1, initial)
+
+    def cursor(self, reverse=False, readahead=READAHEAD, key_only=False):
+        return Cursor(self, reverse, readahead, key_only)
+
+    def process(self, fn):
+        """
+        Process database using a function. The function should accept
+        a key and value, and return a new value or `None` to leave the
+        record unchanged.
+        """
+        with self._lock:
+            for key, value in list(self.iteritems()):
+                result = fn(key, value)
+                if result is not None:
+                    self._set(key, to_bytes(result))
+        return True
+
+    def process_items(self, fn, store_result=False, stream=False):
+        if stream:
+            return (fn(key, value) for key, value in self.iteritems())
+        accum = [] if store_result else None
+        for key, value in self.iteritems():
+            result = fn(key, value)
+            if store_result:
+                accum.append(result)
+        return accum
+
+    def _iterate(self, start, stop, reverse=False):
+        return self._keys.irange(self._lock, start, stop, reverse)
+
+    def _iterate_items(self, start, stop, reverse=False):
+        data = self._data
+        for key in self._iterate(start, stop, reverse):
+            value = data.get(key, _missing)
+            if value is not _missing:
+                yield (key, value)
+
+    def _iterate_versions(self, versions, start, stop, reverse=False):
+        # Keys deleted since the snapshot are only found in its own list.
+        data = self._data
+        for key in union_irange(self._lock, self._keys, versions.keys,
+                                start, stop, reverse):
+            value = versions.get(key, data.get(key))
+            if value is not None:
+                yield (key, value)
+
+    def _slice(self, start, end, reverse):
+        # Values are read as each record is reached, rather than a batch at a
+        # time, so writes made while iterating are always seen. The snapshot
+        # is looked up now, so a slice taken inside one keeps reading it.
+        versions = self._local.versions
+        if versions is not None:
+            return self._iterate_versions(versions, start, end, reverse)
+        return self._iterate_items(start, end, reverse)
+
+    def __iter__(self):
+        return self._iterate(None, None)
+
+    def keys(self):
+        return self._iterate(None, None)
+
+    def itervalues(self):
+        for _, value in self._iterate_items(None, None):
+            yield value
+
+    def values(self, stream=False):
+        if stream:
+            return self.itervalues()
+        return list(self.itervalues())
+
+    def iteritems(self):
+        return self._iterate_items(None, None)
+
+    def items(self, stream=False):
+        if stream:
+            return self.iteritems()
+        return list(self.iteritems())
+
+    def merge(self, databases, mode=MERGE_OVERWRITE):
+        with self._lock:
+            for database in databases:
+                for key, value in database.iteritems():
+                    key, value = to_bytes(key), to_bytes(value)
+                    if key in self._data:
+                        if mode == MERGE_PRESERVE:
+                            continue
+                        elif mode == MERGE_APPEND:
+                            value = self._data[key] + value
+                    elif mode == MERGE_REPLACE:
+                        continue
+                    self._set(key, value)
+        return True
+
+    def __or__(self, rhs):
+        return self.merge(rhs)
+
+    def _get_int(self, key):
+        return struct.unpack('>q', self[key])[0]
+
+    def _set_int(self, key, value):
+        self[key] = struct.pack('>q', value)
+
+    def _get_float(self, key):
+        return struct.unpack('>d', self[key])[0]
+
+    def _set_float(self, key, value):
+        self[key] = struct.pack('>d', value)
+
+
+class Cursor(BaseCursor):
+    def __init__(self, *args, **kwargs):
+        super(Cursor, self).__init__(*args, **kwargs)
+        self._version = None
+        # A cursor opened inside a snapshot reads from it.
+        self._versions = self.db._local.versions
+
+    def _read(self, start, reverse, inclusive, count, stop=None):
+        # Only keys are read ahead. Values are looked up as they are needed.
+        if start is not None:
+            start = to_bytes(start)
+        if stop is not None:
+            stop = to_bytes(stop)
+        if self._versions is not None:
+            return read_versions(self, self._versions, start, reverse,
+                                 inclusive, count, stop)
+        keys = self.db._keys
+        accum = []
+        with self.db._lock:
+            while len(accum) < count:
+                batch = keys.batch(start, stop, reverse, inclusive)
+                if not batch:
+                    break
+                accum.extend(batch[:count - len(accum)])
+                start, inclusive = batch[-1], False
+            self._version = keys.version
+        return [(key, None) for key in accum]
+
+    def _is_stale(self):
+        if self._versions is not None:
+            return False
+        return self._version != self.db._keys.version
+
+    def get(self):
+        if self._versions is not None:
+            # Records read from a snapshot do not change.
+            return self._record
+        # If the current record was removed, move on to the next one.
+        data = self.db._data
+        while self._record is not None:
+            key = self._record[0]
+            value = data.get(key, _missing)
+            if value is not _missing:
+                return (key, None if self.key_only else value)
+            self._move(self.reverse)
@@ -1,21 +1,51 @@
 # Requires pyrocksdb.
 from contextlib import contextmanager
 import struct
+import threading
 
 # See https://pyrocksdb.readthedocs.io/en/latest/tutorial/index.html
 import rocksdb
+from rocksdb.interfaces import AssociativeMergeOperator
 
+from kvkit.backends.helpers import BaseCursor
+from kvkit.backends.helpers import clean_delete_slice
 from kvkit.backends.helpers import clean_key_slice
 from kvkit.backends.helpers import KVHelper
+from kvkit.backends.helpers import READAHEAD
+
+
+_int64 = struct.Struct('>q')
+
+
+class Int64AddOperator(AssociativeMergeOperator):
+    # Adds 8-byte big-endian integers, the format used by `incr()`.
+    def merge(self, key, existing_value, value):
+        if existing_value:
+            value = _int64.pack(
+                _int64.unpack(existing_value)[0] + _int64.unpack(value)[0])
+        return (True, value)
+
+    def name(self):
+        return 'kvkit.Int64AddOperator'
 
 
 class RocksDB(KVHelper):
     def __init__(self, filename, *args, **kwargs):
         self.filename = filename
         kwargs.setdefault('create_if_missing', True)
+        kwargs.setdefault('merge_operator', Int64AddOperator())
         options = rocksdb.Options(**kwargs)
         self.db = rocksdb.DB(filename, options)
         self._closed = False
+        self._local = threading.local()
+
+    def _read_options(self):
+        # Keyword arguments that make a read use the snapshot pinned to this
+        # thread, if any.
+        snapshot = getattr(self._local, 'snapshot', None)
+        if snapshot is None:
+            return {}
+        return {'snapshot': snapshot}
 
     def __getitem__(self, key):
         if isinstance(key, slice):
@@ -25,9 +55,9 @@ class RocksDB(KVHelper):
             else:
                 return self.get_slice(start, stop)
         elif isinstance(key, (list, tuple)):
-            return self.db.multi_get(key)
+            return self.db.multi_get(key, **self._read_options())
         else:
-            res = self.db.get(key)
+            res = self.db.get(key, **self._read_options())
             if res is None:
                 raise KeyError(key)
             return res
@@ -47,65 +77,174 @@ class RocksDB(KVHelper):
         self.db.put(key, value)
 
     def __delitem__(self, key):
-        self.db.delete(key)
+        if isinstance(key, slice):
+            self.delete_range(*clean_delete_slice(key))
+        else:
+            self.db.delete(key)
+
+    def incr(self, key, amount=1):
+        """
+        Add `amount` to the counter at `key` with a merge, which is atomic
+        without reading the old value or taking a lock, even across the
+        processes sharing the database. Returns the counter's value read
+        back after the merge, which may include increments made
+        concurrently. Merges are not atomic with respect to `cas()`.
+        """
+        self.db.merge(key, _int64.pack(amount))
+        return _int64.unpack(self.db.get(key))[0]
+
+    def incr_many(self, deltas):
+        """
+        Add each amount in the `deltas` dictionary to its counter, with a
+        single write batch of merges.
+        """
+        batch = rocksdb.WriteBatch()
+        for key, amount in deltas.iteritems():
+            batch.merge(key, _int64.pack(amount))
+        self.db.write(batch)
+
+    def delete_range(self, start, stop, batch_size=1000):
+        """
+        Delete the keys from `start` to `stop`, inclusive, using a write batch
+        for every `batch_size` keys. Returns the number of keys deleted.
+        """
+        # The Python bindings do not expose `DeleteRange()`, and it would not
+        # report how many keys were removed in any case.
+        count = 0
+        batch = rocksdb.WriteBatch()
+        iterator = self.db.iterkeys()
+        if start is None:
+            iterator.seek_to_first()
+        else:
+            iterator.seek(start)
+        for key in iterator:
+            if stop is not None and key > stop:
+                break
+            batch.delete(key)
+            count += 1
+            if count % batch_size == 0:
+                self.db.write(batch)
+                batch = rocksdb.WriteBatch()
+        self.db.write(batch)
+        return count
+
+    def apply_batch(self, sets, deletes):
+        """
+        Store the records in the `sets` dictionary and remove the keys in
+        `deletes` in a single write batch.
+        """
+        batch = rocksdb.WriteBatch()
+        for key in deletes:
+            batch.delete(key)
+        for key, value in sets.iteritems():
+            batch.put(key, value)
+        self.db.write(batch)
 
     def update(self, _data=None, **kwargs):
         batch = rocksdb.WriteBatch()
         if _data:
-            kwargs.update(_data)
-        for key, value in kwargs.iteritems():
+            if kwargs:
+                _data.update(kwargs)
+        else:
+            _data = kwargs
+        for key, value in _data.iteritems():
             batch.put(key, value)
         self.db.write(batch)
 
     def keys(self):
-        iterator = self.db.iterkeys()
+        iterator = self.db.iterkeys(**self._read_options())
         iterator.seek_to_first()
         for key in iterator:
             yield key
 
     def values(self):
-        iterator = self.db.itervalues()
+        iterator = self.db.itervalues(**self._read_options())
         iterator.seek_to_first()
         for value in iterator:
             yield value
 
     def items(self):
-        iterator = self.db.iteritems()
+        iterator = self.db.iteritems(**self._read_options())
         iterator.seek_to_first()
         for item in iterator:
             yield item
 
-    def get_slice(self, start, end):
-        iterator = self.db.iteritems()
-        if start is None:
-            iterator.seek_to_first()
-        else:
-            iterator.seek(start)
+    @contextmanager
+    def snapshot(self):
+        """
+        Read from a RocksDB snapshot inside the block, so this thread sees
+        the database as it was when the block began.
+        """
+        if getattr(self._local, 'snapshot', None) is not None:
+            yield
+            return
+        self._local.snapshot = self.db.snapshot()
+        try:
+            yield
+        finally:
+            # The snapshot is released when it is garbage collected.
+            self._local.snapshot = None
+
+    def cursor(self, reverse=False, readahead=READAHEAD, key_only=False):
+        return Cursor(self, reverse, readahead, key_only)
+
+    def _reader(self):
+        # RocksDB allows read-only handles alongside the writer. They replay
+        # the write-ahead log, so they see every write made so far.
+        reader = RocksDB.__new__(RocksDB)
+        reader.filename = self.filename
+        reader.db = rocksdb.DB(
+            self.filename,
+            rocksdb.Options(merge_operator=Int64AddOperator()),
+            read_only=True)
+        reader._closed = False
+        reader._local = threading.local()
+        return reader
+
+
+class Cursor(BaseCursor):
+    # A read that carries on from the last record of the previous one, as
+    # the batches of a scan and steps past the readahead do, reads on from
+    # the same iterator instead of creating and seeking a new one.
+    _iterator = None
+    _position = None
 
-        while True:
-            key, value = iterator.next()
-            if key > end:
-                raise StopIteration
-            yield key, value
+    def close(self):
+        super(Cursor, self).close()
+        self._iterator = self._position = None
 
-    def get_slice_rev(self, start, end):
-        iterator = reversed(self.db.iteritems())
-        if start is None:
-            iterator.seek_to_last()
+    def _read(self, start, reverse, inclusive, count, stop=None):
+        if (not inclusive and start is not None and
+                self._position == (start, reverse)):
+            iterator = self._iterator
         else:
-            iterator.seek(start)
-
-        try:
-            key, value = iterator.next()
-        except StopIteration:
-            iterator.seek_to_last()
-            key, value = iterator.next()
-
-        if key <= start or start is None:
-            yield key, value
-
-        while True:
-            key, value = iterator.next()
-            if key < end:
-                raise StopIteration
-            yield key, value
+            options = self.db._read_options()
+            if self.key_only:
+                iterator = self.db.db.iterkeys(**options)
+            else:
+                iterator = self.db.db.iteritems(**options)
+            if reverse:
+                iterator = reversed(iterator)
+                if start is None:
+                    iterator.seek_to_last()
+                else:
+                    iterator.seek_for_prev(start)
+            elif start is None:
+                iterator.seek_to_first()
+            else:
+                iterator.seek(start)
+        self._iterator = self._position = None
+
+        records = []
+        for record in iterator:
+            key = record if self.key_only else record[0]
+            if stop is not None and (key < stop if reverse else key > stop):
+                break
+            elif inclusive or key != start:
+                records.append((key, None) if self.key_only else record)
+                if len(records) == count:
+                    # The iterator now points at the record after `key`.
+                    self._iterator = iterator
+                    self._position = (key, reverse)
+                    break
+        return records
@@ -0,0 +1,471 @@
+# Uses the standard library sqlite3 module.
+import contextlib
+import sqlite3
+import struct
+import threading
+
+from kvkit.exceptions import DatabaseError
+from kvkit.backends.helpers import BaseCursor
+from kvkit.backends.helpers import clean_delete_slice
+from kvkit.backends.helpers import clean_key_slice
+from kvkit.backends.helpers import KVHelper
+from kvkit.backends.helpers import READAHEAD
+from kvkit.backends.helpers import to_bytes
+from kvkit.backends.helpers import transaction
+
+
+# SQLite limits the number of parameters in a single query to 999.
+MAX_PARAMS = 500
+
+
+def _blob(value):
+    # Bind keys and values as BLOBs, so they are compared bytewise. Text
+    # sorts before all blobs and uses the collation, so never mix them.
+    return sqlite3.Binary(to_bytes(value))
+
+
+class SqliteDB(KVHelper):
+    """
+    Key/value store backed by a `WITHOUT ROWID` table in a SQLite database,
+    which stores records in a b-tree clustered on the key.
+
+    Each thread uses its own connection, so readers do not block one another
+    and, in WAL mode, are not blocked by a writer either. Since connections
+    can not share an in-memory database, `filename` should be a file; use
+    `MemoryDB` for an in-memory store.
+    """
+    def __init__(self, filename, table='kv', wal=True, timeout=10.0,
+                 cached_statements=64, pragmas=None):
+        self.filename = filename
+        self.table = table
+        self.wal = wal
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self.pragmas = pragmas or {}
+
+        table = '"%s"' % table.replace('"', '""')
+        self._sql = {
+            'get': 'SELECT value FROM %s WHERE key = ?' % table,
+            'get_many': 'SELECT key, value FROM %s WHERE key IN (%%s)' % table,
+            'set': 'INSERT OR REPLACE INTO %s (key, value) VALUES (?, ?)' % (
+                table),
+            'add': 'INSERT OR IGNORE INTO %s (key, value) VALUES (?, ?)' % (
+                table),
+            'replace': 'UPDATE %s SET value = ? WHERE key = ?' % table,
+            'delete': 'DELETE FROM %s WHERE key = ?' % table,
+            'clear': 'DELETE FROM %s' % table,
+            'count': 'SELECT COUNT(*) FROM %s' % table,
+            'first': 'SELECT key, value FROM %s ORDER BY key LIMIT 1' % table,
+            'keys': 'SELECT key FROM %s ORDER BY key' % table,
+            'values': 'SELECT value FROM %s ORDER BY key' % table,
+            'items': 'SELECT key, value FROM %s ORDER BY key' % table,
+            'prefix': ('SELECT key FROM %s WHERE key >= ? '
+                       'ORDER BY key' % table),
+        }
+        self._table = table
+
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._closed = True
+        self.open()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.filename,
+            timeout=self.timeout,
+            isolation_level=None,  # Transactions are managed explicitly.
+            check_same_thread=False,
+            cached_statements=self.cached_statements)
+        if self.wal:
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Durable across application crashes, may lose the most recent
+            # transactions on power loss.
+            conn.execute('PRAGMA synchronous=NORMAL')
+        for key, value in sorted(self.pragmas.items()):
+            conn.execute('PRAGMA %s=%s' % (key, value))
+        with self._connections_lock:
+            # Connections are kept with their threads, so that those of
+            # threads that have since exited can be closed.
+            live, dead = [], []
+            for thread, old in self._connections:
+                if thread.is_alive():
+                    live.append((thread, old))
+                else:
+                    dead.append(old)
+            live.append((threading.current_thread(), conn))
+            self._connections = live
+        for old in dead:
+            old.close()
+        return conn
+
+    @property
+    def conn(self):
+        """The connection for the current thread."""
+        if self._closed:
+            raise DatabaseError('Database is closed.')
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            self._local.depth = 0
+        return conn
+
+    def open(self):
+        if not self._closed:
+            return False
+        self._closed = False
+        self._local = threading.local()
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS %s ('
+            'key BLOB NOT NULL PRIMARY KEY, '
+            'value BLOB NOT NULL) WITHOUT ROWID' % self._table)
+        return True
+
+    def close(self):
+        if self._closed:
+            return False
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for thread, conn in connections:
+            conn.close()
+        self._closed = True
+        return True
+
+    def _execute(self, sql, params=()):
+        return self.conn.execute(sql, params)
+
+    def __getitem__(self, key):
+        if isinstance(key, (list, tuple)):
+            return self.get_many(key)
+        elif isinstance(key, slice):
+            start, stop, reverse = clean_key_slice(key)
+            if reverse:
+                return self.get_slice_rev(start, stop)
+            else:
+                return self.get_slice(start, stop)
+        else:
+            row = self._execute(self._sql['get'], (_blob(key),)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            return bytes(row[0])
+
+    def __setitem__(self, key, value):
+        self._execute(self._sql['set'], (_blob(key), _blob(value)))
+
+    def __delitem__(self, key):
+        if isinstance(key, (list, tuple)):
+            with self.transaction():
+                self.conn.executemany(
+                    self._sql['delete'], [(_blob(k),) for k in key])
+        elif isinstance(key, slice):
+            self.delete_range(*clean_delete_slice(key))
+        else:
+            self._execute(self._sql['delete'], (_blob(key),))
+
+    def __contains__(self, key):
+        row = self._execute(self._sql['get'], (_blob(key),)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        return self._execute(self._sql['count']).fetchone()[0]
+
+    def get_many(self, keys):
+        """Return a dictionary of the keys that exist and their values."""
+        keys = [_blob(key) for key in keys]
+        accum = {}
+        for i in range(0, len(keys), MAX_PARAMS):
+            chunk = keys[i:i + MAX_PARAMS]
+            sql = self._sql['get_many'] % ', '.join('?' * len(chunk))
+            for key, value in self._execute(sql, chunk):
+                accum[bytes(key)] = bytes(value)
+        return accum
+
+    def update(self, _data=None, **kwargs):
+        """
+        Update multiple records atomically. Returns the number of records
+        updated.
+        """
+        if _data:
+            if kwargs:
+                _data.update(kwargs)
+        else:
+            _data = kwargs
+        params = [(_blob(key), _blob(value))
+                  for key, value in _data.iteritems()]
+        with self.transaction():
+            self.conn.executemany(self._sql['set'], params)
+        return len(params)
+
+    def pop(self, key=None):
+        """
+        Remove the first record, or the record specified by the given key,
+        returning the value.
+        """
+        with self.transaction():
+            if key is None:
+                row = self._execute(self._sql['first']).fetchone()
+                if row is None:
+                    raise KeyError(key)
+                ret = (bytes(row[0]), bytes(row[1]))
+                self._execute(self._sql['delete'], (row[0],))
+            else:
+                ret = self[key]
+                del self[key]
+        return ret
+
+    def clear(self):
+        """Remove all records, returning `True` on success."""
+        self._execute(self._sql['clear'])
+        return True
+
+    def flush(self, hard=True):
+        """Checkpoint the write-ahead log into the database file."""
+        if self.wal:
+            mode = 'TRUNCATE' if hard else 'PASSIVE'
+            self._execute('PRAGMA wal_checkpoint(%s)' % mode)
+        return True
+
+    def add(self, key, value):
+        """
+        Add the key/value pair to the database. If the key already exists, then
+        no change is made to the existing value.
+
+        Returns boolean indicating whether value was added.
+        """
+        curs = self._execute(self._sql['add'], (_blob(key), _blob(value)))
+        return curs.rowcount == 1
+
+    def replace(self, key, value):
+        """
+        Replace the value at the given key. If the key does not exist, then
+        no change is made.
+
+        Returns boolean indicating whether value was replaced.
+        """
+        curs = self._execute(self._sql['replace'], (_blob(value), _blob(key)))
+        return curs.rowcount == 1
+
+    def append(self, key, value):
+        """
+        Append the value to a pre-existing value at the given key. If no
+        value exists, this is equivalent to set.
+        """
+        with self.transaction():
+            try:
+                current = self[key]
+            except KeyError:
+                current = ''
+            self[key] = current + to_bytes(value)
+        return True
+
+    def cas(self, key, old, new):
+        """
+        Conditionally set the new value for the given key, but only if the
+        pre-existing value at the key equals `old`.
+
+        Returns boolean indicating if the value was swapped.
+        """
+        with self.transaction():
+            try:
+                current = self[key]
+            except KeyError:
+                current = None
+            if current != (old if old is None else to_bytes(old)):
+                return False
+            if new is None:
+                del self[key]
+            else:
+                self[key] = new
+        return True
+
+    def incr(self, key, amount=1):
+        with self.transaction():
+            return super(SqliteDB, self).incr(key, amount)
+
+    def begin(self, hard=False):
+        """
+        Begin a transaction. Nested transactions are implemented using
+        savepoints.
+        """
+        conn = self.conn
+        depth = self._local.depth
+        if depth:
+            conn.execute('SAVEPOINT kvkit_%d' % depth)
+        else:
+            # Take the write lock up-front, so that a transaction which reads
+            # then writes can not fail with a busy error part-way through.
+            conn.execute('BEGIN IMMEDIATE')
+        self._local.depth = depth + 1
+        return True
+
+    def _end(self, commit):
+        depth = self._local.depth
+        if not depth:
+            raise DatabaseError('No transaction is in progress.')
+        conn = self.conn
+        self._local.depth = depth = depth - 1
+        if depth:
+            if not commit:
+                conn.execute('ROLLBACK TO kvkit_%d' % depth)
+            conn.execute('RELEASE kvkit_%d' % depth)
+        else:
+            conn.execute('COMMIT' if commit else 'ROLLBACK')
+        return True
+
+    def commit(self):
+        """
+        Commit a transaction. Returns boolean indicating success.
+        """
+        return self._end(True)
+
+    def rollback(self):
+        """
+        Rollback a transaction. Returns boolean indicating success.
+        """
+        return self._end(False)
+
+    def transaction(self):
+        return transaction(self)
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        """
+        Make the reads of this thread inside the block from a single read
+        transaction. In WAL mode, other connections can keep writing, and
+        this thread sees the database as it was when the block began. Writes
+        made inside the block fail with a busy error if another connection
+        has written since then.
+        """
+        conn = self.conn
+        if self._local.depth:
+            # Reads inside a transaction are already consistent.
+            yield
+            return
+        conn.execute('BEGIN')
+        # Transactions begun inside the block use savepoints.
+        self._local.depth = 1
+        try:
+            # The snapshot is taken by the first read, rather than by BEGIN.
+            conn.execute(self._sql['first']).fetchall()
+            yield
+        except:
+            self._local.depth = 0
+            conn.execute('ROLLBACK')
+            raise
+        self._local.depth = 0
+        conn.execute('COMMIT')
+
+    def atomic(self, hard=False):
+        """
+        Perform transaction via function `fn`. If the function returns
+        `False` or raises an exception, the changes are rolled back.
+        """
+        def decorator(fn):
+            def inner():
+                self.begin(hard)
+                try:
+                    result = fn()
+                except:
+                    self.rollback()
+                    raise
+                if result is False:
+                    self.rollback()
+                    return False
+                self.commit()
+                return True
+            return inner
+        return decorator
+
+    def match_prefix(self, prefix, max_records=-1):
+        accum = []
+        for key, in self._execute(self._sql['prefix'], (_blob(prefix),)):
+            key = bytes(key)
+            if not key.startswith(prefix) or len(accum) == max_records:
+                break
+            accum.append(key)
+        return accum
+
+    def _iterate(self, sql, params=()):
+        # Rows are stepped lazily from the sqlite cursor, so large ranges are
+        # not loaded into memory.
+        for row in self._execute(sql, params):
+            yield tuple(bytes(column) for column in row)
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        return (key for key, in self._iterate(self._sql['keys']))
+
+    def itervalues(self):
+        return (value for value, in self._iterate(self._sql['values']))
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        return self._iterate(self._sql['items'])
+
+    def items(self):
+        return list(self.iteritems())
+
+    def _get_int(self, key):
+        return struct.unpack('>q', self[key])[0]
+
+    def _set_int(self, key, value):
+        self[key] = struct.pack('>q', value)
+
+    def _get_float(self, key):
+        return struct.unpack('>d', self[key])[0]
+
+    def _set_float(self, key, value):
+        self[key] = struct.pack('>d', value)
+
+    def _range_where(self, low, high):
+        if low is not None and high is not None:
+            return 'key BETWEEN ? AND ?', (_blob(low), _blob(high))
+        elif low is not None:
+            return 'key >= ?', (_blob(low),)
+        elif high is not None:
+            return 'key <= ?', (_blob(high),)
+        return '1', ()
+
+    def delete_range(self, start, stop):
+        """
+        Delete the keys from `start` to `stop`, inclusive, returning the
+        number of keys deleted.
+        """
+        where, params = self._range_where(start, stop)
+        sql = 'DELETE FROM %s WHERE %s' % (self._table, where)
+        return self._execute(sql, params).rowcount
+
+    def cursor(self, reverse=False, readahead=READAHEAD, key_only=False):
+        return Cursor(self, reverse, readahead, key_only)
+
+    def _reader(self):
+        # Connections can not be used across a fork, so open new ones.
+        pragmas = dict(self.pragmas, query_only=1)
+        return SqliteDB(self.filename, self.table, self.wal, self.timeout,
+                        self.cached_statements, pragmas)
+
+
+class Cursor(BaseCursor):
+    def _read(self, start, reverse, inclusive, count, stop=None):
+        db = self.db
+        where, params = ['1'], []
+        if start is not None:
+            operator = ('<' if reverse else '>') + ('=' if inclusive else '')
+            where.append('key %s ?' % operator)
+            params.append(_blob(start))
+        if stop is not None:
+            where.append('key %s ?' % ('>=' if reverse else '<='))
+            params.append(_blob(stop))
+        sql = 'SELECT %s FROM %s WHERE %s ORDER BY key%s LIMIT %d' % (
+            'key' if self.key_only else 'key, value',
+            db._table,
+            ' AND '.join(where),
+            ' DESC' if reverse else '',
+            count)
+        if self.key_only:
+            return [(key, None) for key, in db._iterate(sql, params)]
+        return list(db._iterate(sql, params))
@@ -1,3 +1,66 @@
 # Requires python-lsm-db
-# No action necessary as `LSM` already implements the appropriate interfaces.
-from lsm import LSM
+# `LSM` already implements the appropriate interfaces, aside from range
+# deletion, which excludes the endpoints, and prefix scans.
+from lsm import LSM as _LSM
+from lsm import SEEK_GE
+
+from kvkit.backends.helpers import clean_delete_slice
+
+
+class LSM(_LSM):
+    def __delitem__(self, key):
+        if isinstance(key, slice):
+            self.delete_range(*clean_delete_slice(key))
+        else:
+            self.delete(key)
+
+    def delete_range(self, start, stop):
+        """
+        Delete the keys from `start` to `stop`, inclusive, returning the
+        number of keys deleted. The keys are counted with a key-only scan,
+        and then removed using the native range deletion.
+        """
+        count = 0
+        first = last = None
+        with self.cursor() as cursor:
+            if start is not None:
+                try:
+                    cursor.seek(start, SEEK_GE)
+                except KeyError:
+                    return 0
+            for key in cursor.keys():
+                if stop is not None and key > stop:
+                    break
+                if first is None:
+                    first = key
+                last = key
+                count += 1
+
+        if count:
+            with self.transaction():
+                # The native range deletion excludes both endpoints.
+                super(LSM, self).delete_range(first, last)
+                self.delete(first)
+                self.delete(last)
+        return count
+
+    def get_prefix(self, prefix, max_records=-1):
+        """
+        Return a list of the records whose key begins with `prefix`, in key
+        order, optionally limited to `max_records`.
+        """
+        accum = []
+        if max_records == 0:
+            return accum
+        with self.cursor() as cursor:
+            try:
+                cursor.seek(prefix, SEEK_GE)
+            except KeyError:
+                return accum
+            for key, value in cursor:
+                if not key.startswith(prefix):
+                    break
+                accum.append((key, value))
+                if len(accum) == max_records:
+                    break
+        return accum
@@ -0,0 +1,322 @@
+import contextlib
+import math
+import os
+import struct
+import threading
+from hashlib import md5
+
+from kvkit.backends.helpers import prefix_slice
+from kvkit.backends.helpers import snapshot
+from kvkit.backends.helpers import to_bytes
+from kvkit.exceptions import DatabaseError
+
+
+_header = struct.Struct('>4sBIQQ')
+_unpack_digest = struct.Struct('>QQ').unpack
+_MAGIC = 'KVBF'
+_VERSION = 1
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter sized to hold `capacity` keys with a false-positive rate
+    of `error_rate`. Bit positions are derived from a single MD5 digest using
+    double hashing.
+    """
+    def __init__(self, capacity=1000000, error_rate=0.01):
+        if not 0 < error_rate < 1:
+            raise ValueError('error_rate must be between 0 and 1.')
+        capacity = max(int(capacity), 1)
+        nbits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        nbytes = int(math.ceil(nbits / 8.))
+        self._setup(
+            nbytes * 8,
+            max(int(round(nbytes * 8. / capacity * math.log(2))), 1),
+            bytearray(nbytes),
+            0)
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+    def _setup(self, nbits, nhashes, bits, count):
+        self.nbits = nbits
+        self.nhashes = nhashes
+        self.bits = bits
+        self.count = count
+
+    def add(self, key):
+        h1, h2 = _unpack_digest(md5(key).digest())
+        bits = self.bits
+        nbits = self.nbits
+        for i in xrange(self.nhashes):
+            pos = (h1 + i * h2) % nbits
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        # Most lookups are for missing keys, so stop at the first clear bit.
+        h1, h2 = _unpack_digest(md5(key).digest())
+        bits = self.bits
+        nbits = self.nbits
+        for i in xrange(self.nhashes):
+            pos = (h1 + i * h2) % nbits
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def memory_usage(self):
+        """Return the size of the bit array in bytes."""
+        return len(self.bits)
+
+    def false_positive_rate(self):
+        """
+        Estimate the current false-positive rate from the number of keys
+        added so far.
+        """
+        k = self.nhashes
+        return (1 - math.exp(-k * float(self.count) / self.nbits)) ** k
+
+    def save(self, filename):
+        """
+        Write the filter to `filename`, replacing it atomically.
+        """
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as fh:
+            fh.write(_header.pack(
+                _MAGIC, _VERSION, self.nhashes, self.nbits, self.count))
+            fh.write(self.bits)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as fh:
+            data = fh.read()
+        if len(data) < _header.size:
+            raise DatabaseError('%s is not a bloom filter.' % filename)
+        magic, version, nhashes, nbits, count = _header.unpack_from(data)
+        if magic != _MAGIC or version != _VERSION or (
+                len(data) - _header.size) * 8 != nbits:
+            raise DatabaseError('%s is not a bloom filter.' % filename)
+        bloom = cls.__new__(cls)
+        bloom._setup(nbits, nhashes, bytearray(data[_header.size:]), count)
+        bloom.capacity = int(nbits * math.log(2) / nhashes)
+        bloom.error_rate = 0.5 ** nhashes
+        return bloom
+
+
+class BloomDatabase(object):
+    """
+    Wraps a database with a Bloom filter of its keys, so that membership
+    tests and lookups for most keys that do not exist are answered without
+    reaching the database.
+
+    Every key written through the wrapper is added to the filter. Deleted
+    keys cannot be removed from it, so they are answered by the database
+    until `rebuild()` is called. Writes made to the underlying database
+    directly are not seen, and would cause false negatives.
+
+    If `filename` is given, the filter is loaded from it, and saved back by
+    `close()`. The file is removed while the database is open, so after a
+    crash the filter is rebuilt with a full scan of the keys.
+    """
+    def __init__(self, db, capacity=1000000, error_rate=0.01, filename=None):
+        self.db = db
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.filename = filename
+        # Number of lookups answered by the filter alone.
+        self.negatives = 0
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self.bloom = None
+        # The filter being built by `rebuild()`, which writes also go to.
+        self._next = None
+        self._open()
+
+    def _open(self):
+        if self.filename and os.path.exists(self.filename):
+            self.bloom = BloomFilter.load(self.filename)
+            os.unlink(self.filename)
+        else:
+            self.rebuild()
+
+    def open(self):
+        ret = self.db.open()
+        if self.bloom is None:
+            self._open()
+        return ret
+
+    def close(self):
+        if self.filename and self.bloom is not None:
+            self.bloom.save(self.filename)
+            self.bloom = None
+        return self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def rebuild(self, capacity=None, error_rate=None, batch_size=1000):
+        """
+        Rebuild the filter from a full scan of the keys, dropping any keys
+        that have since been deleted. The filter is sized for `capacity`
+        keys, or at least twice the current number of keys.
+
+        The keys are streamed from the database, and the old filter answers
+        lookups until the new one replaces it. Keys written in the meantime
+        are added to both filters.
+        """
+        if capacity is not None:
+            self.capacity = capacity
+        if error_rate is not None:
+            self.error_rate = error_rate
+        with self._rebuild_lock:
+            bloom = BloomFilter(
+                max(self.capacity, len(self.db) * 2),
+                self.error_rate)
+            with self._lock:
+                self._next = bloom
+            try:
+                batch = []
+                for key in self.db.keys():
+                    batch.append(key)
+                    if len(batch) >= batch_size:
+                        self._add_to(bloom, batch)
+                        batch = []
+                self._add_to(bloom, batch)
+                with self._lock:
+                    self.bloom = bloom
+            finally:
+                with self._lock:
+                    self._next = None
+
+    def stats(self):
+        """
+        Return a dictionary describing the filter's size, in bits, hash
+        functions and bytes of memory, the number of keys added, its
+        estimated false-positive rate, and the number of lookups it has
+        answered alone.
+        """
+        bloom = self.bloom
+        return {
+            'bits': bloom.nbits,
+            'hashes': bloom.nhashes,
+            'bytes': bloom.memory_usage(),
+            'count': bloom.count,
+            'false_positive_rate': bloom.false_positive_rate(),
+            'negatives': self.negatives}
+
+    def _add_to(self, bloom, keys):
+        with self._lock:
+            for key in keys:
+                bloom.add(key)
+
+    def _add(self, keys):
+        with self._lock:
+            for bloom in (self.bloom, self._next):
+                if bloom is not None:
+                    for key in keys:
+                        bloom.add(key)
+            return self.bloom
+
+    @contextlib.contextmanager
+    def _adding(self, keys):
+        # Keys are added to the filter before they are written, so that a
+        # concurrent reader never misses a key that is in the database. A
+        # rebuild that began meanwhile may have scanned the keys before the
+        # write landed, so they are added again to the filters in use after.
+        keys = [to_bytes(key) for key in keys]
+        bloom = self._add(keys)
+        yield
+        if self._next is not None or self.bloom is not bloom:
+            self._add(keys)
+
+    def _might_contain(self, key):
+        if not isinstance(key, str):
+            key = to_bytes(key)
+        if key in self.bloom:
+            return True
+        self.negatives += 1
+        return False
+
+    def __getitem__(self, key):
+        if isinstance(key, (list, tuple)):
+            return self.get_many(key)
+        elif isinstance(key, slice):
+            return self.db[key]
+        elif not self._might_contain(key):
+            raise KeyError(key)
+        return self.db[key]
+
+    def __contains__(self, key):
+        return self._might_contain(key) and key in self.db
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_many(self, keys):
+        keys = [key for key in keys if self._might_contain(key)]
+        if not keys:
+            return {}
+        return self.db[keys]
+
+    def __setitem__(self, key, value):
+        with self._adding((key,)):
+            self.db[key] = value
+
+    def update(self, _data=None, **kwargs):
+        if _data:
+            if kwargs:
+                _data.update(kwargs)
+        else:
+            _data = kwargs
+        with self._adding(_data):
+            return self.db.update(_data)
+
+    def incr(self, key, amount=1):
+        with self._adding((key,)):
+            return self.db.incr(key, amount)
+
+    def decr(self, key, amount=1):
+        return self.incr(key, amount * -1)
+
+    def __delitem__(self, key):
+        del self.db[key]
+
+    def delete_range(self, start, stop):
+        return self.db.delete_range(start, stop)
+
+    def __len__(self):
+        return len(self.db)
+
+    def __iter__(self):
+        return iter(self.db)
+
+    def keys(self):
+        return self.db.keys()
+
+    def values(self):
+        return self.db.values()
+
+    def items(self):
+        return self.db.items()
+
+    def get_prefix(self, prefix, max_records=-1):
+        get_prefix = getattr(self.db, 'get_prefix', None)
+        if get_prefix is not None:
+            return get_prefix(prefix, max_records)
+        return prefix_slice(self.db, prefix, max_records)
+
+    def transaction(self):
+        return self.db.transaction()
+
+    def snapshot(self):
+        # Keys are never removed from the filter, so it covers every key the
+        # snapshot can see.
+        return snapshot(self.db)
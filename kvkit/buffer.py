@@ -0,0 +1,508 @@
+import bisect
+import contextlib
+import struct
+import threading
+
+from kvkit.backends.helpers import clean_delete_slice
+from kvkit.backends.helpers import clean_key_slice
+from kvkit.backends.helpers import prefix_slice
+from kvkit.backends.helpers import snapshot
+from kvkit.backends.helpers import to_bytes
+from kvkit.backends.helpers import transaction
+
+
+# Marks a buffered delete.
+_deleted = object()
+
+
+def _merge(rows, pending, reverse):
+    # Merge the records of an underlying range with the buffered writes to
+    # the same range, both in iteration order. Buffered writes win.
+    i = 0
+    n = len(pending)
+    for key, value in rows:
+        while i < n and (pending[i][0] > key if reverse else
+                         pending[i][0] < key):
+            if pending[i][1] is not _deleted:
+                yield pending[i]
+            i += 1
+        if i < n and pending[i][0] == key:
+            if pending[i][1] is not _deleted:
+                yield pending[i]
+            i += 1
+        else:
+            yield (key, value)
+    for item in pending[i:]:
+        if item[1] is not _deleted:
+            yield item
+
+
+def apply_batch(db, sets, deletes):
+    """
+    Apply a batch of writes to `db`, using its native batch when it has one.
+    """
+    if hasattr(db, 'apply_batch'):
+        return db.apply_batch(sets, deletes)
+    with db.transaction():
+        for key in deletes:
+            try:
+                del db[key]
+            except KeyError:
+                pass
+        if sets:
+            db.update(sets)
+
+
+def incr_many(db, deltas):
+    """
+    Add each amount in the `deltas` dictionary to its counter in `db`, using
+    its native bulk increment when it has one. Counters are removed from
+    `deltas` once they are written, so if this fails, `deltas` is left
+    holding the increments that were not applied.
+    """
+    if hasattr(db, 'incr_many'):
+        # Native bulk increments are applied all at once or not at all.
+        db.incr_many(deltas)
+        deltas.clear()
+        return
+    # Otherwise each counter is written on its own, since a transaction that
+    # fails part way does not undo the writes on every database.
+    for key in list(deltas):
+        db.incr(key, deltas[key])
+        del deltas[key]
+
+
+class WriteBuffer(object):
+    """
+    Wraps a database, collecting sets and deletes in memory and writing them
+    in a single atomic batch once `max_ops` keys or `max_bytes` bytes are
+    buffered, every `flush_interval` seconds, or when `flush()` is called.
+
+    Reads see the buffered writes, including slices, which merge the buffer
+    with the underlying range. Transactions are buffered as a whole, so their
+    writes are always flushed together, and are discarded on rollback.
+
+    A snapshot copies the buffer and takes a snapshot of the underlying
+    database at the same moment, and reads inside it use the copy. Writes
+    made inside a snapshot are buffered as usual, but are not seen by it.
+    """
+    def __init__(self, db, max_ops=1000, max_bytes=1 << 20,
+                 flush_interval=None):
+        self.db = db
+        self.max_ops = max_ops
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+
+        # Maps each key written to its value, or `_deleted`.
+        self._pending = {}
+        self._sorted = None
+        self._bytes = 0
+        # Whether each buffered key exists in the database, looked up when
+        # the buffer is first counted and kept until it is flushed.
+        self._exists = {}
+        self._lock = threading.RLock()
+        # Copies of the buffer at the start of each open transaction.
+        self._savepoints = []
+        # The copy of the buffer read by the snapshot open in each thread.
+        self._local = threading.local()
+
+        self._stop = threading.Event()
+        self._flusher = None
+        if flush_interval:
+            self._flusher = threading.Thread(target=self._flush_loop)
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """Flush any buffered writes and stop the background flusher."""
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+
+    def __len__(self):
+        # The size of the database, counting the buffered writes that add or
+        # remove a key. Only the keys buffered since the last count are
+        # looked up, except inside a snapshot, which reads its own state.
+        with self._lock:
+            pending = self._buffered()
+            if pending is self._pending:
+                exists = self._exists
+            else:
+                exists = {}
+            for key in pending:
+                if key not in exists:
+                    exists[key] = key in self.db
+            count = len(self.db)
+            for key, value in pending.iteritems():
+                if value is _deleted:
+                    count -= exists[key]
+                else:
+                    count += not exists[key]
+        return count
+
+    @property
+    def pending_count(self):
+        """The number of buffered writes."""
+        return len(self._pending)
+
+    @property
+    def pending_bytes(self):
+        return self._bytes
+
+    def _put(self, key, value):
+        key = to_bytes(key)
+        if value is not _deleted:
+            value = to_bytes(value)
+        old = self._pending.get(key)
+        if old is None:
+            self._sorted = None
+            self._bytes += len(key)
+        elif old is not _deleted:
+            self._bytes -= len(old)
+        if value is not _deleted:
+            self._bytes += len(value)
+        self._pending[key] = value
+
+    def _maybe_flush(self):
+        if not self._savepoints and (
+                len(self._pending) >= self.max_ops or
+                self._bytes >= self.max_bytes):
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered sets and deletes to the database as one batch.
+        Returns the number of writes flushed.
+        """
+        with self._lock:
+            if self._savepoints or not self._pending:
+                return 0
+            sets = {}
+            deletes = []
+            for key, value in self._pending.iteritems():
+                if value is _deleted:
+                    deletes.append(key)
+                else:
+                    sets[key] = value
+            # The buffer is only cleared once the batch has been written, so
+            # nothing is lost if it fails.
+            apply_batch(self.db, sets, deletes)
+            count = len(self._pending)
+            self._pending = {}
+            self._sorted = None
+            self._bytes = 0
+            self._exists = {}
+            return count
+
+    def discard(self):
+        """Throw away any buffered writes."""
+        with self._lock:
+            self._pending = {}
+            self._sorted = None
+            self._bytes = 0
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._put(key, value)
+            self._maybe_flush()
+
+    def __getitem__(self, key):
+        if isinstance(key, (list, tuple)):
+            return self.get_many(key)
+        elif isinstance(key, slice):
+            return self._slice(key)
+        value = self._buffered().get(to_bytes(key))
+        if value is _deleted:
+            raise KeyError(key)
+        elif value is None:
+            return self.db[key]
+        return value
+
+    def __delitem__(self, key):
+        if isinstance(key, (list, tuple)):
+            with self._lock:
+                for k in key:
+                    self._put(k, _deleted)
+                self._maybe_flush()
+        elif isinstance(key, slice):
+            self.delete_range(*clean_delete_slice(key))
+        else:
+            with self._lock:
+                self._put(key, _deleted)
+                self._maybe_flush()
+
+    def __contains__(self, key):
+        value = self._buffered().get(to_bytes(key))
+        if value is None:
+            return key in self.db
+        return value is not _deleted
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_many(self, keys):
+        pending = self._buffered()
+        accum = {}
+        missing = []
+        for key in keys:
+            key = to_bytes(key)
+            value = pending.get(key)
+            if value is None:
+                missing.append(key)
+            elif value is not _deleted:
+                accum[key] = value
+        for key in missing:
+            try:
+                accum[key] = self.db[key]
+            except KeyError:
+                pass
+        return accum
+
+    def update(self, _data=None, **kwargs):
+        if _data:
+            if kwargs:
+                _data.update(kwargs)
+        else:
+            _data = kwargs
+        with self._lock:
+            for key, value in _data.iteritems():
+                self._put(key, value)
+            self._maybe_flush()
+        return len(_data)
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            try:
+                value = struct.unpack('>q', self[key])[0] + amount
+            except KeyError:
+                value = amount
+            self[key] = struct.pack('>q', value)
+        return value
+
+    def decr(self, key, amount=1):
+        return self.incr(key, amount * -1)
+
+    def _buffered(self):
+        # The buffer read by this thread, a copy if it has a snapshot open.
+        pending = getattr(self._local, 'pending', None)
+        return self._pending if pending is None else pending
+
+    def _pending_range(self, low, high, reverse):
+        # Buffered writes between `low` and `high`, inclusive, in iteration
+        # order.
+        buffered = getattr(self._local, 'pending', None)
+        if buffered is not None:
+            if self._local.sorted is None:
+                self._local.sorted = sorted(buffered)
+            keys = self._local.sorted
+        else:
+            buffered = self._pending
+            if self._sorted is None:
+                self._sorted = sorted(buffered)
+            keys = self._sorted
+        lo = 0 if low is None else bisect.bisect_left(keys, low)
+        hi = len(keys) if high is None else bisect.bisect_right(keys, high)
+        pending = [(key, buffered[key]) for key in keys[lo:hi]]
+        if reverse:
+            pending.reverse()
+        return pending
+
+    def _slice(self, key):
+        start, stop, reverse = clean_key_slice(key)
+        low, high = (stop, start) if reverse else (start, stop)
+        with self._lock:
+            pending = self._pending_range(low, high, reverse)
+        return _merge(self.db[key], pending, reverse)
+
+    def __iter__(self):
+        return (key for key, _ in self[:])
+
+    def keys(self):
+        return list(self)
+
+    def itervalues(self):
+        return (value for _, value in self[:])
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        return self[:]
+
+    def items(self):
+        return list(self[:])
+
+    def get_prefix(self, prefix, max_records=-1):
+        return prefix_slice(self, prefix, max_records)
+
+    def delete_range(self, start, stop):
+        """
+        Delete the keys from `start` to `stop`, inclusive, returning the
+        number of keys deleted. The buffer is flushed and the range deleted
+        from the database, unless a transaction is open, in which case a
+        delete is buffered for each key.
+        """
+        with self._lock:
+            if not self._savepoints:
+                self.flush()
+                return self.db.delete_range(start, stop)
+            keys = [key for key, _ in self[start:stop]]
+            for key in keys:
+                self._put(key, _deleted)
+            self._maybe_flush()
+        return len(keys)
+
+    def begin(self):
+        self._lock.acquire()
+        self._savepoints.append((dict(self._pending), self._bytes))
+
+    def commit(self):
+        self._savepoints.pop()
+        try:
+            self._maybe_flush()
+        finally:
+            self._lock.release()
+
+    def rollback(self):
+        self._pending, self._bytes = self._savepoints.pop()
+        self._sorted = None
+        self._lock.release()
+
+    def transaction(self):
+        return transaction(self)
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        if getattr(self._local, 'pending', None) is not None:
+            yield
+            return
+        with self._lock:
+            # Nothing can be flushed between copying the buffer and pinning
+            # the database.
+            pinned = snapshot(self.db)
+            pinned.__enter__()
+            self._local.pending = dict(self._pending)
+            self._local.sorted = None
+        try:
+            yield
+        finally:
+            self._local.pending = self._local.sorted = None
+            pinned.__exit__(None, None, None)
+
+
+class CounterBuffer(object):
+    """
+    Coalesces increments to counters in memory, adding the total of each
+    counter's increments to the database at once, when `max_keys` counters
+    are pending, every `flush_interval` seconds, or when `flush()` is
+    called. Counters are stored as 8-byte big-endian integers, like
+    `incr()`, and hold exact totals once flushed.
+
+    `get()` returns the stored value plus any increments not yet written.
+    Increments are lost if the process exits before they are flushed.
+    """
+    def __init__(self, db, max_keys=1000, flush_interval=None):
+        self.db = db
+        self.max_keys = max_keys
+        self.flush_interval = flush_interval
+
+        # Maps each counter to the sum of its increments since the last flush.
+        self._pending = {}
+        self._lock = threading.Lock()
+        # Held while increments are written, which readers wait for, so that
+        # they are counted exactly once.
+        self._flush_lock = threading.Lock()
+
+        self._stop = threading.Event()
+        self._flusher = None
+        if flush_interval:
+            self._flusher = threading.Thread(target=self._flush_loop)
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """Flush any pending increments and stop the background flusher."""
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+
+    def __len__(self):
+        # Number of counters with pending increments.
+        return len(self._pending)
+
+    def incr(self, key, amount=1):
+        key = to_bytes(key)
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + amount
+            full = len(self._pending) >= self.max_keys
+        if full:
+            self.flush()
+
+    def decr(self, key, amount=1):
+        self.incr(key, amount * -1)
+
+    def get(self, key):
+        """
+        Return the value of a counter, including pending increments, or 0
+        if it does not exist.
+        """
+        key = to_bytes(key)
+        with self._flush_lock:
+            try:
+                value = struct.unpack('>q', self.db[key])[0]
+            except KeyError:
+                value = 0
+            with self._lock:
+                return value + self._pending.get(key, 0)
+
+    def flush(self):
+        """
+        Add the pending increments to the database, returning the number of
+        counters written. Increments made while flushing are kept for the
+        next flush.
+        """
+        with self._flush_lock:
+            with self._lock:
+                deltas = dict(
+                    item for item in self._pending.iteritems() if item[1])
+                self._pending = {}
+            if not deltas:
+                return 0
+            count = len(deltas)
+            try:
+                incr_many(self.db, deltas)
+            except:
+                # Put back the increments that were not written, to be retried
+                # by the next flush.
+                with self._lock:
+                    for key, amount in deltas.iteritems():
+                        self._pending[key] = self._pending.get(key, 0) + amount
+                raise
+            return count
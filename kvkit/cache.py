@@ -0,0 +1,333 @@
+import collections
+import contextlib
+import threading
+
+from kvkit.backends.helpers import clean_delete_slice
+from kvkit.backends.helpers import prefix_slice
+from kvkit.backends.helpers import snapshot
+from kvkit.backends.helpers import to_bytes
+from kvkit.backends.helpers import transaction
+
+
+# Cached result of a lookup for a key that does not exist.
+_missing = object()
+# Returned by `_lookup()` when a key is not in the cache.
+_uncached = object()
+
+
+class CachedDatabase(object):
+    """
+    Wraps a database with a read-through LRU cache of up to `max_bytes` of
+    keys and values. Lookups for keys that do not exist are cached as well.
+
+    Every write made through the wrapper evicts the keys it touches. Keys
+    written inside a transaction bypass the cache until the outermost
+    transaction ends, and are evicted again when it commits or rolls back,
+    so the cache never holds uncommitted or rolled-back values. Writes made
+    to the underlying database directly are not seen.
+
+    Reads made inside a snapshot bypass the cache, which holds the latest
+    values, and go to a snapshot of the underlying database.
+    """
+    def __init__(self, db, max_bytes=32 << 20):
+        self.db = db
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        # Maps keys to values, or `_missing`, least recently used first.
+        self._cache = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        # Incremented on every eviction, so that a value read from the
+        # database is not cached if the key was written in the meantime.
+        self._generation = 0
+        # Keys written in each open transaction, and the depth of open
+        # snapshots, per thread.
+        self._local = threading.local()
+
+    def open(self):
+        return self.db.open()
+
+    def close(self):
+        self.clear_cache()
+        return self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def cache_bytes(self):
+        return self._bytes
+
+    def stats(self):
+        """
+        Return a dictionary of the hit and miss counts, the hit rate, and
+        the number of entries and bytes in the cache.
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / total if total else 0.,
+            'entries': len(self._cache),
+            'bytes': self._bytes}
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+    def _count(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+            self._bytes = 0
+            self._generation += 1
+
+    def _size(self, key, value):
+        return len(key) + (0 if value is _missing else len(value))
+
+    def _lookup(self, key):
+        with self._lock:
+            value = self._cache.pop(key, _uncached)
+            if value is not _uncached:
+                # Re-insert to mark it as the most recently used.
+                self._cache[key] = value
+            return value
+
+    def _store(self, key, value, generation):
+        size = self._size(key, value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self._generation or key in self._cache:
+                return
+            self._cache[key] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                old_key, old_value = self._cache.popitem(last=False)
+                self._bytes -= self._size(old_key, old_value)
+
+    def _evict(self, keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                value = self._cache.pop(key, _uncached)
+                if value is not _uncached:
+                    self._bytes -= self._size(key, value)
+
+    def _evict_range(self, start, stop):
+        with self._lock:
+            self._evict([
+                key for key in self._cache
+                if (start is None or key >= start) and
+                (stop is None or key <= stop)])
+
+    def _touched(self):
+        # Stack of the keys written in each open transaction.
+        if not hasattr(self._local, 'touched'):
+            self._local.touched = []
+        return self._local.touched
+
+    def _written(self, keys):
+        touched = self._touched()
+        if touched:
+            touched[-1].update(keys)
+        self._evict(keys)
+
+    def _bypass(self, key):
+        if getattr(self._local, 'snapshots', 0):
+            return True
+        for keys in self._touched():
+            if key in keys:
+                return True
+        return False
+
+    def __getitem__(self, key):
+        if isinstance(key, (list, tuple)):
+            return self.get_many(key)
+        elif isinstance(key, slice):
+            return self.db[key]
+
+        key = to_bytes(key)
+        if self._bypass(key):
+            return self.db[key]
+
+        value = self._lookup(key)
+        if value is not _uncached:
+            self._count(1, 0)
+            if value is _missing:
+                raise KeyError(key)
+            return value
+
+        self._count(0, 1)
+        generation = self._generation
+        try:
+            value = self.db[key]
+        except KeyError:
+            self._store(key, _missing, generation)
+            raise
+        self._store(key, value, generation)
+        return value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_many(self, keys):
+        # The keys that are not cached are read with a single call to the
+        # underlying database.
+        accum = {}
+        hits = 0
+        missing = []
+        cacheable = set()
+        for key in keys:
+            key = to_bytes(key)
+            if self._bypass(key):
+                missing.append(key)
+                continue
+            value = self._lookup(key)
+            if value is _uncached:
+                missing.append(key)
+                cacheable.add(key)
+                continue
+            hits += 1
+            if value is not _missing:
+                accum[key] = value
+        self._count(hits, len(cacheable))
+        if not missing:
+            return accum
+
+        generation = self._generation
+        found = self.db[missing]
+        accum.update(found)
+        for key in cacheable:
+            self._store(key, found.get(key, _missing), generation)
+        return accum
+
+    def __setitem__(self, key, value):
+        self.db[key] = value
+        self._written([to_bytes(key)])
+
+    def __delitem__(self, key):
+        if isinstance(key, slice):
+            self.delete_range(*clean_delete_slice(key))
+            return
+        elif isinstance(key, (list, tuple)):
+            keys = [to_bytes(k) for k in key]
+        else:
+            keys = [to_bytes(key)]
+        try:
+            del self.db[key]
+        finally:
+            self._written(keys)
+
+    def update(self, _data=None, **kwargs):
+        if _data:
+            if kwargs:
+                _data.update(kwargs)
+        else:
+            _data = kwargs
+        try:
+            return self.db.update(_data)
+        finally:
+            self._written([to_bytes(key) for key in _data])
+
+    def incr(self, key, amount=1):
+        try:
+            return self.db.incr(key, amount)
+        finally:
+            self._written([to_bytes(key)])
+
+    def decr(self, key, amount=1):
+        return self.incr(key, amount * -1)
+
+    def delete_range(self, start, stop):
+        """
+        Delete the keys from `start` to `stop`, inclusive, returning the
+        number of keys deleted.
+        """
+        touched = self._touched()
+        if touched:
+            touched[-1].update(key for key, _ in self.db[start:stop])
+        try:
+            return self.db.delete_range(start, stop)
+        finally:
+            self._evict_range(start, stop)
+
+    def __len__(self):
+        return len(self.db)
+
+    def __iter__(self):
+        return iter(self.db)
+
+    def keys(self):
+        return self.db.keys()
+
+    def values(self):
+        return self.db.values()
+
+    def items(self):
+        return self.db.items()
+
+    def get_prefix(self, prefix, max_records=-1):
+        get_prefix = getattr(self.db, 'get_prefix', None)
+        if get_prefix is not None:
+            return get_prefix(prefix, max_records)
+        return prefix_slice(self.db, prefix, max_records)
+
+    def begin(self):
+        begin = getattr(self.db, 'begin', None)
+        if begin is not None:
+            begin()
+        self._touched().append(set())
+
+    def _end(self, fn_name):
+        fn = getattr(self.db, fn_name, None)
+        touched = self._touched()
+        keys = touched.pop()
+        try:
+            if fn is not None:
+                fn()
+        finally:
+            if touched:
+                # Keep bypassing the cache until the outermost transaction
+                # has ended.
+                touched[-1].update(keys)
+            else:
+                self._evict(keys)
+
+    def commit(self):
+        self._end('commit')
+
+    def rollback(self):
+        self._end('rollback')
+
+    def transaction(self):
+        return transaction(self)
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        depth = getattr(self._local, 'snapshots', 0)
+        self._local.snapshots = depth + 1
+        try:
+            with snapshot(self.db):
+                yield
+        finally:
+            self._local.snapshots = depth
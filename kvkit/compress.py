@@ -0,0 +1,363 @@
+import collections
+import heapq
+import os
+import random
+import struct
+import zlib
+
+from kvkit.backends.helpers import clean_delete_slice
+from kvkit.backends.helpers import key_lock
+from kvkit.backends.helpers import prefix_slice
+from kvkit.backends.helpers import snapshot
+from kvkit.backends.helpers import to_bytes
+from kvkit.exceptions import DatabaseError
+
+
+# Header byte of values stored as-is. Any other header is the version of
+# the dictionary the value was compressed with.
+RAW = '\x00'
+
+_MAGIC = 'KVZD'
+_entry = struct.Struct('>BI')
+
+
+def train_dictionary(samples, size=16384, gram=8, segment=64):
+    """
+    Build a preset dictionary of at most `size` bytes from a list of sample
+    values. The samples are cut into overlapping segments, and segments are
+    chosen greedily by how many samples share the byte sequences in them
+    that no chosen segment already covers. The best segments are placed at
+    the end of the dictionary, where they are cheapest for zlib to refer to.
+    """
+    def grams(chunk):
+        return set(chunk[i:i + gram] for i in xrange(len(chunk) - gram + 1))
+
+    counts = collections.defaultdict(int)
+    for value in samples:
+        for chunk in grams(value):
+            counts[chunk] += 1
+
+    def score(chunk):
+        return sum(counts[g] - 1 for g in grams(chunk))
+
+    heap = []
+    seen = set()
+    for value in samples:
+        for i in xrange(0, max(len(value) - gram, 0) + 1, segment // 2):
+            chunk = value[i:i + segment]
+            if chunk not in seen:
+                seen.add(chunk)
+                heap.append((-score(chunk), chunk))
+    heapq.heapify(heap)
+
+    chosen = []
+    total = 0
+    while heap and total < size:
+        _, chunk = heapq.heappop(heap)
+        # Scores only fall as grams are covered, so a segment is taken once
+        # its current score is still at least as good as the next best.
+        current = score(chunk)
+        if current <= 0:
+            continue
+        elif heap and current < -heap[0][0]:
+            heapq.heappush(heap, (-current, chunk))
+            continue
+        chunk = chunk[:size - total]
+        chosen.append(chunk)
+        total += len(chunk)
+        for g in grams(chunk):
+            counts[g] = 1
+    return ''.join(reversed(chosen))
+
+
+class _Codec(object):
+    # Python 2's zlib cannot set a preset dictionary, so a raw deflate
+    # stream is primed with the dictionary once, and a copy of it is used
+    # for each value. Matches can refer back into the dictionary just as
+    # they would with a preset dictionary. Copying the compressor dominates
+    # the cost of compressing a small value, and a smaller hash table makes
+    # the copy many times cheaper without hurting the ratio.
+    def __init__(self, dictionary, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 5)
+        primed = self.compressor.compress(dictionary)
+        primed += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.decompressor = zlib.decompressobj(-15)
+        self.decompressor.decompress(primed)
+
+    def compress(self, value):
+        compressor = self.compressor.copy()
+        return compressor.compress(value) + compressor.flush()
+
+    def decompress(self, data):
+        decompressor = self.decompressor.copy()
+        return decompressor.decompress(data) + decompressor.flush()
+
+
+class CompressedDatabase(object):
+    """
+    Wraps a database, compressing values with zlib and a preset dictionary
+    trained from a sample of the values by `train()`. Suited to small,
+    repetitive values, such as model rows and Hexastore records, that
+    compress poorly on their own.
+
+    Each value begins with a header byte holding the version of the
+    dictionary it was compressed with, so values written with older
+    dictionaries can still be read after retraining. Values shorter than
+    `min_size` bytes, or that do not get smaller, are stored as-is.
+
+    Dictionaries are kept in the `dictionaries` mapping of version to bytes.
+    If `filename` is given, they are loaded from it, and saved to it each
+    time a new one is trained.
+
+    To wrap a database that already holds values, set `legacy`, so that
+    values without a known header are returned as they are, and convert
+    them with `recompress(headerless=True)`. A value written before the
+    wrapper was used that happens to begin with a header byte can not be
+    told apart from one written by the wrapper, so the conversion should be
+    done before the database is written through the wrapper.
+    """
+    def __init__(self, db, dictionaries=None, level=6, min_size=64,
+                 filename=None, legacy=False):
+        self.db = db
+        self.level = level
+        self.min_size = min_size
+        self.filename = filename
+        self.legacy = legacy
+        self.dictionaries = {}
+        self._codecs = {}
+        self.version = None
+        if filename and os.path.exists(filename):
+            self._load(filename)
+        for version, dictionary in sorted((dictionaries or {}).items()):
+            self.add_dictionary(version, dictionary)
+
+    def open(self):
+        return self.db.open()
+
+    def close(self):
+        return self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _load(self, filename):
+        with open(filename, 'rb') as fh:
+            data = fh.read()
+        if not data.startswith(_MAGIC):
+            raise DatabaseError('%s is not a dictionary file.' % filename)
+        offset = len(_MAGIC)
+        while offset < len(data):
+            version, length = _entry.unpack_from(data, offset)
+            offset += _entry.size
+            self.add_dictionary(version, data[offset:offset + length])
+            offset += length
+
+    def _save(self, filename):
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as fh:
+            fh.write(_MAGIC)
+            for version, dictionary in sorted(self.dictionaries.items()):
+                fh.write(_entry.pack(version, len(dictionary)))
+                fh.write(dictionary)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp, filename)
+
+    def add_dictionary(self, version, dictionary):
+        """
+        Register a dictionary, which is used to compress new values if its
+        version is the highest.
+        """
+        if not 0 < version < 256:
+            raise ValueError('Dictionary versions must be from 1 to 255.')
+        self.dictionaries[version] = dictionary
+        self._codecs[version] = _Codec(dictionary, self.level)
+        self.version = max(self.dictionaries)
+
+    def train(self, samples=None, sample_size=1000, size=16384):
+        """
+        Train a new dictionary of up to `size` bytes from `samples`, or from
+        a random sample of `sample_size` of the stored values, and use it
+        for all new values. Returns the new dictionary's version.
+        """
+        if samples is None:
+            samples = []
+            # Values that can not be decoded are sampled as they are stored.
+            for i, (_, data) in enumerate(self.db[:]):
+                try:
+                    value = self.decode(data)
+                except DatabaseError:
+                    value = data
+                if i < sample_size:
+                    samples.append(value)
+                else:
+                    j = random.randint(0, i)
+                    if j < sample_size:
+                        samples[j] = value
+        version = (self.version or 0) + 1
+        if version > 255:
+            raise DatabaseError('No dictionary versions remain.')
+        self.add_dictionary(version, train_dictionary(samples, size))
+        if self.filename:
+            self._save(self.filename)
+        return version
+
+    def encode(self, value):
+        value = to_bytes(value)
+        if self.version is not None and len(value) >= self.min_size:
+            data = self._codecs[self.version].compress(value)
+            if len(data) < len(value):
+                return chr(self.version) + data
+        return RAW + value
+
+    def decode(self, data):
+        header = data[:1]
+        if header == RAW:
+            return data[1:]
+        codec = self._codecs.get(ord(header)) if header else None
+        if codec is not None:
+            try:
+                return codec.decompress(data[1:])
+            except zlib.error:
+                if not self.legacy:
+                    raise DatabaseError('Value could not be decompressed.')
+        elif not self.legacy:
+            raise DatabaseError('Unknown dictionary version %r.' % header)
+        return data
+
+    def recompress(self, headerless=False, batch_size=1000):
+        """
+        Rewrite every value that is not stored as the current dictionary
+        would store it, `batch_size` values at a time, returning the number
+        rewritten. This converts values written with older dictionaries,
+        and if `headerless` is set, values written without the wrapper, all
+        of which are taken to have no header. Values written by other
+        threads while a batch is being converted may be overwritten.
+        """
+        count = 0
+        last = None
+        while True:
+            batch = {}
+            rows = self.db[last:]
+            try:
+                for key, data in rows:
+                    if key == last:
+                        continue
+                    value = data if headerless else self.decode(data)
+                    encoded = self.encode(value)
+                    if encoded != data:
+                        batch[key] = encoded
+                    last = key
+                    if len(batch) >= batch_size:
+                        break
+                else:
+                    last = None
+            finally:
+                if hasattr(rows, 'close'):
+                    rows.close()
+            if batch:
+                self.db.update(batch)
+                count += len(batch)
+            if last is None:
+                return count
+
+    def _decode_rows(self, rows):
+        decode = self.decode
+        for key, data in rows:
+            yield (key, decode(data))
+
+    def __getitem__(self, key):
+        if isinstance(key, (list, tuple)):
+            return self.get_many(key)
+        elif isinstance(key, slice):
+            return self._decode_rows(self.db[key])
+        return self.decode(self.db[key])
+
+    def __setitem__(self, key, value):
+        self.db[key] = self.encode(value)
+
+    def __delitem__(self, key):
+        if isinstance(key, slice):
+            self.delete_range(*clean_delete_slice(key))
+        else:
+            del self.db[key]
+
+    def __contains__(self, key):
+        return key in self.db
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_many(self, keys):
+        return dict(
+            (key, self.decode(data))
+            for key, data in self.db[list(keys)].iteritems())
+
+    def update(self, _data=None, **kwargs):
+        if _data:
+            if kwargs:
+                _data.update(kwargs)
+        else:
+            _data = kwargs
+        encode = self.encode
+        return self.db.update(collections.OrderedDict(
+            (key, encode(value)) for key, value in _data.iteritems()))
+
+    def incr(self, key, amount=1):
+        # The transaction is begun first, as `incr()` may be called inside
+        # one, and the key lock makes the update atomic on databases whose
+        # transactions do not block other threads.
+        with self.db.transaction():
+            with key_lock(key):
+                try:
+                    value = struct.unpack('>q', self[key])[0] + amount
+                except KeyError:
+                    value = amount
+                self[key] = struct.pack('>q', value)
+        return value
+
+    def decr(self, key, amount=1):
+        return self.incr(key, amount * -1)
+
+    def delete_range(self, start, stop):
+        return self.db.delete_range(start, stop)
+
+    def __len__(self):
+        return len(self.db)
+
+    def __iter__(self):
+        return iter(self.db)
+
+    def keys(self):
+        return self.db.keys()
+
+    def itervalues(self):
+        for _, value in self.iteritems():
+            yield value
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        return self._decode_rows(self.db[:])
+
+    def items(self):
+        return list(self.iteritems())
+
+    def get_prefix(self, prefix, max_records=-1):
+        get_prefix = getattr(self.db, 'get_prefix', None)
+        if get_prefix is not None:
+            return list(self._decode_rows(get_prefix(prefix, max_records)))
+        return prefix_slice(self, prefix, max_records)
+
+    def transaction(self):
+        return self.db.transaction()
+
+    def snapshot(self):
+        return snapshot(self.db)
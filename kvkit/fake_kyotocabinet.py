@@ -0,0 +1,390 @@
+"""
+An in-memory stand-in for the kyotocabinet legacy bindings, which the test
+suite runs the Kyoto databases against when the bindings are not installed.
+Every database behaves like a tree database, with its keys kept in order.
+Handles opened on the same path share their records, and transactions
+serialize with each other but not with plain writes.
+"""
+import bisect
+import re
+import struct
+import threading
+
+
+def _distance(a, b):
+    # Levenshtein distance between `a` and `b`.
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[-1] + 1,
+                           prev[j - 1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+
+class Visitor(object):
+    NOP = object()
+    REMOVE = object()
+
+
+class Error(Exception):
+    pass
+
+
+class _Meta(type):
+    def __getattr__(cls, name):
+        return 0
+
+
+class DB(object):
+    __metaclass__ = _Meta
+    GEXCEPTIONAL = 1
+    GCONCURRENT = 2
+    OREADER = 1
+    OWRITER = 2
+    OCREATE = 4
+    OTRUNCATE = 8
+    OAUTOTRAN = 16
+    OAUTOSYNC = 32
+    ONOLOCK = 64
+    OTRYLOCK = 128
+    ONOREPAIR = 256
+    MSET = 0
+    MADD = 1
+    MREPLACE = 2
+    MAPPEND = 3
+
+    def __init__(self, opts=0):
+        self._data = {}
+        self._keys = []
+        self._tx = None
+        self._lock = threading.RLock()
+        self._txlock = threading.Lock()
+
+    _files = {}
+
+    def open(self, path, mode):
+        # Handles on the same file share its records, as on disk.
+        if path[:1] not in ('-', '+', ':', '*', '%'):
+            if mode & self.OWRITER:
+                DB._files[path] = (self._data, self._keys)
+            else:
+                self._data, self._keys = DB._files[path]
+        return True
+
+    def close(self):
+        return True
+
+    def error(self):
+        return 'error'
+
+    def _set(self, key, value):
+        key, value = str(key), str(value)
+        if key not in self._data:
+            bisect.insort(self._keys, key)
+        self._data[key] = value
+
+    def _del(self, key):
+        if key in self._data:
+            del self._data[key]
+            self._keys.pop(bisect.bisect_left(self._keys, key))
+            return True
+        return False
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+        return True
+
+    def get(self, key):
+        return self._data.get(key)
+
+    def add(self, key, value):
+        with self._lock:
+            if key in self._data:
+                return False
+            self._set(key, value)
+            return True
+
+    def replace(self, key, value):
+        with self._lock:
+            if key not in self._data:
+                return False
+            self._set(key, value)
+            return True
+
+    def append(self, key, value):
+        with self._lock:
+            self._set(key, self._data.get(key, '') + value)
+            return True
+
+    def cas(self, key, old, new):
+        with self._lock:
+            if self._data.get(key) != old:
+                return False
+            if new is None:
+                self._del(key)
+            else:
+                self._set(key, new)
+            return True
+
+    def remove(self, key):
+        with self._lock:
+            return self._del(key)
+
+    def check(self, key):
+        v = self._data.get(key)
+        return -1 if v is None else len(v)
+
+    def count(self):
+        return len(self._data)
+
+    def get_bulk(self, keys, atomic=True):
+        return dict((k, self._data[k]) for k in keys if k in self._data)
+
+    def set_bulk(self, data, atomic=True):
+        with self._lock:
+            for k, v in data.items():
+                self._set(k, v)
+            return len(data)
+
+    def remove_bulk(self, keys, atomic=True):
+        with self._lock:
+            return sum(1 for k in keys if self._del(k))
+
+    def seize(self, key):
+        with self._lock:
+            v = self._data.get(key)
+            self._del(key)
+            return v
+
+    def shift(self):
+        with self._lock:
+            if not self._keys:
+                return None
+            k = self._keys[0]
+            v = self._data[k]
+            self._del(k)
+            return (k, v)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            del self._keys[:]
+            return True
+
+    def increment(self, key, num=0, orig=0):
+        with self._lock:
+            if key in self._data:
+                cur = struct.unpack('>q', self._data[key])[0]
+            else:
+                cur = orig
+            cur += num
+            self._set(key, struct.pack('>q', cur))
+            return cur
+
+    def increment_double(self, key, num=0.0, orig=0.0):
+        raise NotImplementedError
+
+    def match_prefix(self, prefix, max=-1):
+        i = bisect.bisect_left(self._keys, prefix)
+        out = []
+        while i < len(self._keys) and self._keys[i].startswith(prefix):
+            if len(out) == max:
+                break
+            out.append(self._keys[i])
+            i += 1
+        return out
+
+    def match_regex(self, regex, max=-1):
+        r = re.compile(regex)
+        out = [k for k in self._keys if r.search(k)]
+        return out if max < 0 else out[:max]
+
+    def match_similar(self, origin, range=1, utf=False, max=-1):
+        out = [k for k in self._keys if _distance(origin, k) <= range]
+        return out if max < 0 else out[:max]
+
+    def begin_transaction(self, hard=False):
+        self._txlock.acquire()
+        self._tx = dict(self._data)
+        return True
+
+    def end_transaction(self, commit=True):
+        if not commit:
+            self._data = self._tx
+            self._keys = sorted(self._data)
+        self._tx = None
+        self._txlock.release()
+        return True
+
+    def transaction(self, proc, hard=False):
+        self.begin_transaction(hard)
+        try:
+            ok = proc()
+        except:
+            self.end_transaction(False)
+            raise
+        self.end_transaction(bool(ok))
+        return bool(ok)
+
+    def cursor(self):
+        return Cursor(self)
+
+    def cursor_process(self, proc):
+        cur = Cursor(self)
+        try:
+            proc(cur)
+        finally:
+            cur.disable()
+        return True
+
+    def iterate(self, visitor, writable=True):
+        for k in list(self._keys):
+            ret = visitor(k, self._data[k])
+            if ret is Visitor.REMOVE:
+                self._del(k)
+            elif ret is not Visitor.NOP and ret is not None:
+                self._set(k, ret)
+        return True
+
+    def occupy(self, writable=False, proc=None):
+        with self._lock:
+            if proc:
+                proc()
+        return True
+
+    def synchronize(self, hard=False, proc=None):
+        return True
+
+    def copy(self, dest):
+        return True
+
+    def merge(self, srcary, mode=0):
+        with self._lock:
+            for src in srcary:
+                for key in list(src._keys):
+                    value = src._data[key]
+                    if mode == self.MADD and key in self._data:
+                        continue
+                    elif mode == self.MREPLACE and key not in self._data:
+                        continue
+                    elif mode == self.MAPPEND:
+                        value = self._data.get(key, '') + value
+                    self._set(key, value)
+        return True
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+
+class Cursor(object):
+    def __init__(self, db):
+        self.db = db
+        self.key = None
+
+    def _valid(self):
+        return self.key is not None and self.key in self.db._data
+
+    def _index(self):
+        return bisect.bisect_left(self.db._keys, self.key)
+
+    def jump(self, key=None):
+        keys = self.db._keys
+        if key is None:
+            self.key = keys[0] if keys else None
+        else:
+            i = bisect.bisect_left(keys, key)
+            self.key = keys[i] if i < len(keys) else None
+        return self.key is not None
+
+    def jump_back(self, key=None):
+        keys = self.db._keys
+        if key is None:
+            self.key = keys[-1] if keys else None
+        else:
+            i = bisect.bisect_right(keys, key)
+            self.key = keys[i - 1] if i else None
+        return self.key is not None
+
+    def step(self):
+        if self.key is None:
+            return False
+        keys = self.db._keys
+        i = bisect.bisect_right(keys, self.key)
+        self.key = keys[i] if i < len(keys) else None
+        return self.key is not None
+
+    def step_back(self):
+        if self.key is None:
+            return False
+        keys = self.db._keys
+        i = bisect.bisect_left(keys, self.key)
+        self.key = keys[i - 1] if i else None
+        return self.key is not None
+
+    def _settle(self):
+        # A removed record leaves the cursor on the next one.
+        if self.key is not None and self.key not in self.db._data:
+            keys = self.db._keys
+            i = bisect.bisect_left(keys, self.key)
+            self.key = keys[i] if i < len(keys) else None
+
+    def get(self, step=False):
+        self._settle()
+        if self.key is None:
+            return None
+        rec = (self.key, self.db._data[self.key])
+        if step:
+            self.step()
+        return rec
+
+    def get_key(self, step=False):
+        rec = self.get(step)
+        return rec and rec[0]
+
+    def get_value(self, step=False):
+        rec = self.get(step)
+        return rec and rec[1]
+
+    def set_value(self, value, step=False):
+        self._settle()
+        if self.key is None:
+            return False
+        self.db._set(self.key, value)
+        if step:
+            self.step()
+        return True
+
+    def remove(self):
+        self._settle()
+        if self.key is None:
+            return False
+        k = self.key
+        self.step()
+        self.db._del(k)
+        return self.key is not None
+
+    def seize(self):
+        rec = self.get()
+        if rec is not None:
+            self.remove()
+        return rec
+
+    def accept(self, visitor, writable=True, step=False):
+        self._settle()
+        if self.key is None:
+            return False
+        ret = visitor(self.key, self.db._data[self.key])
+        k = self.key
+        if step:
+            self.step()
+        if ret is Visitor.REMOVE:
+            self.db._del(k)
+        elif ret is not Visitor.NOP and ret is not None:
+            self.db._set(k, ret)
+        return True
+
+    def disable(self):
+        self.key = None
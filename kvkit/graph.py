@@ -1,6 +1,140 @@
 # Hexastore.
+import array
+import collections
+import datetime
 import itertools
 import json
+import numbers
+import re
+import struct
+
+from kvkit.backends.helpers import snapshot
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    _string_types = basestring
+    _text_type = unicode
+except NameError:
+    _string_types = str
+    _text_type = ()
+
+
+# Orderings of subject, predicate and object used to index each triple.
+PERMUTATIONS = tuple(''.join(p) for p in itertools.permutations('spo'))
+
+# Minimal set of permutations that still answers every pattern with a prefix
+# scan: spo (s, sp), pos (p, po) and osp (o, os).
+THREE_INDEX = ('spo', 'pos', 'osp')
+
+# Typed literals are stored in keys with an order-preserving encoding, so that
+# ranges of values can be read with a range scan. The encoded value is a tag
+# identifying the type, followed by a fixed-width payload.
+TYPED = '\x00'
+TAG_NUMBER = 'n'
+TAG_DATE = 'd'
+TAG_DATETIME = 't'
+
+
+def _encode_typed(value):
+    """Return `(tag, payload)` for a typed value, or `None`."""
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = (value - value.utcoffset()).replace(tzinfo=None)
+        return TAG_DATETIME, '%04d-%02d-%02dT%02d:%02d:%02d.%06d' % (
+            value.year, value.month, value.day, value.hour, value.minute,
+            value.second, value.microsecond)
+    elif isinstance(value, datetime.date):
+        return TAG_DATE, '%04d-%02d-%02d' % (
+            value.year, value.month, value.day)
+    elif isinstance(value, (numbers.Integral, float)):
+        # Integers and floats share one encoding so that they sort together:
+        # the value as a double, then the exact value of integral numbers
+        # (which orders large integers that round to the same double), then
+        # the original type.
+        if isinstance(value, numbers.Integral):
+            exact, kind = int(value), 'i'
+            if not -(1 << 63) <= exact < (1 << 63):
+                raise ValueError('Integer %s does not fit in 64 bits.' % value)
+        else:
+            exact, kind = 0, 'f'
+            if value.is_integer() and -(1 << 63) <= value < (1 << 63):
+                exact = int(value)
+
+        # Flip the sign bit of positive numbers, and all of the bits of
+        # negative numbers, so that the bytes sort in numeric order. Adding
+        # zero folds -0.0 into 0.0.
+        bits = struct.unpack('>Q', struct.pack('>d', float(value) + 0.))[0]
+        if bits >> 63:
+            bits ^= 0xffffffffffffffff
+        else:
+            bits |= 1 << 63
+        return TAG_NUMBER, '%016x%016x%s' % (bits, exact + (1 << 63), kind)
+
+
+def _decode_typed(tag, payload):
+    if tag == TAG_DATETIME:
+        return datetime.datetime.strptime(payload, '%Y-%m-%dT%H:%M:%S.%f')
+    elif tag == TAG_DATE:
+        return datetime.date(*map(int, payload.split('-')))
+    elif tag == TAG_NUMBER:
+        if payload[32:] == 'i':
+            return int(int(payload[16:32], 16) - (1 << 63))
+        bits = int(payload[:16], 16)
+        if bits >> 63:
+            bits ^= 1 << 63
+        else:
+            bits ^= 0xffffffffffffffff
+        return struct.unpack('>d', struct.pack('>Q', bits))[0]
+    raise ValueError('Unrecognized type: %r' % tag)
+
+
+def _decode_key_part(part):
+    # Inverse of `Hexastore._encode()` for typed literals. Other values are
+    # left as (byte) strings.
+    if part.startswith(TYPED) and len(part) > 1:
+        return _decode_typed(part[1], part[2:])
+    return part
+
+
+class Range(object):
+    """
+    Inclusive range of typed literals, for use as the object of a `search()`
+    condition. Either bound may be `None`.
+    """
+    def __init__(self, lower=None, upper=None):
+        if lower is None and upper is None:
+            raise ValueError('At least one bound is required.')
+        self.lower = lower
+        self.upper = upper
+
+    def __repr__(self):
+        return '<Range: %r - %r>' % (self.lower, self.upper)
+
+    def bounds(self):
+        """Return the encoded lower and upper bounds."""
+        tags = set()
+        payloads = []
+        for value in (self.lower, self.upper):
+            if value is None:
+                payloads.append('')
+                continue
+            tag, payload = _encode_typed(value) or (None, None)
+            if tag == TAG_NUMBER:
+                # Drop the trailing type, so that integers and floats of
+                # equal value are both included.
+                payload = payload[:-1]
+            tags.add(tag)
+            payloads.append(payload)
+
+        if len(tags) != 1 or None in tags:
+            raise ValueError('Range bounds must be numbers, dates or '
+                             'datetimes of the same type.')
+        prefix = TYPED + tags.pop()
+        return prefix + payloads[0], prefix + payloads[1] + '\xff'
 
 
 class _VariableGenerator(object):
@@ -14,18 +148,31 @@ class _VariableGenerator(object):
 class Hexastore(object):
 
     def __init__(self, database, prefix='', serialize=json.dumps,
-                 deserialize=json.loads):
+                 deserialize=json.loads, statistics=False,
+                 permutations=PERMUTATIONS):
         self.database = database
         self.prefix = prefix
         self.serialize = serialize
         self.deserialize = deserialize
+        self.statistics = statistics
         self.v = _VariableGenerator()
 
+        # Always use the canonical order, which determines which permutation
+        # is preferred when several can answer a query.
+        if not permutations or set(permutations) - set(PERMUTATIONS):
+            raise ValueError('permutations must be a subset of: %s.' %
+                             ', '.join(PERMUTATIONS))
+        self.permutations = tuple(
+            perm for perm in PERMUTATIONS if perm in permutations)
+        self._plans = {}
+
     def _data_for_storage(self, s, p, o):
-        serialized = self.serialize({
-            's': s,
-            'p': p,
-            'o': o})
+        data = {'s': s, 'p': p, 'o': o}
+        if isinstance(o, datetime.date):
+            # Dates cannot be serialized as JSON, so store their encoded
+            # value and type.
+            data['t'], data['o'] = _encode_typed(o)
+        serialized = self.serialize(data)
 
         data = {}
         for key in self.keys_for_values(s, p, o):
@@ -34,102 +181,1117 @@ class Hexastore(object):
         return data
 
     def store(self, s, p, o):
-        return self.database.update(self._data_for_storage(s, p, o))
+        if not self.statistics:
+            return self.database.update(self._data_for_storage(s, p, o))
 
-    def store_many(self, items):
-        data = {}
-        for item in items:
-            data.update(self._data_for_storage(*item))
-        return self.database.update(data)
+        with self.database.transaction():
+            exists = self._exists(s, p, o)
+            ret = self.database.update(self._data_for_storage(s, p, o))
+            if not exists:
+                self._update_statistics(((s, p, o),), 1)
+        return ret
+
+    def store_many(self, items, chunk_size=10000):
+        """
+        Store the triples in `items`, `chunk_size` at a time. Returns the sum
+        of what the database's `update()` returned for each chunk, or `None`
+        if it does not return a count.
+        """
+        ret = None
+        iterator = iter(items)
+        while True:
+            chunk = list(itertools.islice(iterator, chunk_size))
+            if not chunk:
+                break
+            count = self._load_chunk(chunk)
+            if count is not None:
+                ret = (ret or 0) + count
+        return ret
+
+    def load(self, source, format=None, chunk_size=10000, progress=None):
+        """
+        Bulk-load triples from an iterable of `(s, p, o)` tuples, or from an
+        N-Triples (`format='ntriples'`) or tab-separated (`format='tsv'`)
+        file. Filenames ending in `.nt` are assumed to be N-Triples.
+
+        Triples are read and written `chunk_size` at a time, so memory use is
+        bounded regardless of the size of the input. Each chunk is written
+        with a single `update()`, which is one write batch on LevelDB and
+        RocksDB, in key order, so that B-tree engines see sequential inserts.
+        If given, `progress` is called with the running total after each
+        chunk is written.
+
+        Returns the number of triples loaded.
+        """
+        if isinstance(source, _string_types):
+            if format is None:
+                format = 'ntriples' if source.endswith('.nt') else 'tsv'
+            with open(source) as fh:
+                return self.load(fh, format, chunk_size, progress)
+
+        if format is not None:
+            source = READERS[format](source)
+
+        total = 0
+        iterator = iter(source)
+        while True:
+            chunk = list(itertools.islice(iterator, chunk_size))
+            if not chunk:
+                break
+            self._load_chunk(chunk)
+            total += len(chunk)
+            if progress is not None:
+                progress(total)
+        return total
+
+    def _load_chunk(self, chunk):
+        with self.database.transaction():
+            if self.statistics:
+                new_items = set(
+                    tuple(item) for item in chunk if not self._exists(*item))
+
+            data = {}
+            for item in chunk:
+                data.update(self._data_for_storage(*item))
+
+            # Keys are grouped by permutation, so sorting them all at once
+            # gives one sequential run of inserts per permutation.
+            ret = self.database.update(
+                collections.OrderedDict(sorted(data.items())))
+
+            if self.statistics:
+                self._update_statistics(new_items, 1)
+        return ret
 
     def delete(self, s, p, o):
-        for key in self.keys_for_values(s, p, o):
-            del self.database[key]
+        if not self.statistics:
+            for key in self.keys_for_values(s, p, o):
+                del self.database[key]
+            return
+
+        with self.database.transaction():
+            if self._exists(s, p, o):
+                for key in self.keys_for_values(s, p, o):
+                    del self.database[key]
+                self._update_statistics(((s, p, o),), -1)
+
+    def delete_where(self, s=None, p=None, o=None, chunk_size=1000):
+        """
+        Delete every triple matching the given values, returning the number
+        of triples deleted.
+
+        Matches are streamed from the best permutation and deleted
+        `chunk_size` at a time, each chunk in its own transaction. If the
+        database implements `delete_range()`, the scanned permutation is
+        cleared with one range deletion per chunk.
+        """
+        start, end, filters = self._plan_query(s, p, o)
+        if end is None:
+            if not self._exists(s, p, o):
+                return 0
+            self.delete(s, p, o)
+            return 1
+
+        delete_range = None
+        if not filters:
+            delete_range = getattr(self.database, 'delete_range', None)
+
+        deleted = 0
+        while True:
+            rows = self.database[start:end]
+            chunk = list(itertools.islice(rows, chunk_size))
+            if hasattr(rows, 'close'):
+                rows.close()
+            if not chunk:
+                break
+
+            triples = []
+            with self.database.transaction():
+                for key, value in chunk:
+                    result = self._load(value)
+                    if filters and not self._matches(result, filters):
+                        continue
+                    triple = (result['s'], result['p'], result['o'])
+                    triples.append(triple)
+                    for triple_key in self.keys_for_values(*triple):
+                        if delete_range is None or triple_key != key:
+                            del self.database[triple_key]
+
+                if delete_range is not None:
+                    delete_range(chunk[0][0], chunk[-1][0])
+                if self.statistics:
+                    self._update_statistics(triples, -1)
+
+            deleted += len(triples)
+            start = chunk[-1][0] + '\x00'
+        return deleted
+
+    def _exists(self, s, p, o):
+        key, _ = self.keys_for_query(s, p, o)
+        try:
+            self.database[key]
+        except KeyError:
+            return False
+        return True
+
+    # Selectivity statistics. Counters are stored alongside the triples as
+    # 8-byte big-endian integers, which is the format used by `incr()`.
+    def _stat_key(self, *parts):
+        return '::'.join(
+            (self.prefix, 'stats') + tuple(map(self._encode, parts)))
+
+    def _stat_keys_for_values(self, s, p, o):
+        return (
+            self._stat_key('*'),
+            self._stat_key('s', s),
+            self._stat_key('p', p),
+            self._stat_key('po', p, o))
+
+    def _update_statistics(self, items, sign):
+        deltas = {}
+        for s, p, o in items:
+            for key in self._stat_keys_for_values(s, p, o):
+                deltas[key] = deltas.get(key, 0) + sign
+
+        for key, delta in sorted(deltas.items()):
+            if delta and self.database.incr(key, delta) <= 0:
+                del self.database[key]
+
+    def _read_counter(self, key):
+        try:
+            return struct.unpack('>q', self.database[key])[0]
+        except KeyError:
+            return 0
+
+    def rebuild_statistics(self):
+        """
+        Discard any stored counters and recompute them from a full scan of
+        the triples. Useful when enabling `statistics` on existing data.
+        """
+        start, end = self._stat_key(''), self._stat_key('\xff')
+        with self.database.transaction():
+            stale = [key for key, _ in self.database[start:end]]
+            for key in stale:
+                del self.database[key]
+
+            counts = {}
+            for triple in self.query():
+                for key in self._stat_keys_for_values(
+                        triple['s'], triple['p'], triple['o']):
+                    counts[key] = counts.get(key, 0) + 1
+
+            self.database.update(dict(
+                (key, struct.pack('>q', value))
+                for key, value in counts.items()))
+
+    def count(self, s=None, p=None, o=None):
+        """
+        Return the number of triples matching the given values. When
+        statistics are enabled, lookups by subject, predicate or
+        predicate/object (and the total) are answered from the counters.
+        """
+        bound = self._bound(s, p, o)
+        if len(bound) == 3:
+            return 1 if self._exists(s, p, o) else 0
+
+        if self.statistics:
+            if not bound:
+                return self._read_counter(self._stat_key('*'))
+            elif bound == frozenset('s'):
+                return self._read_counter(self._stat_key('s', s))
+            elif bound == frozenset('po'):
+                return self._read_counter(self._stat_key('po', p, o))
+            elif bound == frozenset('p'):
+                return self._read_counter(self._stat_key('p', p))
+
+        start, end, filters = self._plan_query(s, p, o)
+        if filters:
+            return sum(1 for _ in self.query(s, p, o))
+        return sum(1 for _ in self.database[start:end])
+
+    def estimate(self, s=None, p=None, o=None):
+        """
+        Estimate the number of triples matching the given values. Unlike
+        `count()`, this never scans the database. The estimate is an upper
+        bound when statistics are enabled, otherwise it is a rough guess
+        based on how many bound values the index prefix can cover.
+        """
+        bound = self._bound(s, p, o)
+        if len(bound) == 3:
+            return 1
+        elif not self.statistics:
+            return 10 ** (3 - len(self._permutation_for(bound)[1]))
+        elif bound == frozenset('sp'):
+            return min(self.count(s=s), self.count(p=p))
+        elif 's' in bound:
+            return self.count(s=s)
+        elif bound:
+            return self.count(p=p, o=o)
+        return self.count()
+
+    def _encode(self, value):
+        # Values read back from the database are deserialized as unicode, so
+        # they must be encoded before being used to build keys.
+        if isinstance(value, _text_type):
+            return value.encode('utf-8')
+        elif value is None or isinstance(value, bytes):
+            return value
+        typed = _encode_typed(value)
+        if typed is None:
+            raise ValueError('Unsupported value: %r' % (value,))
+        return TYPED + ''.join(typed)
+
+    def _node(self, value):
+        # Normalize values used as nodes during traversals, so that values
+        # read from keys and from serialized triples compare equal.
+        if isinstance(value, _text_type):
+            return value.encode('utf-8')
+        return value
+
+    def _load(self, value):
+        result = self.deserialize(value)
+        tag = result.pop('t', None)
+        if tag is not None:
+            result['o'] = _decode_typed(tag, result['o'])
+        return result
+
+    def _bound(self, s, p, o):
+        return frozenset(
+            part for part, value in zip('spo', (s, p, o))
+            if self._encode(value))
 
     def keys_for_values(self, s, p, o):
-        zipped = zip('spo', (s, p, o))
-        for ((p1, v1), (p2, v2), (p3, v3)) in itertools.permutations(zipped):
+        values = dict(zip('spo', map(self._encode, (s, p, o))))
+        for perm in self.permutations:
             yield '::'.join((
                 self.prefix,
-                ''.join((p1, p2, p3)),
-                v1,
-                v2,
-                v3))
+                perm,
+                values[perm[0]],
+                values[perm[1]],
+                values[perm[2]]))
 
-    def keys_for_query(self, s=None, p=None, o=None):
-        parts = [self.prefix]
+    def _permutation_for(self, bound):
+        # Find the permutation whose leading parts cover the most bound
+        # values. Any bound values that are not covered must be filtered.
+        if bound not in self._plans:
+            def covered(perm):
+                return len(list(itertools.takewhile(bound.__contains__, perm)))
+            perm = max(self.permutations, key=covered)
+            self._plans[bound] = (perm, perm[:covered(perm)])
+        return self._plans[bound]
+
+    def _plan_query(self, s=None, p=None, o=None):
+        values = dict(zip('spo', map(self._encode, (s, p, o))))
+        bound = frozenset(part for part in 'spo' if values[part])
         key = lambda parts: '::'.join(parts)
 
-        if s and p and o:
-            parts.extend(('spo', s, p, o))
-            return key(parts), None
-        elif s and p:
-            parts.extend(('spo', s, p))
-        elif s and o:
-            parts.extend(('sop', s, o))
-        elif p and o:
-            parts.extend(('pos', p, o))
-        elif s:
-            parts.extend(('spo', s))
-        elif p:
-            parts.extend(('pso', p))
-        elif o:
-            parts.extend(('osp', o))
-        return key(parts + ['']), key(parts + ['\xff'])
-
-    def query(self, s=None, p=None, o=None):
-        start, end = self.keys_for_query(s, p, o)
-        deserialize = self.deserialize
+        if len(bound) == 3:
+            perm = self.permutations[0]
+            parts = [self.prefix, perm] + [values[part] for part in perm]
+            return key(parts), None, ()
+
+        perm, covered = self._permutation_for(bound)
+        parts = [self.prefix, perm] + [values[part] for part in covered]
+        filters = tuple(
+            (part, values[part]) for part in 'spo'
+            if part in bound and part not in covered)
+        return key(parts + ['']), key(parts + ['\xff']), filters
+
+    def keys_for_query(self, s=None, p=None, o=None):
+        return self._plan_query(s, p, o)[:2]
+
+    def _plan_range(self, s, p, o_range):
+        # Find a permutation that places the object directly after the bound
+        # values, so the range can be read with a single range scan.
+        lower, upper = o_range.bounds()
+        values = dict(zip('sp', map(self._encode, (s, p))))
+        bound = self._bound(s, p, None)
+        for perm in self.permutations:
+            n = len(bound)
+            if frozenset(perm[:n]) == bound and perm[n] == 'o':
+                parts = [self.prefix, perm] + [values[x] for x in perm[:n]]
+                start = '::'.join(parts + [lower])
+                end = '::'.join(parts + [upper, '\xff'])
+                return start, end, ()
+
+        # Otherwise scan the bound values and filter the objects.
+        start, end, filters = self._plan_query(s, p)
+        return start, end, filters + (('o', (lower, upper)),)
+
+    def _matches(self, result, filters):
+        for part, value in filters:
+            encoded = self._encode(result[part])
+            if isinstance(value, tuple):
+                if not value[0] <= encoded <= value[1]:
+                    return False
+            elif encoded != value:
+                return False
+        return True
+
+    def query(self, s=None, p=None, o=None, o_range=None):
+        """
+        Generate the triples matching the given values. Instead of an exact
+        object, `o_range` may be a `(lower, upper)` tuple (or `Range`)
+        of numbers, dates or datetimes. Either bound may be `None`, and both
+        are inclusive.
+        """
+        if isinstance(o, Range):
+            o, o_range = None, o
+        if o_range is not None:
+            if not isinstance(o_range, Range):
+                o_range = Range(*o_range)
+            start, end, filters = self._plan_range(s, p, o_range)
+        else:
+            start, end, filters = self._plan_query(s, p, o)
+
+        deserialize = self._load
         if end is None:
             try:
                 yield deserialize(self.database[start])
             except KeyError:
                 raise StopIteration
+        elif filters:
+            # No permutation covers all of the bound values, so scan the
+            # closest one and filter out the rows that do not match.
+            for key, value in self.database[start:end]:
+                result = deserialize(value)
+                if self._matches(result, filters):
+                    yield result
         else:
             for key, value in self.database[start:end]:
                 yield deserialize(value)
 
+    # Graph traversal.
+    def _expand(self, frontier, predicate, direction, fan_out):
+        if direction == 'out':
+            patterns = (('s', 'o'),)
+        elif direction == 'in':
+            patterns = (('o', 's'),)
+        elif direction == 'both':
+            patterns = (('s', 'o'), ('o', 's'))
+        else:
+            raise ValueError('direction must be one of "out", "in" or "both".')
+
+        # Each level is expanded with one forward pass of a cursor over the
+        # index per pattern. The frontier's ranges are read in key order, and
+        # the cursor only seeks when the next range starts past its position.
+        adjacency = dict((node, []) for node in frontier)
+        for part, target in patterns:
+            plans = []
+            for node in frontier:
+                start, end, filters = self._plan_query(
+                    **{part: node, 'p': predicate})
+                plans.append((start, end, filters, node))
+            plans.sort()
+            # Only the neighbor remains after the scanned prefix.
+            key_only = bool(predicate) and not plans[0][2]
+
+            for (start, end, filters, node), rows in self._read_ranges(
+                    plans, key_only):
+                neighbors = adjacency[node]
+                if fan_out is not None and len(neighbors) >= fan_out:
+                    continue
+                for key, value in rows:
+                    if key_only:
+                        neighbors.append(_decode_key_part(key[len(start):]))
+                    else:
+                        result = self._load(value)
+                        if not filters or self._matches(result, filters):
+                            neighbors.append(self._node(result[target]))
+                    if fan_out is not None and len(neighbors) >= fan_out:
+                        break
+                if hasattr(rows, 'close'):
+                    rows.close()
+        return adjacency
+
+    def _read_ranges(self, ranges, key_only=False):
+        # Generate `(item, rows)` for items beginning with a `(start, end)`
+        # pair, which must be sorted and must not overlap. Each item's rows
+        # are to be read before moving on to the next item.
+        if not hasattr(self.database, 'cursor'):
+            for item in ranges:
+                yield item, self.database[item[0]:item[1]]
+            return
+
+        cursor = self.database.cursor(key_only=key_only)
+        try:
+            positioned = False
+            for item in ranges:
+                record = cursor.get()
+                if not positioned or (
+                        record is not None and record[0] < item[0]):
+                    cursor.seek(item[0])
+                    positioned = True
+                yield item, self._read_range(cursor, item[1])
+        finally:
+            cursor.close()
+
+    def _read_range(self, cursor, end):
+        # The cursor is left on the last record read, or on the first record
+        # past `end`.
+        record = cursor.get()
+        while record is not None and record[0] <= end:
+            yield record
+            cursor.step()
+            record = cursor.get()
+
+    def _traverse(self, start, predicate, direction, max_depth, fan_out):
+        start = self._node(start)
+        visited = set((start,))
+        frontier = [start]
+        depth = 0
+        yield start, depth, None
+
+        while frontier and (max_depth is None or depth < max_depth):
+            depth += 1
+            adjacency = self._expand(frontier, predicate, direction, fan_out)
+            next_frontier = []
+            for node in sorted(adjacency):
+                for neighbor in adjacency[node]:
+                    if neighbor not in visited:
+                        visited.add(neighbor)
+                        next_frontier.append(neighbor)
+                        yield neighbor, depth, node
+            frontier = next_frontier
+
+    def bfs(self, start, predicate=None, direction='out', max_depth=None,
+            fan_out=None):
+        """
+        Generate `(node, depth)` for every node reachable from `start`, in
+        breadth-first order, beginning with `(start, 0)`.
+
+        Edges are followed from subject to object (`direction='out'`), from
+        object to subject (`'in'`) or both ways (`'both'`), optionally only
+        for the given `predicate`. `max_depth` limits the number of hops and
+        `fan_out` the number of edges followed from any one node.
+        """
+        for node, depth, _ in self._traverse(
+                start, predicate, direction, max_depth, fan_out):
+            yield node, depth
+
+    def neighbors(self, node, predicate=None, direction='out', depth=1,
+                  fan_out=None):
+        """Return the set of nodes within `depth` hops of `node`."""
+        return set(
+            neighbor for neighbor, _ in self.bfs(
+                node, predicate, direction, depth, fan_out)
+            if neighbor != self._node(node))
+
+    def shortest_path(self, source, target, predicate=None, direction='out',
+                      max_depth=None, fan_out=None):
+        """
+        Return the list of nodes on a shortest path from `source` to
+        `target`, or `None` if `target` cannot be reached.
+        """
+        target = self._node(target)
+        parents = {}
+        for node, _, parent in self._traverse(
+                source, predicate, direction, max_depth, fan_out):
+            parents[node] = parent
+            if node == target:
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = parents[node]
+                return path[::-1]
+
+    def _edges(self, predicate):
+        start, end, filters = self._plan_query(p=predicate)
+        perm, covered = self._permutation_for(frozenset('p'))
+        reverse = perm[len(covered):] == 'os'
+        offset = len(start)
+
+        for key, value in self.database[start:end]:
+            if not filters:
+                # The subject and object can be read from the key unless one
+                # of them contains the separator.
+                parts = key[offset:].split('::')
+                if len(parts) == 2:
+                    if reverse:
+                        parts.reverse()
+                    yield _decode_key_part(parts[0]), _decode_key_part(parts[1])
+                    continue
+            result = self._load(value)
+            if not filters or self._matches(result, filters):
+                yield self._node(result['s']), self._node(result['o'])
+
+    def to_csr(self, predicate):
+        """
+        Export the edges (from subject to object) with the given predicate as
+        a `CSRGraph`. The edges are read with a single range scan.
+        """
+        return CSRGraph.from_edges(self._edges(predicate))
+
     def v(self, name):
         return Variable(name)
 
+    def range(self, lower=None, upper=None):
+        """
+        Inclusive range of typed literals, which can be used as the object
+        of a `search()` condition.
+        """
+        return Range(lower, upper)
+
+    def path(self, expression, limit=None):
+        """
+        Parse a property path for use as the predicate of a `search()`
+        condition. Supported syntax:
+
+        * `p+`: one or more `p` (transitive closure).
+        * `p*`: zero or more `p`.
+        * `p1/p2`: `p1` followed by `p2`.
+        * `^p`: `p` followed from object to subject.
+        * Parentheses for grouping, e.g. `(parent/sibling)+`.
+
+        `limit` caps the number of nodes any closure may reach from a single
+        start node.
+        """
+        return _PathParser(expression, limit).parse()
+
     def search(self, *conditions):
-        results = {}
+        """
+        Find the values of the variables that satisfy all of the conditions.
+        Conditions are evaluated most-selective first, based on `estimate()`,
+        so the order in which they are given does not matter.
 
+        The predicate of a condition may be a property path (see `path()`).
+        Path steps are memoized for the duration of the search. The object
+        may be a `Range` of typed literals (see `range()`). Every condition
+        is evaluated against the same snapshot of the database.
+        """
+        conditions = [self._parse_condition(c) for c in conditions]
+        names = set()
         for condition in conditions:
-            if isinstance(condition, tuple):
-                query = dict(zip('spo', condition))
+            names.update(name for _, name in condition[1])
+
+        bindings = [{}]
+        memo = {}
+        with snapshot(self.database):
+            for query, targets in self._order_conditions(conditions):
+                bindings = self._join(query, targets, bindings, memo)
+                if not bindings:
+                    break
+
+        results = dict((name, set()) for name in names)
+        for binding in bindings:
+            for name, value in binding.items():
+                results[name].add(value)
+        return results
+
+    def _parse_condition(self, condition):
+        if isinstance(condition, tuple):
+            query = dict(zip('spo', condition))
+        else:
+            query = condition.copy()
+
+        # Split the condition into the bound values and the variables,
+        # which are identified by name.
+        targets = []
+        for part in ('s', 'p', 'o'):
+            if isinstance(query.get(part), Variable):
+                targets.append((part, query.pop(part).name))
+        return query, targets
+
+    def _order_conditions(self, conditions):
+        # Greedily pick the condition with the smallest estimated result,
+        # preferring conditions that share a variable with the conditions
+        # already picked so that we avoid computing cross-products.
+        remaining = [
+            (self._estimate_condition(query), i, (query, targets))
+            for i, (query, targets) in enumerate(conditions)]
+        bound = set()
+        while remaining:
+            connected = [
+                item for item in remaining
+                if bound.intersection(name for _, name in item[2][1])]
+            item = min(connected or remaining)
+            remaining.remove(item)
+            bound.update(name for _, name in item[2][1])
+            yield item[2]
+
+    def _estimate_condition(self, query):
+        if isinstance(query.get('p'), Path):
+            # Estimate a path by its bound endpoints alone.
+            return self.estimate(s=query.get('s'), o=query.get('o'))
+        elif isinstance(query.get('o'), Range):
+            return self.estimate(s=query.get('s'), p=query.get('p'))
+        return self.estimate(**query)
+
+    def _join(self, query, targets, bindings, memo):
+        # Every binding contains the same variables, so the variables that
+        # are already bound can be determined from the first one.
+        bound = [(part, name) for part, name in targets if name in bindings[0]]
+        free = [(part, name) for part, name in targets
+                if name not in bindings[0]]
+
+        accum = []
+        cache = {}
+        for binding in bindings:
+            values = tuple(binding[name] for _, name in bound)
+            if values not in cache:
+                full_query = dict(query)
+                full_query.update(
+                    (part, value) for (part, _), value in zip(bound, values))
+                cache[values] = self._solutions(full_query, free, memo)
+
+            for solution in cache[values]:
+                new_binding = dict(binding)
+                new_binding.update(solution)
+                accum.append(new_binding)
+        return accum
+
+    def _solutions(self, query, free, memo):
+        if isinstance(query.get('p'), Path):
+            results = self._path_query(memo, **query)
+        else:
+            results = self.query(**query)
+
+        solutions = []
+        for result in results:
+            solution = {}
+            for part, name in free:
+                # The same variable may appear more than once in a condition.
+                if solution.setdefault(name, result[part]) != result[part]:
+                    break
             else:
-                query = condition.copy()
-            materialized = {}
-            targets = []
-
-            for part in ('s', 'p', 'o'):
-                if isinstance(query[part], Variable):
-                    variable = query.pop(part)
-                    materialized[part] = set()
-                    targets.append((variable, part))
-
-            # Potentially rather than popping all the variables, we could use
-            # the result values from a previous condition and do O(results)
-            # loops looking for a single variable.
-            for result in self.query(**query):
-                ok = True
-                for var, part in targets:
-                    if var in results and result[part] not in results[var]:
-                        ok = False
-                        break
+                solutions.append(solution)
+        return solutions
+
+    def _path_query(self, memo, s=None, p=None, o=None):
+        s, o = self._node(s), self._node(o)
+        if s is not None:
+            pairs = [(s, node) for node in p.step(self, [s], memo)[s]
+                     if o is None or node == o]
+        elif o is not None:
+            steps = p.inverse().step(self, [o], memo)
+            pairs = [(node, o) for node in steps[o]]
+        else:
+            sources = p.sources(self)
+            steps = p.step(self, sources, memo)
+            pairs = [(source, node) for source in sources
+                     for node in steps[source]]
+
+        for subject, obj in pairs:
+            yield {'s': _decode(subject), 'p': p, 'o': _decode(obj)}
+
+
+_NT_TERM = r'(<[^>]*>|_:\S+|"(?:[^"\\]|\\.)*"(?:@[\w-]+|\^\^<[^>]*>)?)'
+_NT_LINE = re.compile(r'^\s*%s\s+%s\s+%s\s*\.\s*$' % ((_NT_TERM,) * 3))
+_NT_ESCAPE = re.compile(r'\\(u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|.)')
+_NT_ESCAPES = {
+    't': u'\t', 'b': u'\b', 'n': u'\n', 'r': u'\r', 'f': u'\f',
+    '"': u'"', "'": u"'", '\\': u'\\'}
+
+
+def _nt_unescape(match):
+    escape = match.group(1)
+    if escape[0] in 'uU':
+        return struct.pack('>I', int(escape[1:], 16)).decode('utf-32-be')
+    return _NT_ESCAPES.get(escape, escape)
+
+
+def _nt_value(term):
+    if term.startswith('<'):
+        return term[1:-1]
+    elif term.startswith('_:'):
+        return term
+    # Literal, discarding any language tag or datatype.
+    body = term[1:term.rindex('"')].decode('utf-8')
+    return _NT_ESCAPE.sub(_nt_unescape, body).encode('utf-8')
+
+
+def read_ntriples(lines):
+    """
+    Generate `(s, p, o)` tuples from N-Triples. IRIs are returned without the
+    enclosing angle brackets and literals as their (unescaped) string value.
+    """
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        match = _NT_LINE.match(line)
+        if match is None:
+            raise ValueError('Invalid N-Triples on line %s: %r' % (
+                lineno, line))
+        yield tuple(_nt_value(term) for term in match.groups())
+
+
+def read_tsv(lines):
+    """Generate `(s, p, o)` tuples from tab-separated lines."""
+    for lineno, line in enumerate(lines, 1):
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        triple = tuple(line.split('\t'))
+        if len(triple) != 3:
+            raise ValueError('Expected 3 columns on line %s: %r' % (
+                lineno, line))
+        yield triple
+
+
+READERS = {
+    'ntriples': read_ntriples,
+    'tsv': read_tsv,
+}
+
+
+def _decode(value):
+    # Nodes found by path evaluation are read from the keys. Decode them so
+    # they compare equal to values read from the serialized triples.
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+class Path(object):
+    """
+    Base class for property paths. A path maps each start node to the set of
+    nodes that can be reached by following it.
+
+    Subclasses implement `step(graph, nodes, memo)`, which returns a dict
+    mapping each of `nodes` to its reachable set, `sources(graph)`, which
+    returns the nodes that the path could start from, and `inverse()`.
+    """
+
+
+class Link(Path):
+    def __init__(self, predicate, inverted=False):
+        self.predicate = predicate
+        self.inverted = inverted
+
+    def __repr__(self):
+        return '<Link: %s%s>' % ('^' if self.inverted else '', self.predicate)
+
+    def step(self, graph, nodes, memo):
+        key = (self.predicate, self.inverted)
+        seen = memo.setdefault(key, {})
+        missing = [node for node in set(nodes) if node not in seen]
+        if missing:
+            direction = 'in' if self.inverted else 'out'
+            adjacency = graph._expand(missing, self.predicate, direction, None)
+            for node, neighbors in adjacency.items():
+                seen[node] = frozenset(neighbors)
+        return dict((node, seen[node]) for node in nodes)
+
+    def sources(self, graph):
+        part = 'o' if self.inverted else 's'
+        return sorted(set(
+            graph._node(result[part])
+            for result in graph.query(p=self.predicate)))
+
+    def inverse(self):
+        return Link(self.predicate, not self.inverted)
+
+
+class Sequence(Path):
+    def __init__(self, *paths):
+        self.paths = paths
+
+    def __repr__(self):
+        return '<Sequence: %s>' % ' / '.join(map(repr, self.paths))
+
+    def step(self, graph, nodes, memo):
+        reached = dict((node, frozenset((node,))) for node in nodes)
+        for path in self.paths:
+            frontier = set()
+            for targets in reached.values():
+                frontier.update(targets)
+            steps = path.step(graph, frontier, memo)
+            reached = dict(
+                (node, frozenset().union(*[steps[t] for t in targets]))
+                for node, targets in reached.items())
+        return reached
+
+    def sources(self, graph):
+        return self.paths[0].sources(graph)
+
+    def inverse(self):
+        return Sequence(*[path.inverse() for path in reversed(self.paths)])
+
+
+class OneOrMore(Path):
+    reflexive = False
+
+    def __init__(self, path, limit=None):
+        self.path = path
+        self.limit = limit
+
+    def __repr__(self):
+        return '<%s: %r>' % (type(self).__name__, self.path)
+
+    def step(self, graph, nodes, memo):
+        # Semi-naive evaluation: each round only follows the path from nodes
+        # discovered in the previous round, for all start nodes at once.
+        # Nodes are never revisited, so cycles terminate.
+        nodes = set(nodes)
+        first = self.path.step(graph, nodes, memo)
+        reached = {}
+        for node in nodes:
+            found = first[node]
+            if self.limit is not None:
+                found = sorted(found)[:self.limit]
+            reached[node] = set(found)
+        delta = dict((node, set(reached[node])) for node in nodes)
+        while any(delta.values()):
+            frontier = set()
+            for node, new in delta.items():
+                frontier.update(new)
+            steps = self.path.step(graph, frontier, memo)
+            for node, new in delta.items():
+                found = set()
+                for target in new:
+                    found.update(steps[target])
+                found -= reached[node]
+                if self.limit is not None:
+                    room = self.limit - len(reached[node])
+                    found = set(sorted(found)[:max(room, 0)])
+                reached[node] |= found
+                delta[node] = found
+
+        if self.reflexive:
+            for node in nodes:
+                reached[node].add(node)
+        return dict((node, frozenset(reached[node])) for node in nodes)
+
+    def sources(self, graph):
+        return self.path.sources(graph)
+
+    def inverse(self):
+        return type(self)(self.path.inverse(), self.limit)
+
+
+class ZeroOrMore(OneOrMore):
+    reflexive = True
+
+
+class _PathParser(object):
+    _token_re = re.compile(r'\s*([\^/+*()]|[^\s\^/+*()]+)')
+
+    def __init__(self, expression, limit=None):
+        self.expression = expression
+        self.limit = limit
+        self.tokens = []
+        position = 0
+        expression = expression.rstrip()
+        while position < len(expression):
+            match = self._token_re.match(expression, position)
+            self.tokens.append(match.group(1))
+            position = match.end()
+        self.position = 0
+
+    def error(self, message):
+        return ValueError('Invalid path "%s": %s.' % (self.expression, message))
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+
+    def advance(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        path = self.parse_sequence()
+        if self.peek() is not None:
+            raise self.error('unexpected "%s"' % self.peek())
+        return path
+
+    def parse_sequence(self):
+        paths = [self.parse_element()]
+        while self.peek() == '/':
+            self.advance()
+            paths.append(self.parse_element())
+        return paths[0] if len(paths) == 1 else Sequence(*paths)
+
+    def parse_element(self):
+        inverted = self.peek() == '^'
+        if inverted:
+            self.advance()
+
+        token = self.advance()
+        if token == '(':
+            path = self.parse_sequence()
+            if self.advance() != ')':
+                raise self.error('expected ")"')
+        elif token is None or token in '^/+*)':
+            raise self.error('expected a predicate')
+        else:
+            path = Link(token)
+
+        if self.peek() == '+':
+            self.advance()
+            path = OneOrMore(path, self.limit)
+        elif self.peek() == '*':
+            self.advance()
+            path = ZeroOrMore(path, self.limit)
+        return path.inverse() if inverted else path
+
+
+class CSRGraph(object):
+    """
+    Compressed sparse row adjacency structure. Node `i` is `nodes[i]` and its
+    successors are the node ids `targets[offsets[i]:offsets[i + 1]]`.
+
+    The arrays are NumPy arrays if NumPy is installed, otherwise they are
+    `array.array` instances and the algorithms fall back to pure Python.
+    Algorithms return one value per node, ordered by node id.
+    """
+    def __init__(self, nodes, offsets, targets):
+        self.nodes = nodes
+        self.offsets = offsets
+        self.targets = targets
+        self.index = dict((node, i) for i, node in enumerate(nodes))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @classmethod
+    def from_edges(cls, edges):
+        index = {}
+        nodes = []
+        sources = array.array('l')
+        targets = array.array('l')
+        for source, target in edges:
+            i = index.get(source)
+            if i is None:
+                i = index[source] = len(nodes)
+                nodes.append(source)
+            j = index.get(target)
+            if j is None:
+                j = index[target] = len(nodes)
+                nodes.append(target)
+            sources.append(i)
+            targets.append(j)
+
+        # Group the edges by source id with a stable counting sort.
+        n = len(nodes)
+        if numpy is not None:
+            sources = numpy.array(sources, dtype=numpy.int64)
+            targets = numpy.array(targets, dtype=numpy.int64)
+            offsets = numpy.zeros(n + 1, dtype=numpy.int64)
+            numpy.cumsum(numpy.bincount(sources, minlength=n),
+                         out=offsets[1:])
+            targets = targets[numpy.argsort(sources, kind='mergesort')]
+        else:
+            offsets = array.array('l', [0] * (n + 1))
+            for i in sources:
+                offsets[i + 1] += 1
+            for i in range(n):
+                offsets[i + 1] += offsets[i]
+            position = offsets[:-1]
+            grouped = array.array('l', [0] * len(targets))
+            for i, j in zip(sources, targets):
+                grouped[position[i]] = j
+                position[i] += 1
+            targets = grouped
+        return cls(nodes, offsets, targets)
+
+    def successors(self, node):
+        i = self.index[node]
+        return [self.nodes[j]
+                for j in self.targets[self.offsets[i]:self.offsets[i + 1]]]
+
+    def out_degree(self):
+        if numpy is not None:
+            return numpy.diff(self.offsets)
+        offsets = self.offsets
+        return [offsets[i + 1] - offsets[i] for i in range(len(self))]
+
+    def in_degree(self):
+        if numpy is not None:
+            return numpy.bincount(self.targets, minlength=len(self))
+        degree = [0] * len(self)
+        for j in self.targets:
+            degree[j] += 1
+        return degree
+
+    def pagerank(self, damping=0.85, iterations=100, tolerance=1e-6):
+        """
+        Compute PageRank by power iteration. The rank of nodes without
+        successors is distributed evenly over all nodes.
+        """
+        n = len(self)
+        if not n:
+            return []
+        if numpy is None:
+            return self._pagerank_python(damping, iterations, tolerance)
+
+        out_degree = self.out_degree()
+        dangling = out_degree == 0
+        sources = numpy.repeat(numpy.arange(n), out_degree)
+        rank = numpy.full(n, 1. / n)
+        for _ in range(iterations):
+            share = rank / numpy.maximum(out_degree, 1)
+            new_rank = numpy.bincount(
+                self.targets,
+                weights=share[sources],
+                minlength=n)
+            new_rank = ((1. - damping) / n +
+                        damping * (new_rank + rank[dangling].sum() / n))
+            delta = numpy.abs(new_rank - rank).sum()
+            rank = new_rank
+            if delta < tolerance:
+                break
+        return rank
+
+    def _pagerank_python(self, damping, iterations, tolerance):
+        n = len(self)
+        offsets, targets = self.offsets, self.targets
+        rank = [1. / n] * n
+        for _ in range(iterations):
+            new_rank = [0.] * n
+            dangling = 0.
+            for i in range(n):
+                start, end = offsets[i], offsets[i + 1]
+                if start == end:
+                    dangling += rank[i]
+                    continue
+                share = rank[i] / (end - start)
+                for j in targets[start:end]:
+                    new_rank[j] += share
+            base = (1. - damping) / n + damping * dangling / n
+            new_rank = [base + damping * value for value in new_rank]
+            delta = sum(abs(a - b) for a, b in zip(new_rank, rank))
+            rank = new_rank
+            if delta < tolerance:
+                break
+        return rank
+
+    def connected_components(self):
+        """
+        Label the weakly-connected components. Each node is labelled with
+        the smallest node id in its component.
+        """
+        n = len(self)
+        if numpy is not None:
+            # Propagate the minimum label across edges in both directions,
+            # with pointer-jumping to shortcut long chains.
+            sources = numpy.repeat(numpy.arange(n), self.out_degree())
+            labels = numpy.arange(n)
+            while True:
+                previous = labels.copy()
+                numpy.minimum.at(labels, self.targets, labels[sources])
+                numpy.minimum.at(labels, sources, labels[self.targets])
+                labels = labels[labels]
+                if (labels == previous).all():
+                    return labels
 
-                if ok:
-                    for var, part in targets:
-                        materialized[part].add(result[part])
+        parents = list(range(n))
 
-            for var, part in targets:
-                if var in results:
-                    results[var] &= materialized[part]
-                else:
-                    results[var] = materialized[part]
+        def find(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
 
-        return dict((var.name, vals) for (var, vals) in results.items())
+        offsets = self.offsets
+        for i in range(n):
+            for j in self.targets[offsets[i]:offsets[i + 1]]:
+                a, b = find(i), find(j)
+                if a != b:
+                    parents[max(a, b)] = min(a, b)
+        return [find(i) for i in range(n)]
 
 
 class Variable(object):
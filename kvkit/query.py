@@ -2,6 +2,8 @@ import datetime
 import pickle
 import struct
 
+from kvkit.backends.helpers import snapshot
+
 
 class Node(object):
     # Node in a query tree.
@@ -308,20 +310,30 @@ class Model(with_metaclass(DeclarativeMeta)):
             index.store_endpoint()
 
     @classmethod
-    def _read_model_data(cls, primary_key, fields=None):
+    def _model_data_keys(cls, primary_key, fields=None):
         key = cls._meta.get_instance_key(primary_key)
         if cls._meta.serialize:
-            # For serialized models, simply grab all data.
-            data = pickle.loads(cls._meta.database[key])
-        else:
-            # Load the model data from each field.
-            data = {}
-            fields = fields or cls._meta.sorted_fields
-            for field in fields:
-                field_key = '%s:%s' % (key, field.name)
-                data[field.name] = field.python_value(
-                    cls._meta.database[field_key])
-        return data
+            # For serialized models, all data is in a single record.
+            return [key]
+        # Otherwise there is a record for each field.
+        fields = fields or cls._meta.sorted_fields
+        return ['%s:%s' % (key, field.name) for field in fields]
+
+    @classmethod
+    def _decode_model_data(cls, values, fields=None):
+        # Convert the values of the records named by `_model_data_keys()`.
+        if cls._meta.serialize:
+            return pickle.loads(values[0])
+        fields = fields or cls._meta.sorted_fields
+        return dict((field.name, field.python_value(value))
+                    for field, value in zip(fields, values))
+
+    @classmethod
+    def _read_model_data(cls, primary_key, fields=None):
+        database = cls._meta.database
+        values = [database[key]
+                  for key in cls._model_data_keys(primary_key, fields)]
+        return cls._decode_model_data(values, fields)
 
     @classmethod
     def _read_indexed_data(cls, primary_key):
@@ -359,6 +371,14 @@ class Model(with_metaclass(DeclarativeMeta)):
 
     @classmethod
     def query(cls, expr):
+        # The indexes and the records are read from one snapshot, so writes
+        # made by other threads meanwhile can not tear the results.
+        with snapshot(cls._meta.database):
+            return [cls.load(primary_key)
+                    for primary_key in sorted(cls._query_ids(expr))]
+
+    @classmethod
+    def _query_ids(cls, expr):
         def dfs(expr):
             lhs = expr.lhs
             rhs = expr.rhs
@@ -377,8 +397,7 @@ class Model(with_metaclass(DeclarativeMeta)):
             else:
                 raise ValueError('Unable to execute query, unexpected type.')
 
-        id_list = dfs(expr)
-        return [cls.load(primary_key) for primary_key in sorted(id_list)]
+        return dfs(expr)
 
 
 class Index(object):
@@ -413,11 +432,31 @@ class Index(object):
     def store_endpoint(self):
         self.database[self.stop_key] = ''
 
+    def clear(self):
+        """
+        Remove every entry from the index with a single range deletion,
+        returning the number of entries removed. Databases without
+        `delete_range()`, such as ForestDB and Sophia, delete the keys of
+        the range one at a time.
+        """
+        start, stop = self.get_prefix(), self.stop_key
+        has_endpoint = stop in self.database
+        if hasattr(self.database, 'delete_range'):
+            count = self.database.delete_range(start, stop)
+        else:
+            keys = [key for key, _ in self.database[start:stop]]
+            for key in keys:
+                del self.database[key]
+            count = len(keys)
+        if has_endpoint:
+            self.store_endpoint()
+            count -= 1
+        return count
+
     def query(self, value, operation):
         if operation == '=':
             start_key = self.get_prefix(value, closed=True)
-            end_key = start_key + '\xff'
-            return [value for key, value in self.database[start_key:end_key]]
+            return self._scan_prefix(start_key, start_key + '\xff')
         elif operation in ('<', '<='):
             start_key = self.get_prefix()
             end_key = self.get_prefix(value) + '\xff'
@@ -440,5 +479,11 @@ class Index(object):
             return [v for k, v in results if not k.startswith(match)][:-1]
         elif operation == 'startswith':
             start_key = self.get_prefix(value)
-            end_key = start_key + '\xff\xff'
-            return [value for key, value in self.database[start_key:end_key]]
+            return self._scan_prefix(start_key, start_key + '\xff\xff')
+
+    def _scan_prefix(self, prefix, end_key):
+        # Use the database's prefix scan where there is one.
+        get_prefix = getattr(self.database, 'get_prefix', None)
+        if get_prefix is not None:
+            return [value for key, value in get_prefix(prefix)]
+        return [value for key, value in self.database[prefix:end_key]]
@@ -0,0 +1,402 @@
+import collections
+import contextlib
+import heapq
+import sys
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from kvkit.exceptions import DatabaseError
+from kvkit.backends.helpers import clean_delete_slice
+from kvkit.backends.helpers import clean_key_slice
+from kvkit.backends.helpers import prefix_upper_bound
+from kvkit.backends.helpers import snapshot
+from kvkit.backends.helpers import to_bytes
+
+
+class _Descending(object):
+    # Inverts the ordering of a record, so the heap yields the largest key.
+    __slots__ = ('record',)
+
+    def __init__(self, record):
+        self.record = record
+
+    def __lt__(self, other):
+        return other.record < self.record
+
+
+def merge_ranges(ranges, reverse=False):
+    """
+    Merge iterables of `(key, value)` records, each already in key order
+    (descending if `reverse`), into a single ordered stream.
+    """
+    heap = []
+    for i, rows in enumerate(ranges):
+        rows = iter(rows)
+        for record in rows:
+            heap.append((_Descending(record) if reverse else record, i, rows))
+            break
+    heapq.heapify(heap)
+    while heap:
+        item, i, rows = heap[0]
+        yield item.record if reverse else item
+        for record in rows:
+            heapq.heapreplace(
+                heap, (_Descending(record) if reverse else record, i, rows))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+@contextlib.contextmanager
+def _nested(managers):
+    # Enter each context manager in turn, exiting them in reverse order.
+    if not managers:
+        yield
+    else:
+        with managers[0]:
+            with _nested(managers[1:]):
+                yield
+
+
+class _ShardLocks(object):
+    """
+    A lock for each shard, held by a transaction from when it first writes
+    the shard until it ends. Transactions lock the shards of each write in
+    index order, but one that goes on to write a lower shard than it holds
+    can deadlock with another, so a wait that would complete a cycle raises
+    a `DatabaseError` instead.
+    """
+    def __init__(self, count):
+        self._condition = threading.Condition(threading.Lock())
+        self._owners = [None] * count
+        # The shard each blocked thread is waiting for.
+        self._waiting = {}
+
+    def acquire(self, i):
+        me = threading.current_thread()
+        with self._condition:
+            while self._owners[i] is not None:
+                owner = self._owners[i]
+                while owner is not None and owner is not me:
+                    j = self._waiting.get(owner)
+                    owner = None if j is None else self._owners[j]
+                if owner is me:
+                    raise DatabaseError('Deadlock writing shard %s.' % i)
+                self._waiting[me] = i
+                try:
+                    self._condition.wait()
+                finally:
+                    del self._waiting[me]
+            self._owners[i] = me
+
+    def release(self, indexes):
+        with self._condition:
+            for i in indexes:
+                self._owners[i] = None
+            self._condition.notify_all()
+
+
+def crc32_router(key, shards):
+    return (zlib.crc32(key) & 0xffffffff) % shards
+
+
+class ShardedDatabase(object):
+    """
+    Spreads keys across several databases, routed by `router(key, shards)`,
+    which defaults to a CRC-32 of the key. Point operations go to a single
+    shard, bulk operations are grouped by shard and run on a pool of
+    `workers` threads, and slices merge the matching range of every shard,
+    so models and Hexastores work unchanged.
+
+    Transactions lock a shard and begin a transaction on it when it is
+    first written, so transactions writing different shards run at the same
+    time. Each shard commits separately, so the old value of each key
+    written to the second and later shards is kept, and if a commit fails
+    the shards already committed are restored. Snapshots are taken of each
+    shard in turn, so they are consistent within a shard but are not a
+    single point in time across shards.
+    """
+    def __init__(self, databases, router=None, workers=None):
+        if not databases:
+            raise ValueError('At least one database is required.')
+        self.databases = list(databases)
+        self.router = router or crc32_router
+        if workers is None:
+            workers = len(self.databases)
+        self.workers = workers
+        self._pool = None
+        self._local = threading.local()
+        self._locks = _ShardLocks(len(self.databases))
+
+    def open(self):
+        return all([db.open() for db in self.databases])
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        return all([db.close() for db in self.databases])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def shard_for(self, key):
+        return self.databases[
+            self.router(to_bytes(key), len(self.databases))]
+
+    def _map(self, fn, items):
+        # Run `fn` over `items`, in parallel if there is more than one. The
+        # transactions and snapshots of this thread are not visible to, and
+        # transactions may block, other threads, so work inside them is done
+        # in this thread.
+        if len(items) < 2 or self.workers < 2 or getattr(
+                self._local, 'depth', 0):
+            return map(fn, items)
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        return self._pool.map(fn, items)
+
+    def _writing(self, groups, start=None, stop=None):
+        # Begin a transaction on each of the shards about to be written that
+        # does not have one yet, at every level of nesting. `groups` maps the
+        # index of each shard to the keys to be written, or to `None` when
+        # the keys from `start` to `stop` are deleted.
+        stack = getattr(self._local, 'transactions', None)
+        if not stack:
+            return
+        for i in sorted(groups):
+            if i not in stack[0]:
+                self._locks.acquire(i)
+                self._local.locked.append(i)
+            for managers in stack:
+                if i not in managers:
+                    manager = self.databases[i].transaction()
+                    manager.__enter__()
+                    managers[i] = manager
+            self._save(i, groups[i], start, stop)
+
+    def _save(self, i, keys, start, stop):
+        # Keep the values the keys of the shard had before the transaction,
+        # to restore them if the shard commits but a later one fails. The
+        # first shard written commits last, so it needs none.
+        if i == self._local.locked[0]:
+            return
+        saved = self._local.saved.setdefault(i, {})
+        db = self.databases[i]
+        if keys is None:
+            for key, value in db[start:stop]:
+                saved.setdefault(key, value)
+            return
+        keys = [key for key in keys if key not in saved]
+        if keys:
+            values = db[keys]
+            for key in keys:
+                saved[key] = values.get(key)
+
+    def _index(self, key):
+        return self.router(to_bytes(key), len(self.databases))
+
+    def _group(self, keys, write=True):
+        groups = {}
+        nshards = len(self.databases)
+        for key in keys:
+            key = to_bytes(key)
+            groups.setdefault(self.router(key, nshards), []).append(key)
+        if write:
+            self._writing(groups)
+        return [(self.databases[i], group)
+                for i, group in sorted(groups.items())]
+
+    def __getitem__(self, key):
+        if isinstance(key, (list, tuple)):
+            return self.get_many(key)
+        elif isinstance(key, slice):
+            reverse = clean_key_slice(key)[2]
+            return merge_ranges([db[key] for db in self.databases], reverse)
+        return self.shard_for(key)[key]
+
+    def __setitem__(self, key, value):
+        i = self._index(key)
+        self._writing({i: [key]})
+        self.databases[i][key] = value
+
+    def __delitem__(self, key):
+        if isinstance(key, (list, tuple)):
+            def delete(group):
+                db, keys = group
+                del db[keys]
+            self._map(delete, self._group(key))
+        elif isinstance(key, slice):
+            self.delete_range(*clean_delete_slice(key))
+        else:
+            i = self._index(key)
+            self._writing({i: [key]})
+            del self.databases[i][key]
+
+    def __contains__(self, key):
+        return key in self.shard_for(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_many(self, keys):
+        accum = {}
+        for result in self._map(lambda group: group[0][group[1]],
+                                self._group(keys, False)):
+            accum.update(result)
+        return accum
+
+    def update(self, _data=None, **kwargs):
+        if _data:
+            if kwargs:
+                _data.update(kwargs)
+        else:
+            _data = kwargs
+        # Each shard is given its records in the order of `_data`.
+        groups = [(db, collections.OrderedDict(
+                       (key, _data[key]) for key in group))
+                  for db, group in self._group(_data)]
+        self._map(lambda group: group[0].update(group[1]), groups)
+        return len(_data)
+
+    def incr(self, key, amount=1):
+        i = self._index(key)
+        self._writing({i: [key]})
+        return self.databases[i].incr(key, amount)
+
+    def decr(self, key, amount=1):
+        return self.incr(key, amount * -1)
+
+    def delete_range(self, start, stop):
+        """
+        Delete the keys from `start` to `stop`, inclusive, from every shard,
+        returning the number of keys deleted.
+        """
+        self._writing(dict.fromkeys(range(len(self.databases))), start, stop)
+        return sum(self._map(lambda db: db.delete_range(start, stop),
+                             self.databases))
+
+    def __len__(self):
+        return sum(self._map(len, self.databases))
+
+    def __iter__(self):
+        return (key for key, _ in self[:])
+
+    def keys(self):
+        return list(self)
+
+    def itervalues(self):
+        return (value for _, value in self[:])
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        return self[:]
+
+    def items(self):
+        return list(self[:])
+
+    def get_prefix(self, prefix, max_records=-1):
+        accum = []
+        if max_records == 0:
+            return accum
+        ranges = []
+        for db in self.databases:
+            get_prefix = getattr(db, 'get_prefix', None)
+            if get_prefix is not None:
+                ranges.append(get_prefix(prefix, max_records))
+            else:
+                ranges.append(db[prefix:prefix_upper_bound(prefix)])
+        for key, value in merge_ranges(ranges):
+            if not key.startswith(prefix):
+                break
+            accum.append((key, value))
+            if len(accum) == max_records:
+                break
+        return accum
+
+    @contextlib.contextmanager
+    def transaction(self):
+        stack = getattr(self._local, 'transactions', None)
+        if stack is None:
+            stack = self._local.transactions = []
+        if not stack:
+            # The shards locked by the outermost transaction, in the order
+            # they were first written, and the values saved from them.
+            self._local.locked = []
+            self._local.saved = {}
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+        # The shard transactions begun at this level, by shard.
+        managers = collections.OrderedDict()
+        stack.append(managers)
+        exc_info = (None, None, None)
+        try:
+            yield
+        except:
+            exc_info = sys.exc_info()
+            raise
+        finally:
+            stack.pop()
+            try:
+                if stack:
+                    error = self._exit(reversed(managers.values()), exc_info)
+                else:
+                    error = self._commit(managers, exc_info)
+            finally:
+                self._local.depth -= 1
+                if not stack:
+                    self._locks.release(self._local.locked)
+            if error is not None and exc_info[0] is None:
+                raise error
+
+    def _exit(self, managers, exc_info):
+        error = None
+        for manager in managers:
+            try:
+                manager.__exit__(*exc_info)
+            except Exception as exc:
+                error = error or exc
+        return error
+
+    def _commit(self, managers, exc_info):
+        # The first shard written commits last. If a commit fails, the shards
+        # not yet committed are rolled back and those committed restored.
+        order = self._local.locked[1:] + self._local.locked[:1]
+        for n, i in enumerate(order):
+            try:
+                managers[i].__exit__(*exc_info)
+            except Exception as exc:
+                if exc_info[0] is not None:
+                    continue
+                failed = (type(exc), exc, sys.exc_info()[2])
+                self._exit([managers[j] for j in order[n + 1:]], failed)
+                for j in order[:n]:
+                    self._restore(j)
+                return exc
+
+    def _restore(self, i):
+        sets, deletes = {}, []
+        for key, value in self._local.saved.get(i, {}).items():
+            if value is None:
+                deletes.append(key)
+            else:
+                sets[key] = value
+        self.databases[i].apply_batch(sets, deletes)
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+        try:
+            with _nested([snapshot(db) for db in self.databases]):
+                yield
+        finally:
+            self._local.depth -= 1
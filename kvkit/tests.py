@@ -1,16 +1,54 @@
+import collections
+import contextlib
 import datetime
 import gc
+import operator
 import os
 import shutil
 import struct
 import sys
 import tempfile
+import threading
+import time
 import unittest
 
-from kvkit.backends.kyoto import *
-from kvkit.backends.kyoto import _FilenameDatabase
+from kvkit.backends.bitcask import BitcaskDB
+from kvkit.backends.memory import MemoryDB
+from kvkit.backends.memory import SortedKeys
+from kvkit.backends.sqlite import SqliteDB
+from kvkit.bloom import BloomDatabase
+from kvkit.bloom import BloomFilter
+from kvkit.buffer import CounterBuffer
+from kvkit.buffer import incr_many
+from kvkit.buffer import WriteBuffer
+from kvkit.cache import CachedDatabase
+from kvkit.compress import CompressedDatabase
+from kvkit.exceptions import DatabaseError
 from kvkit.graph import *
 from kvkit.query import *
+from kvkit.shard import ShardedDatabase
+
+try:
+    from kvkit.aio import asyncio
+    from kvkit.aio import AsyncDatabase
+    from kvkit.aio import AsyncModel
+    from kvkit.aio import StopAsyncIteration
+except ImportError:
+    AsyncDatabase = None
+
+try:
+    import kyotocabinet
+except ImportError:
+    # Run the Kyoto tests against an in-memory stand-in for the bindings.
+    from kvkit import fake_kyotocabinet
+    sys.modules['kyotocabinet'] = fake_kyotocabinet
+
+try:
+    from kvkit.backends.kyoto import *
+    from kvkit.backends.kyoto import _FilenameDatabase
+except ImportError:
+    TreeDB = None
+    _FilenameDatabase = ()
 
 try:
     from kvkit.backends.berkeleydb import BerkeleyDB
@@ -235,6 +273,29 @@ class KVKitTests(object):
         self.assertEqual(sorted(self.db.iteritems()), [
             ('k1', 'v1'), ('k2', 'v2'), ('k3', 'v3')])
 
+    def test_streaming(self):
+        self.db.update(k1='v1', k2='v2', k3='v3')
+        items = self.db.items(stream=True)
+        self.assertFalse(isinstance(items, list))
+        self.assertEqual(sorted(items), [
+            ('k1', 'v1'), ('k2', 'v2'), ('k3', 'v3')])
+        self.assertEqual(sorted(self.db.values(stream=True)),
+                         ['v1', 'v2', 'v3'])
+
+        results = self.db.process_items(
+            lambda k, v: k + v, store_result=True, stream=True)
+        self.assertIn(next(results), ('k1v1', 'k2v2', 'k3v3'))
+        self.assertEqual(len(list(results)), 2)
+
+        # Abandoning a stream part-way through releases its cursor.
+        for value in self.db.values(stream=True):
+            break
+        self.db['k4'] = 'v4'
+        self.assertEqual(len(self.db.items()), 4)
+
+        self.db.clear()
+        self.assertEqual(list(self.db.items(stream=True)), [])
+
 
 class SliceTests(object):
     def assertSlice(self, s, expected):
@@ -316,6 +377,275 @@ class SliceTests(object):
         self.assertSlice(s, ['ff', 'ee', 'dd', 'cc'])
 
 
+    def test_delete_range(self):
+        self.create_slice_data()
+
+        self.assertEqual(self.db.delete_range('aa0', 'bb'), 3)
+        self.assertSlice(self.db[:'zz'], ['aa', 'cc', 'dd', 'ee', 'ff'])
+
+        # Reverse slices delete the same range.
+        del self.db['dd':'cc']
+        self.assertSlice(self.db[:'zz'], ['aa', 'ee', 'ff'])
+
+        self.assertEqual(self.db.delete_range('b', 'c'), 0)
+        self.assertEqual(self.db.delete_range('ef', None), 1)
+        del self.db[:'aa']
+        self.assertSlice(self.db[:'zz'], ['ee'])
+        self.assertEqual(self.db.delete_range(None, None), 1)
+        self.assertSlice(self.db[:'zz'], [])
+
+    def test_get_prefix(self):
+        self.create_slice_data()
+        self.db['aa\xff'] = 'aa\xff'
+        self.db['ab'] = 'ab'
+
+        self.assertSlice(self.db.get_prefix('aa'),
+                         ['aa', 'aa1', 'aa2', 'aa\xff'])
+        self.assertSlice(self.db.get_prefix('aa', 2), ['aa', 'aa1'])
+        self.assertSlice(self.db.get_prefix('aa\xff'), ['aa\xff'])
+        self.assertSlice(self.db.get_prefix('ff'), ['ff'])
+        self.assertSlice(self.db.get_prefix('a0'), [])
+        self.assertSlice(self.db.get_prefix('zz'), [])
+
+
+class CursorTests(object):
+    def create_cursor_data(self):
+        for key in ('aa', 'bb', 'cc', 'dd', 'ee'):
+            self.db[key] = key.upper()
+
+    def test_cursor_seek(self):
+        self.create_cursor_data()
+        for readahead in (1, 2, 64):
+            cursor = self.db.cursor(readahead=readahead)
+            self.assertTrue(cursor.seek('bb'))
+            self.assertEqual(cursor.key(), 'bb')
+            self.assertEqual(cursor.value(), 'BB')
+
+            self.assertTrue(cursor.seek('bc'))
+            self.assertEqual(cursor.get(), ('cc', 'CC'))
+            self.assertTrue(cursor.seek_for_prev('bc'))
+            self.assertEqual(cursor.get(), ('bb', 'BB'))
+            self.assertTrue(cursor.seek_for_prev('cc'))
+            self.assertEqual(cursor.key(), 'cc')
+            self.assertTrue(cursor.seek_for_prev('zz'))
+            self.assertEqual(cursor.key(), 'ee')
+
+            self.assertFalse(cursor.seek('zz'))
+            self.assertEqual(cursor.get(), None)
+            self.assertFalse(cursor.is_valid())
+            self.assertFalse(cursor.seek_for_prev('a'))
+            self.assertTrue(cursor.seek(None))
+            self.assertEqual(cursor.key(), 'aa')
+            cursor.close()
+
+    def test_cursor_step(self):
+        self.create_cursor_data()
+        for readahead in (1, 2, 64):
+            cursor = self.db.cursor(readahead=readahead)
+            self.assertTrue(cursor.first())
+            keys = [cursor.key()]
+            while cursor.step():
+                keys.append(cursor.key())
+            self.assertEqual(keys, ['aa', 'bb', 'cc', 'dd', 'ee'])
+
+            # Change direction part way through.
+            self.assertTrue(cursor.seek('cc'))
+            self.assertTrue(cursor.step())
+            self.assertEqual(cursor.key(), 'dd')
+            self.assertTrue(cursor.step_back())
+            self.assertTrue(cursor.step_back())
+            self.assertEqual(cursor.key(), 'bb')
+            self.assertTrue(cursor.step_back())
+            self.assertFalse(cursor.step_back())
+            self.assertFalse(cursor.step())
+
+            self.assertTrue(cursor.last())
+            self.assertEqual(cursor.get(), ('ee', 'EE'))
+            self.assertTrue(cursor.step_back())
+            self.assertEqual(cursor.key(), 'dd')
+            self.assertTrue(cursor.step())
+            self.assertFalse(cursor.step())
+
+            # next() and prev() return the current record, then move.
+            self.assertTrue(cursor.seek('cc'))
+            self.assertEqual(cursor.next(), ('cc', 'CC'))
+            self.assertEqual(cursor.prev(), ('dd', 'DD'))
+            self.assertEqual(cursor.prev(), ('cc', 'CC'))
+            self.assertEqual(cursor.key(), 'bb')
+            cursor.close()
+
+    def test_cursor_iteration(self):
+        self.create_cursor_data()
+        with self.db.cursor(reverse=True, readahead=2) as cursor:
+            self.assertEqual(list(cursor), [
+                ('ee', 'EE'),
+                ('dd', 'DD'),
+                ('cc', 'CC'),
+                ('bb', 'BB'),
+                ('aa', 'AA')])
+
+            cursor.seek_for_prev('dd')
+            self.assertEqual(list(cursor.fetch_until('bb')), [
+                ('dd', 'DD'), ('cc', 'CC'), ('bb', 'BB')])
+
+        with self.db.cursor(key_only=True, readahead=3) as cursor:
+            self.assertEqual(list(cursor), ['aa', 'bb', 'cc', 'dd', 'ee'])
+
+            cursor.seek('b')
+            self.assertEqual(list(cursor.fetch_count(2)), ['bb', 'cc'])
+            self.assertEqual(cursor.key(), 'dd')
+            self.assertTrue(cursor.step_back())
+            self.assertEqual(list(cursor.fetch_until('dd')), ['cc', 'dd'])
+
+        cursor = self.db.cursor(readahead=2)
+        cursor.seek('cc')
+        self.assertEqual(cursor.next(), ('cc', 'CC'))
+        self.assertEqual(cursor.next(), ('dd', 'DD'))
+        self.assertEqual(cursor.next(), ('ee', 'EE'))
+        self.assertRaises(StopIteration, cursor.next)
+        cursor.close()
+
+    def test_map_reduce(self):
+        self.db.update(dict(('k%03d' % i, str(i)) for i in range(200)))
+        splits = self.db.split_range(4)
+        self.assertEqual(len(splits), 3)
+        self.assertEqual(splits, sorted(splits))
+        self.assertEqual(self.db.split_range(4, 'k050', 'k052'), ['k051'])
+
+        # Most keys are after a gap, and only a sample of them is read.
+        self.db.update(dict(('z%05d' % i, str(i)) for i in range(1800)))
+        split, = self.db.split_range(2, sample_size=160)
+        self.assertTrue('z00700' < split < 'z01100')
+        self.db.delete_range('z', None)
+
+        def mapper(key, value):
+            if int(value) % 2 == 0:
+                return int(value)
+
+        for workers in (1, 3):
+            self.assertEqual(self.db.map_reduce(
+                mapper, operator.add, workers=workers), 9900)
+            self.assertEqual(self.db.map_reduce(
+                lambda k, v: [k], operator.add, 'k010', 'k014',
+                workers=workers), ['k010', 'k011', 'k012', 'k013', 'k014'])
+            self.assertEqual(self.db.map_reduce(
+                mapper, operator.add, 'x', workers=workers, default=0), 0)
+
+
+class AtomicTests(object):
+    def get_or_none(self, key):
+        try:
+            return self.db[key]
+        except KeyError:
+            return None
+
+    def test_cas(self):
+        self.assertTrue(self.db.cas('k1', None, 'v1'))
+        self.assertFalse(self.db.cas('k1', None, 'v2'))
+        self.assertFalse(self.db.cas('k1', 'vx', 'v2'))
+        self.assertTrue(self.db.cas('k1', 'v1', 'v2'))
+        self.assertEqual(self.db['k1'], 'v2')
+        self.assertTrue(self.db.cas('k1', 'v2', None))
+        self.assertEqual(self.get_or_none('k1'), None)
+
+    def test_atomic_threads(self):
+        def work():
+            for i in range(50):
+                self.db.incr('ct')
+                while True:
+                    current = self.get_or_none('swapped')
+                    new = str(int(current or 0) + 1)
+                    if self.db.cas('swapped', current, new):
+                        break
+
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(struct.unpack('>q', self.db['ct'])[0], 400)
+        self.assertEqual(self.db['swapped'], '400')
+
+    def test_incr_many(self):
+        self.db.incr('c1', 5)
+        incr_many(self.db, {'c1': 2, 'c2': -3})
+        self.assertEqual(struct.unpack('>q', self.db['c1'])[0], 7)
+        self.assertEqual(struct.unpack('>q', self.db['c2'])[0], -3)
+        self.assertEqual(self.db.incr('c2'), -2)
+
+
+class SnapshotTests(object):
+    def in_thread(self, fn):
+        thread = threading.Thread(target=fn)
+        thread.start()
+        thread.join()
+
+    def test_snapshot(self):
+        keys = ['k%02d' % i for i in range(20)]
+        for key in keys:
+            self.db[key] = 'v' + key
+
+        def write():
+            for i, key in enumerate(keys):
+                if i % 4 == 0:
+                    del self.db[key]
+                elif i % 3 == 0:
+                    self.db[key] = 'new'
+                self.db[key + 'x'] = 'new'
+
+        expected = [(key, 'v' + key) for key in keys]
+        with self.db.snapshot():
+            self.in_thread(write)
+            self.assertEqual(self.db['k00'], 'vk00')
+            self.assertEqual(self.db['k03'], 'vk03')
+            self.assertRaises(KeyError, lambda: self.db['k00x'])
+            self.assertEqual(self.db[['k04', 'k09']],
+                             {'k04': 'vk04', 'k09': 'vk09'})
+            self.assertEqual(list(self.db['k00':'k99']), expected)
+            self.assertEqual(list(self.db['k99':'k00']), expected[::-1])
+            if hasattr(self.db, 'cursor'):
+                with self.db.cursor() as cursor:
+                    self.assertEqual(list(cursor), expected)
+                    self.assertTrue(cursor.seek('k04'))
+                    self.assertEqual(cursor.value(), 'vk04')
+            with self.db.snapshot():
+                self.assertEqual(self.db['k03'], 'vk03')
+            self.assertEqual(self.db['k03'], 'vk03')
+
+        self.assertEqual(self.db['k03'], 'new')
+        self.assertRaises(KeyError, lambda: self.db['k00'])
+        self.assertEqual(len(list(self.db['k00':'k99'])), 35)
+
+    def test_query_snapshot(self):
+        class Item(Model):
+            name = Field(index=True)
+            size = Field()
+
+            class Meta:
+                database = self.db
+                serialize = False
+
+        item = Item.create(name='a', size='1')
+
+        # Change the item between reading the index and loading it.
+        def update():
+            item.name, item.size = 'b', '2'
+            item.save()
+
+        query_ids = Item._query_ids
+
+        def racing_query_ids(expr):
+            ids = query_ids(expr)
+            self.in_thread(update)
+            return ids
+
+        Item._query_ids = staticmethod(racing_query_ids)
+        results = Item.query(Item.name == 'a')
+        self.assertEqual([(r.name, r.size) for r in results], [('a', '1')])
+        self.assertEqual(Item.load(item.id).name, 'b')
+
+
 class ModelTests(object):
     def setUp(self):
         super(ModelTests, self).setUp()
@@ -440,6 +770,38 @@ class ModelTests(object):
             self.Person.last == 'owen',
             ['zaizee', 'beanie', 'scout'])
 
+    def test_clear_index(self):
+        self._create_people()
+        index = self.Person._meta.indexes['last']
+        self.assertEqual(index.clear(), 5)
+        self.assertPeople(self.Person.last == 'leifer', [])
+        self.assertPeople(self.Person.first == 'huey', ['huey'])
+        self.assertEqual(index.clear(), 0)
+
+    def test_clear_index_without_delete_range(self):
+        db = self.db
+
+        class Database(object):
+            # Like ForestDB and Sophia, which have no `delete_range()`.
+            def __getitem__(self, key):
+                return db[key]
+
+            def __delitem__(self, key):
+                del db[key]
+
+            def __contains__(self, key):
+                return key in db
+
+            def __setitem__(self, key, value):
+                db[key] = value
+
+        self._create_people()
+        index = self.Person._meta.indexes['last']
+        index.database = Database()
+        self.assertEqual(index.clear(), 5)
+        self.assertPeople(self.Person.last == 'leifer', [])
+        self.assertPeople(self.Person.first == 'huey', ['huey'])
+
     def test_get(self):
         self._create_people()
         huey = self.Person.get(self.Person.first == 'huey')
@@ -753,6 +1115,368 @@ class GraphTests(object):
             {'s': Y, 'p': 'friend', 'o': X})
         self.assertEqual(result['y'], set(['charlie', 'huey']))
 
+    def test_search_condition_order(self):
+        self.create_friends()
+        X = self.H.v('x')
+        Y = self.H.v('y')
+
+        conditions = (
+            {'s': X, 'p': 'friend', 'o': 'charlie'},
+            {'s': Y, 'p': 'friend', 'o': X})
+        expected = {'x': set(['huey']), 'y': set(['charlie'])}
+        self.assertEqual(self.H.search(*conditions), expected)
+        self.assertEqual(self.H.search(*reversed(conditions)), expected)
+
+        result = self.H.search((X, 'friend', 'nobody'), (X, 'friend', Y))
+        self.assertEqual(result, {'x': set(), 'y': set()})
+
+    def test_statistics(self):
+        H = Hexastore(self.db, statistics=True)
+        H.store_many((
+            ('charlie', 'likes', 'huey'),
+            ('charlie', 'likes', 'mickey'),
+            ('charlie', 'is', 'human'),
+            ('huey', 'is', 'cat'),
+            ('zaizee', 'is', 'cat'),
+        ))
+        H.store('charlie', 'likes', 'huey')  # Already exists.
+
+        self.assertEqual(H.count(), 5)
+        self.assertEqual(H.count(s='charlie'), 3)
+        self.assertEqual(H.count(p='is'), 3)
+        self.assertEqual(H.count(p='is', o='cat'), 2)
+        self.assertEqual(H.count(o='cat'), 2)
+        self.assertEqual(H.count(s='charlie', p='likes'), 2)
+        self.assertEqual(H.count('huey', 'is', 'cat'), 1)
+        self.assertEqual(H.count('huey', 'is', 'dog'), 0)
+
+        H.delete('charlie', 'likes', 'huey')
+        H.delete('charlie', 'likes', 'huey')  # Does not exist.
+        self.assertEqual(H.count(), 4)
+        self.assertEqual(H.count(s='charlie'), 2)
+        self.assertEqual(H.count(p='likes'), 1)
+        self.assertEqual(H.estimate(s='charlie', p='is'), 2)
+
+        counters = dict(self.db[H._stat_key(''):H._stat_key('\xff')])
+        H.rebuild_statistics()
+        self.assertEqual(
+            dict(self.db[H._stat_key(''):H._stat_key('\xff')]),
+            counters)
+
+    def test_permutations(self):
+        self.create_graph_data()
+        queries = (
+            {'s': 'charlie'},
+            {'p': 'likes'},
+            {'o': 'catfood'},
+            {'s': 'charlie', 'p': 'likes'},
+            {'s': 'huey', 'o': 'cat'},
+            {'p': 'is', 'o': 'cat'},
+            {'s': 'huey', 'p': 'is', 'o': 'cat'},
+            {'s': 'huey', 'p': 'is', 'o': 'dog'},
+        )
+
+        def triples(H, query):
+            return sorted((r['s'], r['p'], r['o']) for r in H.query(**query))
+
+        for i, permutations in enumerate((THREE_INDEX, ('spo',), ('ops',))):
+            H = Hexastore(self.db, prefix='p%s' % i, permutations=permutations)
+            H.store_many(triples(self.H, {}))
+
+            keys = list(self.db['p%s::' % i:'p%s::\xff' % i])
+            self.assertEqual(len(keys), 12 * len(permutations))
+            for query in queries:
+                self.assertEqual(triples(H, query), triples(self.H, query))
+                self.assertEqual(H.count(**query), self.H.count(**query))
+
+        self.assertEqual(
+            Hexastore(self.db, permutations=THREE_INDEX).keys_for_query(
+                s='huey', o='cat'),
+            ('::osp::cat::huey::', '::osp::cat::huey::\xff'))
+        self.assertRaises(ValueError, Hexastore, self.db, permutations=())
+        self.assertRaises(ValueError, Hexastore, self.db, permutations=('sp',))
+
+    def test_load(self):
+        data = [('s%02d' % i, 'p%s' % (i % 3), 'o%s' % (i % 5))
+                for i in range(23)]
+        totals = []
+        H = Hexastore(self.db, statistics=True)
+        self.assertEqual(H.load(iter(data), chunk_size=5,
+                                progress=totals.append), 23)
+        self.assertEqual(totals, [5, 10, 15, 20, 23])
+        self.assertEqual(H.count(), 23)
+        self.assertEqual(H.count(p='p1'), 8)
+        self.assertEqual(
+            sorted((r['s'], r['p'], r['o']) for r in H.query(o='o2')),
+            [triple for triple in data if triple[2] == 'o2'])
+
+        # Loading duplicates does not change the counts.
+        H.store_many(data[:10])
+        self.assertEqual(H.count(), 23)
+
+    def test_load_files(self):
+        ntriples = '\n'.join((
+            '# Comment.',
+            '<charlie> <likes> <huey> .',
+            '<huey> <name> "Huey \\"the cat\\"\\u00e9"@en .',
+            '_:b1 <age> "3"^^<http://www.w3.org/2001/XMLSchema#integer> .',
+            ''))
+        tsv = 'charlie\tlikes\tmickey\nmickey\tis\tdog\n'
+
+        filename = tempfile.mktemp(suffix='.nt')
+        try:
+            with open(filename, 'w') as fh:
+                fh.write(ntriples)
+            self.assertEqual(self.H.load(filename), 3)
+
+            with open(filename, 'w') as fh:
+                fh.write(tsv)
+            self.assertEqual(self.H.load(filename, format='tsv'), 2)
+        finally:
+            os.unlink(filename)
+
+        self.assertEqual(
+            sorted((r['s'], r['p'], r['o']) for r in self.H.query()),
+            [('_:b1', 'age', '3'),
+             ('charlie', 'likes', 'huey'),
+             ('charlie', 'likes', 'mickey'),
+             ('huey', 'name', u'Huey "the cat"\xe9'),
+             ('mickey', 'is', 'dog')])
+
+        self.assertRaises(ValueError, list, read_ntriples(['<a> <b> .']))
+        self.assertRaises(ValueError, list, read_tsv(['a\tb']))
+
+    def test_delete_where(self):
+        self.create_graph_data()
+        triples = lambda H, **q: sorted(
+            (r['s'], r['p'], r['o']) for r in H.query(**q))
+
+        self.assertEqual(self.H.delete_where(s='charlie', chunk_size=3), 4)
+        self.assertEqual(triples(self.H, s='charlie'), [])
+        self.assertEqual(triples(self.H, o='huey'), [
+            ('connor', 'likes', 'huey')])
+        self.assertEqual(self.H.delete_where(s='charlie'), 0)
+
+        self.assertEqual(self.H.delete_where('huey', 'is', 'cat'), 1)
+        self.assertEqual(self.H.delete_where('huey', 'is', 'cat'), 0)
+        self.assertEqual(self.H.delete_where(p='eats', o='catfood'), 2)
+        self.assertEqual(triples(self.H), [
+            ('connor', 'likes', 'huey'),
+            ('connor', 'likes', 'mickey'),
+            ('mickey', 'eats', 'anything'),
+            ('mickey', 'is', 'dog'),
+            ('zaizee', 'is', 'cat')])
+        self.assertEqual(len(list(self.db['::':'::\xff'])), 30)
+
+        # Filtered scan with statistics enabled.
+        H = Hexastore(self.db, prefix='h', statistics=True,
+                      permutations=('spo',))
+        H.store_many(triples(self.H))
+        self.assertEqual(H.delete_where(o='mickey', chunk_size=1), 1)
+        self.assertEqual(H.count(), 4)
+        self.assertEqual(H.count(s='connor'), 1)
+        self.assertEqual(triples(H, s='connor'), [
+            ('connor', 'likes', 'huey')])
+
+    def test_traversal(self):
+        self.create_friends()
+        self.H.store('charlie', 'is', 'human')
+
+        self.assertEqual(self.H.neighbors('charlie', 'friend'), set(['huey']))
+        self.assertEqual(
+            self.H.neighbors('charlie', 'friend', depth=2),
+            set(['huey', 'mickey']))
+        self.assertEqual(
+            self.H.neighbors('charlie', depth=2),
+            set(['huey', 'human', 'mickey']))
+        self.assertEqual(
+            self.H.neighbors('charlie', 'friend', 'in'),
+            set(['huey', 'zaizee']))
+        self.assertEqual(
+            self.H.neighbors('mickey', 'friend', 'both'),
+            set(['huey', 'nuggie', 'zaizee']))
+        self.assertEqual(
+            self.H.neighbors('zaizee', 'friend', fan_out=1),
+            set(['charlie']))
+
+        self.assertEqual(list(self.H.bfs('zaizee', 'friend')), [
+            ('zaizee', 0),
+            ('charlie', 1),
+            ('mickey', 1),
+            ('huey', 2),
+            ('nuggie', 2)])
+        self.assertEqual(
+            list(self.H.bfs('zaizee', 'friend', max_depth=1)),
+            [('zaizee', 0), ('charlie', 1), ('mickey', 1)])
+
+        self.assertEqual(
+            self.H.shortest_path('charlie', 'nuggie', 'friend'),
+            ['charlie', 'huey', 'mickey', 'nuggie'])
+        self.assertEqual(
+            self.H.shortest_path('nuggie', 'charlie', 'friend', 'in'),
+            ['nuggie', 'mickey', 'huey', 'charlie'])
+        self.assertEqual(
+            self.H.shortest_path('charlie', 'charlie', 'friend'),
+            ['charlie'])
+        self.assertIsNone(self.H.shortest_path('nuggie', 'charlie', 'friend'))
+        self.assertIsNone(self.H.shortest_path(
+            'charlie', 'nuggie', 'friend', max_depth=2))
+        self.assertRaises(
+            ValueError, self.H.neighbors, 'charlie', direction='up')
+
+    def test_property_paths(self):
+        self.H.store_many((
+            ('huey', 'parent', 'mickey'),
+            ('mickey', 'parent', 'zaizee'),
+            ('zaizee', 'parent', 'beanie'),
+            ('beanie', 'parent', 'mickey'),  # Cycle.
+            ('nuggie', 'parent', 'huey'),
+            ('huey', 'is', 'cat'),
+            ('mickey', 'is', 'dog'),
+            ('zaizee', 'is', 'cat'),
+        ))
+        X = self.H.v('x')
+        Y = self.H.v('y')
+
+        def search(*conditions):
+            return self.H.search(*conditions)['x']
+
+        parent = self.H.path
+        self.assertEqual(search(('huey', parent('parent+'), X)),
+                         set(['mickey', 'zaizee', 'beanie']))
+        self.assertEqual(search(('huey', parent('parent*'), X)),
+                         set(['huey', 'mickey', 'zaizee', 'beanie']))
+        self.assertEqual(search(('nuggie', parent('parent/parent'), X)),
+                         set(['mickey']))
+        self.assertEqual(search(('huey', parent('^parent'), X)),
+                         set(['nuggie']))
+        self.assertEqual(search((X, parent('parent+'), 'huey')),
+                         set(['nuggie']))
+        self.assertEqual(search(('zaizee', parent('^parent+'), X)),
+                         set(['huey', 'mickey', 'nuggie', 'zaizee', 'beanie']))
+        self.assertEqual(search(('nuggie', parent('(parent/parent)+'), X)),
+                         set(['mickey', 'beanie', 'zaizee']))
+        self.assertEqual(
+            search(('nuggie', parent('parent+', limit=2), X)),
+            set(['huey', 'mickey']))
+        self.assertEqual(
+            search(('mickey', parent('^parent+', limit=1), X)),
+            set(['beanie']))
+
+        # Combined with regular conditions.
+        self.assertEqual(
+            search(('nuggie', parent('parent+'), X), (X, 'is', 'cat')),
+            set(['huey', 'zaizee']))
+        result = self.H.search(
+            (X, parent('parent/parent'), Y),
+            (Y, 'is', 'dog'))
+        self.assertEqual(result, {
+            'x': set(['nuggie', 'zaizee']),
+            'y': set(['mickey'])})
+
+        self.assertRaises(ValueError, self.H.path, 'parent/')
+        self.assertRaises(ValueError, self.H.path, '(parent')
+        self.assertRaises(ValueError, self.H.path, 'parent)')
+
+    def test_csr(self):
+        self.create_friends()
+        self.H.store('charlie', 'likes', 'huey')
+        self.H.store('nash', 'friend', 'connor')
+
+        csr = self.H.to_csr('friend')
+        self.assertEqual(sorted(csr.nodes), [
+            'charlie', 'connor', 'huey', 'mickey', 'nash', 'nuggie',
+            'zaizee'])
+        self.assertEqual(len(csr.targets), 7)
+        self.assertEqual(csr.successors('huey'), ['charlie', 'mickey'])
+        self.assertEqual(csr.successors('nuggie'), [])
+
+        def by_node(values):
+            return dict(zip(csr.nodes, [round(v, 4) for v in values]))
+
+        self.assertEqual(by_node(csr.out_degree()), {
+            'charlie': 1, 'connor': 0, 'huey': 2, 'mickey': 1, 'nash': 1,
+            'nuggie': 0, 'zaizee': 2})
+        self.assertEqual(by_node(csr.in_degree()), {
+            'charlie': 2, 'connor': 1, 'huey': 1, 'mickey': 2, 'nash': 0,
+            'nuggie': 1, 'zaizee': 0})
+
+        ranks = by_node(csr.pagerank())
+        self.assertAlmostEqual(sum(ranks.values()), 1., places=3)
+        self.assertEqual(
+            max(ranks, key=ranks.get), 'nuggie')
+        self.assertTrue(ranks['nash'] == ranks['zaizee'] < ranks['connor'])
+
+        labels = by_node(csr.connected_components())
+        self.assertEqual(labels['nash'], labels['connor'])
+        self.assertEqual(len(set(labels.values())), 2)
+        self.assertEqual(
+            set(node for node in labels if labels[node] == labels['huey']),
+            set(['charlie', 'huey', 'mickey', 'nuggie', 'zaizee']))
+
+        # Reduced permutations without a predicate-first index.
+        H = Hexastore(self.db, prefix='h', permutations=('spo',))
+        H.store_many((r['s'], r['p'], r['o']) for r in self.H.query())
+        csr2 = H.to_csr('friend')
+        self.assertEqual(
+            sorted((node, csr2.successors(node)) for node in csr2.nodes),
+            sorted((node, csr.successors(node)) for node in csr.nodes))
+
+    def test_typed_literals(self):
+        dt = datetime.datetime
+        self.H.store_many((
+            ('huey', 'weight', 12.5),
+            ('mickey', 'weight', 40.),
+            ('zaizee', 'weight', 8.25),
+            ('beanie', 'weight', -1.5),
+            ('huey', 'age', 9),
+            ('mickey', 'age', 11),
+            ('zaizee', 'age', 4),
+            ('beanie', 'age', -2),
+            ('huey', 'born', dt(2011, 5, 1, 12, 30)),
+            ('zaizee', 'born', dt(2014, 1, 3)),
+            ('mickey', 'born', datetime.date(2009, 7, 1)),
+            ('huey', 'is', 'cat'),
+            ('zaizee', 'is', 'cat'),
+        ))
+
+        def query(**kwargs):
+            return [(r['s'], r['o']) for r in self.H.query(**kwargs)]
+
+        self.assertEqual(query(p='age', o_range=(4, 10)), [
+            ('zaizee', 4), ('huey', 9)])
+        self.assertEqual(query(p='age', o_range=(None, 9)), [
+            ('beanie', -2), ('zaizee', 4), ('huey', 9)])
+        self.assertEqual(query(p='weight', o_range=(0, None)), [
+            ('zaizee', 8.25), ('huey', 12.5), ('mickey', 40.)])
+        self.assertEqual(query(p='weight', o_range=(-2., 10)), [
+            ('beanie', -1.5), ('zaizee', 8.25)])
+        self.assertEqual(query(s='mickey', p='age', o_range=(10, 12)), [
+            ('mickey', 11)])
+        self.assertEqual(
+            query(p='born', o_range=(dt(2011, 1, 1), dt(2014, 1, 3))),
+            [('huey', dt(2011, 5, 1, 12, 30)), ('zaizee', dt(2014, 1, 3))])
+        self.assertEqual(query(p='born', o=datetime.date(2009, 7, 1)), [
+            ('mickey', datetime.date(2009, 7, 1))])
+        self.assertEqual(query(s='huey', p='age'), [('huey', 9)])
+        self.assertEqual(self.H.count(p='age', o=4), 1)
+        self.assertRaises(ValueError, list, self.H.query(o_range=('a', 'b')))
+        self.assertRaises(ValueError, list, self.H.query(o_range=(1, dt.now())))
+
+        X = self.H.v('x')
+        result = self.H.search(
+            (X, 'age', self.H.range(0, 10)),
+            (X, 'is', 'cat'))
+        self.assertEqual(result, {'x': set(['huey', 'zaizee'])})
+
+        # Without a permutation that can scan the range.
+        H = Hexastore(self.db, prefix='h', permutations=('pso',))
+        H.store_many((r['s'], r['p'], r['o']) for r in self.H.query())
+        self.assertEqual(
+            sorted((r['s'], r['o']) for r in H.query(
+                p='age', o_range=(0, 10))),
+            [('huey', 9), ('zaizee', 4)])
+
     def create_friends(self):
         data = (
             ('charlie', 'friend', 'huey'),
@@ -766,30 +1490,1295 @@ class GraphTests(object):
             self.H.store(*item)
 
 
-class HashTests(KVKitTests, BaseTestCase):
-    database_class = HashDB
+if TreeDB:
+    class HashTests(KVKitTests, BaseTestCase):
+        database_class = HashDB
+
+
+    class TreeTests(KVKitTests, GraphTests, ModelTests, SliceTests,
+                    CursorTests, AtomicTests, SnapshotTests, BaseTestCase):
+        database_class = TreeDB
+
+        def test_cursor_pool_threads(self):
+            self.create_rows(4)
+
+            def read():
+                self.assertEqual(len(list(self.db['k0':'k3'])), 4)
+
+            for i in range(8):
+                thread = threading.Thread(target=read)
+                thread.start()
+                thread.join()
+            read()
+            # Only the cursors pooled by this thread are left.
+            self.assertEqual(len(self.db._open_cursors), 1)
+
+        def test_snapshot_writes(self):
+            self.create_rows(3)
+            with self.db.snapshot():
+                # Writes do not wait, and are saved before they are made.
+                self.db['k1'] = 'new'
+                self.db.update(k2='new', k3='3')
+                self.db.incr('c')
+                del self.db['k0':'k0']
+                self.assertEqual(self.db.pop('k2'), 'new')
+                self.assertEqual(list(self.db['k0':'k9']), [
+                    ('k0', '0'), ('k1', '1'), ('k2', '2')])
+                self.assertFalse('c' in self.db)
+            self.assertEqual(list(self.db['k0':'k9']), [
+                ('k1', 'new'), ('k3', '3')])
+
+        def test_snapshot_transactions(self):
+            self.create_rows(3)
+
+            # Snapshots wait for the transactions of other threads.
+            began, ended = threading.Event(), threading.Event()
+
+            def transact():
+                with self.db.transaction():
+                    self.db['k0'] = 'tx'
+                    began.set()
+                    ended.wait()
+
+            thread = threading.Thread(target=transact)
+            thread.start()
+            began.wait()
+            opened = []
+
+            def open_snapshot():
+                with self.db.snapshot():
+                    opened.append(self.db['k0'])
+
+            reader = threading.Thread(target=open_snapshot)
+            reader.start()
+            reader.join(0.1)
+            self.assertEqual(opened, [])
+            ended.set()
+            thread.join()
+            reader.join()
+            self.assertEqual(opened, ['tx'])
+
+
+    class CacheHashTests(KVKitTests, BaseTestCase):
+        database_class = CacheHashDB
+
+
+    class CacheTreeTests(KVKitTests, GraphTests, ModelTests, SliceTests,
+                         CursorTests, AtomicTests, SnapshotTests,
+                         BaseTestCase):
+        database_class = CacheTreeDB
+
+
+class MemoryTests(KVKitTests, GraphTests, ModelTests, SliceTests,
+                  CursorTests, AtomicTests, SnapshotTests, BaseTestCase):
+    database_class = MemoryDB
+
+    def create_db(self):
+        # Use a small chunk size so that splits and merges are exercised.
+        return self.database_class(load=4)
+
+    def delete_db(self):
+        pass
+
+    def test_sorted_keys(self):
+        keys = SortedKeys(load=4)
+        values = ['%03d' % (i * 7 % 100) for i in range(100)]
+        for value in values:
+            keys.insert(value)
+        self.assertEqual(list(keys), sorted(values))
+        for value in values[::2]:
+            keys.remove(value)
+        self.assertEqual(list(keys), sorted(values[1::2]))
+        self.assertEqual(len(keys), 50)
+
+    def test_nested_transaction(self):
+        self.db['k1'] = 'v1'
+        with self.db.transaction():
+            self.db['k1'] = 'v1-x'
+            self.db['k2'] = 'v2'
+
+            def nested():
+                with self.db.transaction():
+                    self.db['k3'] = 'v3'
+                    del self.db['k1']
+                    raise ValueError()
+
+            self.assertRaises(ValueError, nested)
+            self.assertEqual(self.db.items(), [('k1', 'v1-x'), ('k2', 'v2')])
+
+            with self.db.transaction():
+                self.db['k4'] = 'v4'
+
+        self.assertEqual(self.db.items(), [
+            ('k1', 'v1-x'), ('k2', 'v2'), ('k4', 'v4')])
+
+        def failed():
+            with self.db.transaction():
+                with self.db.transaction():
+                    self.db.clear()
+                raise ValueError()
+
+        self.assertRaises(ValueError, failed)
+        self.assertEqual(len(self.db), 3)
+
+    def test_write_while_iterating(self):
+        self.create_rows(20)
+        keys = []
+        for key, value in self.db['k1':'k5']:
+            keys.append(key)
+            if key == 'k11':
+                del self.db['k12']
+                self.db['k13x'] = 'x'
+        self.assertEqual(keys, [
+            'k1', 'k10', 'k11', 'k13', 'k13x', 'k14', 'k15', 'k16', 'k17',
+            'k18', 'k19', 'k2', 'k3', 'k4', 'k5'])
+
+        with self.db.cursor(reverse=True) as cursor:
+            self.assertTrue(cursor.seek_for_prev('k13z'))
+            self.assertEqual(cursor.get(), ('k13x', 'x'))
+            self.assertEqual(cursor.pop(), ('k13x', 'x'))
+            self.assertEqual(list(cursor.fetch_count(2)), [
+                ('k13', '13'), ('k11', '11')])
+
+
+class SqliteTests(SliceTests, CursorTests, GraphTests, ModelTests,
+                  AtomicTests, SnapshotTests, BaseTestCase):
+    database_class = SqliteDB
+
+    def delete_db(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db.filename + suffix):
+                os.unlink(self.db.filename + suffix)
+
+    def test_storage(self):
+        self.db['k1'] = 'v1'
+        self.db[u'k2'] = u'v2'
+        self.assertEqual(self.db['k1'], 'v1')
+        self.assertEqual(self.db['k2'], 'v2')
+        self.assertRaises(KeyError, lambda: self.db['k3'])
+        self.assertEqual(self.db[['k1', 'k2', 'k3']], {
+            'k1': 'v1',
+            'k2': 'v2'})
+        self.assertTrue('k1' in self.db)
+        self.assertFalse('k3' in self.db)
+        self.assertEqual(len(self.db), 2)
+
+        self.assertFalse(self.db.add('k1', 'x'))
+        self.assertTrue(self.db.add('k3', 'v3'))
+        self.assertTrue(self.db.replace('k3', 'v3-x'))
+        self.assertFalse(self.db.replace('k4', 'v4'))
+        self.assertEqual(self.db.pop(), ('k1', 'v1'))
+        self.assertEqual(self.db.pop('k3'), 'v3-x')
+        self.assertEqual(self.db.incr('ct', 3), 3)
+        self.assertEqual(self.db.decr('ct'), 2)
+
+        # Keys are compared bytewise.
+        self.db.update({'\xff': 'a', '\x00': 'b', 'k\xe9': 'c'})
+        self.assertEqual(list(self.db.keys()), [
+            '\x00', 'ct', 'k2', 'k\xe9', '\xff'])
+
+        # Keyword arguments take priority, as with the other databases.
+        self.assertEqual(self.db.update({'k2': 'a', 'k5': 'b'}, k2='c'), 2)
+        self.assertEqual(self.db[['k2', 'k5']], {'k2': 'c', 'k5': 'b'})
+
+    def test_transaction(self):
+        with self.db.transaction():
+            self.db['k1'] = 'v1'
+            try:
+                with self.db.transaction():
+                    self.db['k2'] = 'v2'
+                    raise ValueError()
+            except ValueError:
+                pass
+            self.db['k3'] = 'v3'
+
+        self.assertEqual(list(self.db.keys()), ['k1', 'k3'])
+
+        def failed():
+            with self.db.transaction():
+                del self.db['k1']
+                raise ValueError()
+
+        self.assertRaises(ValueError, failed)
+        self.assertEqual(list(self.db.keys()), ['k1', 'k3'])
+
+    def test_threads(self):
+        self.db.update(dict(('k%02d' % i, str(i)) for i in range(20)))
+        results = []
+
+        def read():
+            results.append([key for key, _ in self.db['k05':'k09']])
+            self.db.incr('ct')
+
+        threads = [threading.Thread(target=read) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [['k05', 'k06', 'k07', 'k08', 'k09']] * 4)
+        self.assertEqual(self.db._get_int('ct'), 4)
+
+        # The connections of the exited threads are closed by the next
+        # thread to connect.
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(self.db._connections), 2)
+
+
+class BitcaskTests(SliceTests, CursorTests, GraphTests, ModelTests,
+                   AtomicTests, SnapshotTests, BaseTestCase):
+    database_class = BitcaskDB
+
+    def create_db(self):
+        # Use small segments so that rotation is exercised.
+        return self.database_class('test.db', max_segment_size=1024)
+
+    def test_storage(self):
+        self.db['k1'] = 'v1'
+        self.db['k2'] = 'v2'
+        self.db['k1'] = 'v1-x'
+        self.assertEqual(self.db['k1'], 'v1-x')
+        self.assertRaises(KeyError, lambda: self.db['k3'])
+        self.assertEqual(self.db[['k1', 'k2', 'k3']], {
+            'k1': 'v1-x',
+            'k2': 'v2'})
+        del self.db['k2']
+        self.assertFalse('k2' in self.db)
+        self.assertEqual(len(self.db), 1)
+        self.assertEqual(self.db.incr('ct', 2), 2)
+        self.assertEqual(self.db.pop(), ('ct', struct.pack('>q', 2)))
+
+    def test_reopen(self):
+        for i in range(100):
+            self.db['k%02d' % i] = 'v%s' % i
+        for i in range(0, 100, 2):
+            del self.db['k%02d' % i]
+        self.db['k01'] = 'v1-x'
+        self.db.close()
+
+        # Simulate a partial write at the end of the last segment.
+        segments = sorted(os.listdir('test.db'))
+        last = os.path.join('test.db', segments[-1].replace('.hint', '.data'))
+        os.unlink(last.replace('.data', '.hint'))
+        with open(last, 'ab') as fh:
+            fh.write('\x00\x01\x02')
+
+        self.db.open()
+        self.assertEqual(len(self.db), 50)
+        self.assertEqual(self.db['k01'], 'v1-x')
+        self.assertEqual(self.db['k99'], 'v99')
+        self.assertFalse('k02' in self.db)
+        self.assertEqual(list(self.db.keys())[:3], ['k01', 'k03', 'k05'])
+
+    def test_transaction_recovery(self):
+        self.db['k1'] = 'v1'
+        with self.db.transaction():
+            self.db['k2'] = 'v2'
+        self.db.begin()
+        self.db['k1'] = 'v1-x'
+        self.db['k2'] = 'v2-x'
+        self.db.rollback()
+
+        # Simulate a crash part way through a transaction, after some of its
+        # records have reached the disk.
+        self.db.begin()
+        for i in range(50):
+            self.db['k%02d' % i] = 'temp'
+        self.db.flush()
+        shutil.copytree('test.db', 'test-copy.db')
+        self.db.rollback()
+        self.db.close()
+
+        try:
+            self.db = self.database_class('test-copy.db')
+            self.assertEqual(sorted(self.db.items()), [
+                ('k1', 'v1'), ('k2', 'v2')])
+
+            # Records written after recovering are not part of the lost
+            # transaction.
+            self.db['k3'] = 'v3'
+            self.db.close()
+            self.db.open()
+            self.assertEqual(sorted(self.db.keys()), ['k1', 'k2', 'k3'])
+        finally:
+            self.db.close()
+            shutil.rmtree('test-copy.db')
+        self.db = self.create_db()
+        self.assertEqual(sorted(self.db.items()), [
+            ('k1', 'v1'), ('k2', 'v2')])
+
+    def test_update_transaction(self):
+        self.db['k1'] = 'v1'
+        _set = self.db._set
+
+        def failing_set(key, value):
+            if key == 'k3':
+                raise IOError()
+            _set(key, value)
+
+        # The records of an update are written in a single transaction.
+        self.db._set = failing_set
+        self.assertRaises(IOError, self.db.update,
+                          dict(('k%s' % i, 'x') for i in range(5)))
+        del self.db._set
+        self.assertEqual(self.db.items(), [('k1', 'v1')])
+        self.db.close()
+        self.db.open()
+        self.assertEqual(self.db.items(), [('k1', 'v1')])
+
+    def test_reader(self):
+        self.db.update(dict(('k%02d' % i, 'v%s' % i) for i in range(50)))
+        self.db.flush()
+        reader = self.db._reader()
+        try:
+            self.assertEqual(len(reader), 50)
+            self.assertEqual(reader['k01'], 'v1')
+            self.assertRaises(DatabaseError, reader.__setitem__, 'k1', 'x')
+            self.assertRaises(DatabaseError, reader.begin)
+            self.assertRaises(DatabaseError, reader.compact)
+        finally:
+            reader.close()
+        self.db['k01'] = 'v1-x'
+        self.assertEqual(self.db['k01'], 'v1-x')
+
+    def test_compact(self):
+        for i in range(50):
+            self.db['k%02d' % i] = 'v%s' % i
+        for i in range(50):
+            self.db['k%02d' % i] = 'v%s-x' % i
+        for i in range(0, 50, 2):
+            del self.db['k%02d' % i]
+
+        with self.db.transaction():
+            self.db['k01'] = 'temp'
+            self.assertRaises(DatabaseError, self.db.compact)
+        self.db['k01'] = 'v1-x'
+
+        self.assertTrue(self.db.dead_ratio() > .5)
+        self.assertTrue(self.db.compact() > 0)
+        self.assertTrue(self.db.dead_ratio() < .1)
+        self.assertEqual(self.db['k01'], 'v1-x')
+        self.assertFalse('kx' in self.db)
+        self.assertEqual(len(self.db), 25)
+
+        self.db.close()
+        self.db.open()
+        self.assertEqual(self.db['k01'], 'v1-x')
+        self.assertEqual(self.db['k49'], 'v49-x')
+        self.assertFalse('kx' in self.db)
+        self.assertEqual(len(self.db), 25)
+
+    def test_compact_snapshot(self):
+        for i in range(50):
+            self.db['k%02d' % i] = 'v%s' % i
+        expected = [('k%02d' % i, 'v%s' % i) for i in range(50)]
+
+        with self.db.snapshot():
+            for i in range(50):
+                self.db['k%02d' % i] = 'v%s-x' % i
+            for i in range(0, 50, 2):
+                del self.db['k%02d' % i]
+
+            # The records the snapshot reads are kept by the compaction.
+            self.assertTrue(self.db.compact() > 0)
+            self.assertEqual(self.db['k00'], 'v0')
+            self.assertEqual(list(self.db['k00':'k99']), expected)
+
+        # Deleted keys stay deleted, though their old records were kept.
+        self.db.close()
+        self.db.open()
+        self.assertEqual(len(self.db), 25)
+        self.assertFalse('k00' in self.db)
+        self.assertEqual(self.db['k01'], 'v1-x')
+        self.assertTrue(self.db.compact() > 0)
+        self.assertTrue(self.db.dead_ratio() < .1)
+
+    def test_unordered(self):
+        self.db.close()
+        self.delete_db()
+        self.db = self.database_class('test.db', ordered=False)
+        self.create_slice_data()
+        self.assertSlice(self.db['aa1':'cc'], ['aa1', 'aa2', 'bb', 'cc'])
+        self.assertSlice(self.db['cc':'aa1'], ['cc', 'bb', 'aa2', 'aa1'])
+        with self.db.snapshot():
+            del self.db['bb']
+            self.db['bb1'] = 'bb1'
+            self.assertSlice(self.db['cc':'aa1'], ['cc', 'bb', 'aa2', 'aa1'])
+
+
+class WriteBufferTests(SliceTests, GraphTests, ModelTests, SnapshotTests,
+                       BaseTestCase):
+    def create_db(self):
+        # Flush often so that reads merge the buffer with flushed records.
+        return WriteBuffer(MemoryDB(load=4), max_ops=8)
+
+    def delete_db(self):
+        pass
+
+    def test_read_your_writes(self):
+        self.db.update({'k1': 'v1', 'k2': 'v2', 'k3': 'v3'})
+        self.assertEqual(self.db.flush(), 3)
+        self.assertEqual(len(self.db.db), 3)
+
+        self.db['k2'] = 'v2-x'
+        self.db['k4'] = 'v4'
+        del self.db['k1']
+        self.assertEqual(self.db.pending_count, 3)
+        self.assertEqual(len(self.db), 3)
+        self.assertEqual(self.db['k2'], 'v2-x')
+        self.assertEqual(self.db['k4'], 'v4')
+        self.assertRaises(KeyError, lambda: self.db['k1'])
+        self.assertFalse('k1' in self.db)
+        self.assertTrue('k3' in self.db)
+        self.assertEqual(self.db[['k1', 'k2', 'k3', 'k5']], {
+            'k2': 'v2-x', 'k3': 'v3'})
+
+        # Nothing has reached the database yet.
+        self.assertEqual(self.db.db['k1'], 'v1')
+        self.assertFalse('k4' in self.db.db)
+
+        self.assertEqual(list(self.db['k0':'k9']), [
+            ('k2', 'v2-x'), ('k3', 'v3'), ('k4', 'v4')])
+        self.assertEqual(list(self.db['k9':'k0']), [
+            ('k4', 'v4'), ('k3', 'v3'), ('k2', 'v2-x')])
+        self.assertEqual(self.db.get_prefix('k'), [
+            ('k2', 'v2-x'), ('k3', 'v3'), ('k4', 'v4')])
+
+        self.assertEqual(self.db.flush(), 3)
+        self.assertEqual(self.db.pending_count, 0)
+        self.assertEqual(len(self.db), 3)
+        self.assertEqual(self.db.db.items(), [
+            ('k2', 'v2-x'), ('k3', 'v3'), ('k4', 'v4')])
+
+    def test_len(self):
+        lookups = []
+
+        class CountingDB(MemoryDB):
+            def __contains__(self, key):
+                lookups.append(key)
+                return super(CountingDB, self).__contains__(key)
+
+        db = WriteBuffer(CountingDB(), max_ops=100)
+        db.update(k1='v1', k2='v2')
+        db.flush()
+        db['k2'] = 'v2-x'
+        db['k3'] = 'v3'
+        self.assertEqual(len(db), 3)
+        del db['k1']
+        self.assertEqual(len(db), 2)
+        self.assertEqual(len(db), 2)
+
+        # Each buffered key is looked up once until the buffer is flushed.
+        self.assertEqual(sorted(lookups), ['k1', 'k2', 'k3'])
+        db.flush()
+        self.assertEqual(len(db), 2)
+        self.assertEqual(len(lookups), 3)
+
+    def test_flush_thresholds(self):
+        for i in range(7):
+            self.db['k%s' % i] = 'v%s' % i
+        self.assertEqual(self.db.pending_count, 7)
+        self.assertEqual(len(self.db), 7)
+        self.assertEqual(len(self.db.db), 0)
+
+        # Rewriting a buffered key does not count as another write.
+        self.db['k0'] = 'v0-x'
+        self.assertEqual(self.db.pending_count, 7)
+        self.db['k7'] = 'v7'
+        self.assertEqual(self.db.pending_count, 0)
+        self.assertEqual(len(self.db.db), 8)
+
+        db = WriteBuffer(MemoryDB(), max_bytes=16)
+        db['k1'] = 'v1'
+        self.assertEqual(db.pending_bytes, 4)
+        db['k2'] = 'x' * 10
+        self.assertEqual(db.pending_count, 0)
+        self.assertEqual(db.db['k2'], 'x' * 10)
+
+    def test_transaction(self):
+        self.db['k0'] = 'v0'
+        with self.db.transaction():
+            for i in range(1, 12):
+                self.db['k%s' % i] = 'v%s' % i
+
+            # Writes made in a transaction are not flushed until it commits.
+            self.assertEqual(len(self.db.db), 0)
+
+        self.assertEqual(self.db.pending_count, 0)
+        self.assertEqual(len(self.db.db), 12)
+
+        def failed():
+            with self.db.transaction():
+                self.db['k1'] = 'v1-x'
+                del self.db['k2']
+                self.assertEqual(self.db.delete_range('k3', 'k4'), 2)
+                raise ValueError()
+
+        self.assertRaises(ValueError, failed)
+        self.assertEqual(self.db.pending_count, 0)
+        self.assertEqual(self.db['k1'], 'v1')
+        self.assertEqual(self.db['k2'], 'v2')
+        self.assertEqual(self.db['k3'], 'v3')
+
+        self.db['k5'] = 'v5-x'
+        self.assertEqual(self.db.delete_range('k5', 'k6'), 2)
+        self.assertEqual(self.db.pending_count, 0)
+        self.assertFalse('k5' in self.db.db)
+
+    def test_flush_interval(self):
+        db = WriteBuffer(MemoryDB(), flush_interval=0.01)
+        db['k1'] = 'v1'
+        for i in range(100):
+            if not db.pending_count:
+                break
+            time.sleep(0.01)
+        self.assertEqual(db.db['k1'], 'v1')
+        db['k2'] = 'v2'
+        db.close()
+        self.assertEqual(db.db['k2'], 'v2')
+
+
+class CounterBufferTests(BaseTestCase):
+    def create_db(self):
+        return CounterBuffer(MemoryDB(), max_keys=4)
+
+    def delete_db(self):
+        pass
+
+    def test_counters(self):
+        self.db.db.incr('c0', 10)
+        for i in range(3):
+            self.db.incr('c0')
+            self.db.incr('c1', 2)
+        self.db.decr('c2')
+        self.assertEqual(len(self.db), 3)
+        self.assertEqual(self.db.get('c0'), 13)
+        self.assertEqual(self.db.get('c1'), 6)
+        self.assertEqual(self.db.get('c2'), -1)
+        self.assertEqual(self.db.get('c3'), 0)
+
+        # Nothing has reached the database yet.
+        self.assertEqual(self.db.db._get_int('c0'), 10)
+        self.assertFalse('c1' in self.db.db)
+
+        self.assertEqual(self.db.flush(), 3)
+        self.assertEqual(len(self.db), 0)
+        self.assertEqual(self.db.db._get_int('c0'), 13)
+        self.assertEqual(self.db.db._get_int('c1'), 6)
+        self.assertEqual(self.db.get('c1'), 6)
+
+        # Increments that cancel out are not written.
+        self.db.incr('c1', 3)
+        self.db.decr('c1', 3)
+        self.assertEqual(self.db.flush(), 0)
+
+    def test_flush_failure(self):
+        db = self.db.db
+        incr = db.incr
+        failed = []
+
+        def flaky_incr(key, amount=1):
+            if key == 'c2' and not failed:
+                failed.append(key)
+                raise ValueError('write failed')
+            return incr(key, amount)
+
+        db.incr = flaky_incr
+        for i in range(3):
+            self.db.incr('c%s' % i, i + 1)
+        self.assertRaises(ValueError, self.db.flush)
+
+        # Increments that were written are not put back, so none is counted
+        # twice.
+        for i in range(3):
+            self.assertEqual(self.db.get('c%s' % i), i + 1)
+        self.assertTrue(self.db.flush() >= 1)
+        for i in range(3):
+            self.assertEqual(db._get_int('c%s' % i), i + 1)
+
+    def test_flush_thresholds(self):
+        for i in range(3):
+            self.db.incr('c%s' % i)
+        self.assertEqual(len(self.db.db), 0)
+        self.db.incr('c3')
+        self.assertEqual(len(self.db), 0)
+        self.assertEqual(len(self.db.db), 4)
+
+        db = CounterBuffer(MemoryDB(), flush_interval=0.01)
+        db.incr('c1')
+        for i in range(100):
+            if not len(db):
+                break
+            time.sleep(0.01)
+        self.assertEqual(db.db._get_int('c1'), 1)
+        db.incr('c2')
+        db.close()
+        self.assertEqual(db.db._get_int('c2'), 1)
+
+    def test_threads(self):
+        def work():
+            for i in range(200):
+                self.db.incr('c%s' % (i % 5))
+
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.db.flush()
+        for i in range(5):
+            self.assertEqual(self.db.db._get_int('c%s' % i), 320)
+
+
+class CachedDatabaseTests(SliceTests, GraphTests, ModelTests, SnapshotTests,
+                          BaseTestCase):
+    def create_db(self):
+        # Use a small cache so that evictions are exercised.
+        return CachedDatabase(MemoryDB(load=4), max_bytes=256)
+
+    def delete_db(self):
+        pass
+
+    def test_cache(self):
+        self.db.update({'k1': 'v1', 'k2': 'v2'})
+        self.assertEqual(self.db['k1'], 'v1')
+        self.assertEqual(self.db['k1'], 'v1')
+        self.assertRaises(KeyError, lambda: self.db['k3'])
+        self.assertFalse('k3' in self.db)
+        self.assertEqual(self.db.get('k3', 'x'), 'x')
+        self.assertEqual((self.db.hits, self.db.misses), (3, 2))
+        self.assertEqual(self.db.stats()['entries'], 2)
+        self.assertEqual(self.db.cache_bytes, 6)
+
+        # Writes evict the keys they touch, including cached misses.
+        self.db['k1'] = 'v1-x'
+        self.db['k3'] = 'v3'
+        self.assertEqual(self.db['k1'], 'v1-x')
+        self.assertEqual(self.db['k3'], 'v3')
+        self.db.update(k1='v1-y', k4='v4')
+        self.assertEqual(self.db[['k1', 'k4', 'k5']], {
+            'k1': 'v1-y', 'k4': 'v4'})
+        del self.db['k1']
+        self.assertRaises(KeyError, lambda: self.db['k1'])
+        self.assertEqual(self.db.incr('ct'), 1)
+        self.assertEqual(self.db.incr('ct'), 2)
+        self.assertEqual(self.db.decr('ct'), 1)
+
+        self.assertEqual(self.db['k2'], 'v2')
+        self.assertEqual(self.db.delete_range('k2', 'k3'), 2)
+        self.assertRaises(KeyError, lambda: self.db['k2'])
+        self.assertRaises(KeyError, lambda: self.db['k3'])
+        self.assertEqual(self.db['k4'], 'v4')
+
+        # The keys get_many() finds in the database, or not, are cached.
+        self.db.update(k5='v5', k6='v6')
+        self.db.reset_stats()
+        expected = {'k4': 'v4', 'k5': 'v5', 'k6': 'v6'}
+        keys = ['k4', 'k5', 'k6', 'k7']
+        self.assertEqual(self.db.get_many(keys), expected)
+        self.assertEqual((self.db.hits, self.db.misses), (1, 3))
+        self.assertEqual(self.db.get_many(keys), expected)
+        self.assertEqual((self.db.hits, self.db.misses), (5, 3))
+
+    def test_eviction(self):
+        self.db.update(dict(('k%02d' % i, 'x' * 20) for i in range(20)))
+        for i in range(20):
+            self.db['k%02d' % i]
+        self.assertTrue(self.db.cache_bytes <= 256)
+        self.assertEqual(self.db.stats()['entries'], 11)
+
+        # The most recently used keys are kept.
+        self.db.reset_stats()
+        self.db['k19']
+        self.db['k00']
+        self.assertEqual((self.db.hits, self.db.misses), (1, 1))
+
+        # Values too large for the cache are never cached.
+        self.db['big'] = 'x' * 1024
+        self.assertEqual(self.db['big'], 'x' * 1024)
+        self.assertEqual(self.db['big'], 'x' * 1024)
+        self.assertEqual(self.db.misses, 3)
+
+    def test_transaction(self):
+        self.db.update({'k1': 'v1', 'k2': 'v2', 'k3': 'v3'})
+        self.assertEqual(self.db['k1'], 'v1')
+
+        def failed():
+            with self.db.transaction():
+                self.db['k1'] = 'v1-x'
+                self.assertEqual(self.db['k1'], 'v1-x')
+                self.db.delete_range('k2', 'k3')
+                self.assertRaises(KeyError, lambda: self.db['k2'])
+                with self.db.transaction():
+                    self.db['k4'] = 'v4'
+                self.assertEqual(self.db['k4'], 'v4')
+                raise ValueError()
+
+        self.assertRaises(ValueError, failed)
+        self.assertEqual(self.db['k1'], 'v1')
+        self.assertEqual(self.db['k2'], 'v2')
+        self.assertEqual(self.db['k3'], 'v3')
+        self.assertRaises(KeyError, lambda: self.db['k4'])
+
+        with self.db.transaction():
+            self.db['k1'] = 'v1-x'
+            del self.db['k2']
+        self.assertEqual(self.db['k1'], 'v1-x')
+        self.assertRaises(KeyError, lambda: self.db['k2'])
+
+
+class BloomDatabaseTests(SliceTests, GraphTests, ModelTests, SnapshotTests,
+                         BaseTestCase):
+    def create_db(self):
+        return BloomDatabase(MemoryDB(load=4), capacity=1000)
+
+    def delete_db(self):
+        pass
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+        self.assertEqual(bloom.nhashes, 7)
+        self.assertEqual(bloom.memory_usage(), 1199)
+        for i in range(1000):
+            bloom.add('k%s' % i)
+        for i in range(1000):
+            self.assertTrue('k%s' % i in bloom)
+        false_positives = sum(1 for i in range(10000) if 'x%s' % i in bloom)
+        self.assertTrue(false_positives < 200)
+        self.assertTrue(0.005 < bloom.false_positive_rate() < 0.015)
+
+    def test_negative_lookups(self):
+        self.db.update({'k1': 'v1', 'k2': 'v2'})
+        self.db['k3'] = 'v3'
+        self.db.incr('ct')
+        self.assertEqual(self.db['k1'], 'v1')
+        self.assertTrue('k3' in self.db)
+        self.assertTrue('ct' in self.db)
+
+        self.db.negatives = 0
+        for i in range(100):
+            self.assertFalse('x%s' % i in self.db)
+        self.assertRaises(KeyError, lambda: self.db['x1'])
+        self.assertEqual(self.db[['k1', 'k2', 'x1', 'x2']], {
+            'k1': 'v1', 'k2': 'v2'})
+        self.assertTrue(self.db.negatives > 95)
+
+        # Deleted keys are answered by the database until a rebuild.
+        del self.db['k1']
+        self.assertFalse('k1' in self.db)
+        self.assertEqual(self.db.stats()['count'], 4)
+        self.db.rebuild()
+        self.assertEqual(self.db.stats()['count'], 3)
+        self.assertFalse('k1' in self.db)
+        self.assertEqual(self.db['k2'], 'v2')
+
+    def test_rebuild_concurrent_writes(self):
+        self.db.update(dict(('k%02d' % i, 'v') for i in range(10)))
+        scan = self.db.db.keys
+        seen = []
+
+        def keys():
+            # Write through the wrapper part way through the scan.
+            for i, key in enumerate(scan()):
+                if i == 5:
+                    self.db['k%02d-new' % i] = 'v'
+                    seen.append('k05-new' in self.db)
+                yield key
+
+        self.db.db.keys = keys
+        try:
+            self.db.rebuild(batch_size=2)
+        finally:
+            del self.db.db.keys
+        self.assertEqual(seen, [True])
+        self.assertTrue('k05-new' in self.db.bloom)
+        self.assertEqual(self.db['k05-new'], 'v')
+
+    def test_rebuild_before_write(self):
+        # A rebuild that runs after a key is added to the filter, but before
+        # it reaches the database, scans the keys without it.
+        class RacingDB(MemoryDB):
+            def __setitem__(db, key, value):
+                self.db.rebuild()
+                super(RacingDB, db).__setitem__(key, value)
+
+        self.db = BloomDatabase(RacingDB(), capacity=100)
+        self.db['k1'] = 'v'
+        self.assertTrue('k1' in self.db)
+        self.assertEqual(self.db.get('k1'), 'v')
+
+    def test_persistence(self):
+        path = tempfile.mkdtemp()
+        filename = os.path.join(path, 'test.bloom')
+        try:
+            db = BloomDatabase(MemoryDB(), capacity=100, filename=filename)
+            db.update({'k1': 'v1', 'k2': 'v2'})
+            stats = db.stats()
+            db.close()
+
+            db = BloomDatabase(MemoryDB(), filename=filename)
+            self.assertEqual(db.stats(), stats)
+            self.assertTrue('k1' in db.bloom)
+            self.assertTrue('k2' in db.bloom)
+
+            # The file is removed while the filter is in use.
+            self.assertFalse(os.path.exists(filename))
+            db.close()
+            self.assertTrue(os.path.exists(filename))
+        finally:
+            shutil.rmtree(path)
+
+
+class CompressedDatabaseTests(SliceTests, GraphTests, ModelTests,
+                              SnapshotTests, BaseTestCase):
+    def create_db(self):
+        # Compress even small values, using a dictionary trained on the
+        # kinds of values the tests store.
+        db = CompressedDatabase(MemoryDB(load=4), min_size=4)
+        db.train(['%s::%s::%s' % (x, x, x) for x in ('aa', 'bb', 'k1')] * 2)
+        return db
+
+    def delete_db(self):
+        pass
+
+    def row(self, i):
+        return ('{"id": %s, "first_name": "huey", "last_name": "leifer", '
+                '"dob": "2011-05-01", "city": "Lawrence", "state": "KS"}' % i)
+
+    def test_compression(self):
+        db = CompressedDatabase(MemoryDB(), min_size=32)
+        db['k1'] = self.row(1)
+        self.assertEqual(db.db['k1'], '\x00' + self.row(1))
+
+        self.assertEqual(db.train([self.row(i) for i in range(20)]), 1)
+        db['k2'] = self.row(2)
+        db['k3'] = 'short'
+        self.assertEqual(db.db['k2'][0], '\x01')
+        self.assertTrue(len(db.db['k2']) < len(self.row(2)) // 4)
+        self.assertEqual(db.db['k3'], '\x00short')
+
+        self.assertEqual(db.train(), 2)
+        db.update(k4=self.row(4), k5=self.row(5))
+        self.assertEqual(db.db['k4'][0], '\x02')
+        self.assertEqual(db.items(), [
+            ('k1', self.row(1)), ('k2', self.row(2)), ('k3', 'short'),
+            ('k4', self.row(4)), ('k5', self.row(5))])
+        self.assertEqual(db[['k2', 'k5', 'k6']], {
+            'k2': self.row(2), 'k5': self.row(5)})
+        self.assertEqual(list(db['k5':'k4']), [
+            ('k5', self.row(5)), ('k4', self.row(4))])
+
+        # Values written with an unknown dictionary cannot be read.
+        other = CompressedDatabase(db.db)
+        self.assertEqual(other['k1'], self.row(1))
+        self.assertRaises(DatabaseError, lambda: other['k2'])
+
+    def test_incr_threads(self):
+        class UnlockedDB(MemoryDB):
+            # Transactions that do not block other threads.
+            @contextlib.contextmanager
+            def transaction(self):
+                yield
+
+            def __getitem__(self, key):
+                value = super(UnlockedDB, self).__getitem__(key)
+                time.sleep(0.001)
+                return value
+
+        db = CompressedDatabase(UnlockedDB())
+
+        def incr():
+            for i in range(10):
+                db.incr('ct')
+
+        threads = [threading.Thread(target=incr) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(db.incr('ct', 0), 40)
+
+    def test_legacy_values(self):
+        # A database written without the wrapper.
+        counter = struct.pack('>q', 3)
+        raw = MemoryDB()
+        raw.update(dict(('k%02d' % i, self.row(i)) for i in range(30)))
+        raw['ct'] = counter
+
+        db = CompressedDatabase(raw, min_size=32, legacy=True)
+        self.assertEqual(db['k01'], self.row(1))
+        self.assertEqual(db.train(sample_size=10), 1)
+        self.assertEqual(db['k01'], self.row(1))
+
+        self.assertEqual(db.recompress(headerless=True, batch_size=7), 31)
+        self.assertEqual(db.db['k01'][0], '\x01')
+        self.assertEqual(db.db['ct'], '\x00' + counter)
+        self.assertEqual(db['ct'], counter)
+        self.assertEqual(db.incr('ct'), 4)
+        self.assertEqual(db.items()[:2], [
+            ('ct', struct.pack('>q', 4)), ('k00', self.row(0))])
+
+        # Values written with older dictionaries are converted.
+        self.assertEqual(db.train([self.row(i) * 2 for i in range(20)]), 2)
+        self.assertEqual(db.recompress(), 30)
+        self.assertEqual(db.db['k29'][0], '\x02')
+        self.assertEqual(db['k29'], self.row(29))
+        self.assertEqual(db.recompress(), 0)
+
+        # Without `legacy`, headerless values are an error.
+        raw['x'] = 'headerless'
+        self.assertEqual(db['x'], 'headerless')
+        self.assertRaises(DatabaseError, lambda: CompressedDatabase(
+            raw, db.dictionaries)['x'])
+
+    def test_dictionary_file(self):
+        path = tempfile.mkdtemp()
+        filename = os.path.join(path, 'test.zdict')
+        try:
+            db = CompressedDatabase(MemoryDB(), filename=filename)
+            db.train([self.row(i) for i in range(20)])
+            db.train([self.row(i) * 2 for i in range(20)])
+            db['k1'] = self.row(1)
+
+            other = CompressedDatabase(db.db, filename=filename)
+            self.assertEqual(other.version, 2)
+            self.assertEqual(other.dictionaries, db.dictionaries)
+            self.assertEqual(other['k1'], self.row(1))
+        finally:
+            shutil.rmtree(path)
+
+
+class ShardedDatabaseTests(SliceTests, GraphTests, ModelTests, SnapshotTests,
+                           BaseTestCase):
+    def create_db(self):
+        return ShardedDatabase([MemoryDB(load=4) for i in range(3)])
+
+    def delete_db(self):
+        pass
+
+    def test_routing(self):
+        self.db.update(dict(('k%02d' % i, 'v%s' % i) for i in range(30)))
+        self.assertEqual(len(self.db), 30)
+        counts = [len(db) for db in self.db.databases]
+        self.assertEqual(sum(counts), 30)
+        self.assertTrue(all(counts))
+        for i in range(30):
+            key = 'k%02d' % i
+            self.assertEqual(self.db.shard_for(key)[key], 'v%s' % i)
+
+        self.assertEqual(self.db['k01'], 'v1')
+        self.assertEqual(self.db[['k01', 'k02', 'k99']], {
+            'k01': 'v1', 'k02': 'v2'})
+        self.assertEqual(self.db.incr('ct', 2), 2)
+        del self.db[['k01', 'k02']]
+        self.assertFalse('k01' in self.db)
+
+        self.assertEqual([key for key, _ in self.db['k05':'k09']], [
+            'k05', 'k06', 'k07', 'k08', 'k09'])
+        self.assertEqual([key for key, _ in self.db['k09':'k05']], [
+            'k09', 'k08', 'k07', 'k06', 'k05'])
+        self.assertEqual(self.db.get_prefix('k1', 3), [
+            ('k10', 'v10'), ('k11', 'v11'), ('k12', 'v12')])
+        self.assertEqual(self.db.delete_range('k10', 'k19'), 10)
+        self.assertEqual(len(self.db), 19)
+
+    def test_router(self):
+        db = ShardedDatabase(
+            [MemoryDB(), MemoryDB()],
+            router=lambda key, shards: 0 if key < 'm' else 1,
+            workers=1)
+        db.update(a='1', z='2', b='3')
+        self.assertEqual(list(db.databases[0].keys()), ['a', 'b'])
+        self.assertEqual(list(db.databases[1].keys()), ['z'])
+        self.assertEqual(db.items(), [('a', '1'), ('b', '3'), ('z', '2')])
+
+    def test_transaction(self):
+        self.db.update(k1='v1', k2='v2', k3='v3')
+
+        def failed():
+            with self.db.transaction():
+                del self.db['k1']
+                self.db['k2'] = 'v2-x'
+                self.db['k4'] = 'v4'
+                raise ValueError()
+
+        self.assertRaises(ValueError, failed)
+        self.assertEqual(self.db.items(), [
+            ('k1', 'v1'), ('k2', 'v2'), ('k3', 'v3')])
+
+        # Only the shards written are part of the transaction, so other
+        # threads may write the rest.
+        db = ShardedDatabase(
+            [MemoryDB(), MemoryDB()],
+            router=lambda key, shards: 0 if key < 'm' else 1)
+        with db.transaction():
+            db['a'] = '1'
+            thread = threading.Thread(target=db.__setitem__, args=('z', '2'))
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+            def inner():
+                with db.transaction():
+                    db['b'] = '3'
+                    db['y'] = '4'
+                    raise ValueError()
+
+            self.assertRaises(ValueError, inner)
+            db['c'] = '5'
+        self.assertEqual(db.items(), [('a', '1'), ('c', '5'), ('z', '2')])
+
+    def test_transaction_locks(self):
+        db = ShardedDatabase(
+            [MemoryDB(), MemoryDB()],
+            router=lambda key, shards: 0 if key < 'm' else 1)
+        first, second = threading.Event(), threading.Event()
+        errors = []
+
+        def transact(key, other, mine, theirs):
+            try:
+                with db.transaction():
+                    db[key] = '1'
+                    mine.set()
+                    theirs.wait()
+                    db[other] = '1'
+            except DatabaseError:
+                errors.append(key)
+
+        # Transactions writing different shards run at the same time, and
+        # those writing both in opposite orders do not deadlock.
+        threads = [
+            threading.Thread(target=transact,
+                             args=('a', 'z', first, second)),
+            threading.Thread(target=transact,
+                             args=('y', 'b', second, first))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(len(errors), 1)
+        if errors == ['a']:
+            self.assertEqual(db.keys(), ['b', 'y'])
+        else:
+            self.assertEqual(db.keys(), ['a', 'z'])
+
+    def test_transaction_commit_fails(self):
+        class FailingDB(MemoryDB):
+            @contextlib.contextmanager
+            def transaction(self):
+                with super(FailingDB, self).transaction():
+                    yield
+                    raise DatabaseError('Commit failed.')
+
+        db = ShardedDatabase(
+            [MemoryDB(), FailingDB(), MemoryDB()],
+            router=lambda key, shards: ord(key[0]) % shards)
+        db.update(a='1', c='2')
+
+        def failed():
+            with db.transaction():
+                # The first shard written commits last, and fails.
+                db['a'] = '4'
+                db.update(b='3', c='5', f='6')
+                del db['c']
+
+        self.assertRaises(DatabaseError, failed)
+        self.assertEqual(db.items(), [('a', '1'), ('c', '2')])
+        self.assertEqual(db._locks._owners, [None, None, None])
+
+
+class UpdateOrderTests(unittest.TestCase):
+    def test_update_order(self):
+        written = []
+
+        class RecordingDB(MemoryDB):
+            def _set(self, key, value):
+                written.append(key)
+                super(RecordingDB, self)._set(key, value)
+
+        # Records are written in the order of `_data`, and keyword arguments
+        # take priority.
+        keys = ['k%02d' % i for i in range(20)]
+        keys.reverse()
+        wrappers = (
+            lambda db: ShardedDatabase([db]),
+            lambda db: CompressedDatabase(db, min_size=1 << 20),
+            lambda db: BloomDatabase(db, capacity=100),
+            CachedDatabase)
+        for wrap in wrappers:
+            del written[:]
+            db = wrap(RecordingDB())
+            data = collections.OrderedDict((key, 'v') for key in keys)
+            self.assertEqual(db.update(data, k00='x'), 20)
+            self.assertEqual(written, keys)
+            self.assertEqual(db['k00'], 'x')
+
+
+if AsyncDatabase:
+    class AsyncDatabaseTests(BaseTestCase):
+        def create_db(self):
+            return MemoryDB()
+
+        def delete_db(self):
+            pass
+
+        def setUp(self):
+            super(AsyncDatabaseTests, self).setUp()
+            self.loop = asyncio.new_event_loop()
+            self.adb = AsyncDatabase(self.db, workers=4, loop=self.loop,
+                                     chunk_size=3)
+
+        def tearDown(self):
+            self.adb.close()
+            self.loop.close()
+            super(AsyncDatabaseTests, self).tearDown()
+
+        def wait(self, future):
+            return self.loop.run_until_complete(future)
+
+        def collect(self, aslice):
+            accum = []
+            while True:
+                try:
+                    accum.append(self.wait(aslice.__anext__()))
+                except StopAsyncIteration:
+                    return accum
+
+        def test_get(self):
+            self.db.update(k1='v1', k2='v2', k3='v3')
+            lookups = [self.adb.get('k1'), self.adb.get('k2'),
+                       self.adb.get('k1'), self.adb.get('kx'),
+                       self.adb.get('ky', 'missing')]
+            self.assertEqual(self.wait(asyncio.gather(*lookups)), [
+                'v1', 'v2', 'v1', None, 'missing'])
+            # The lookups were read with one bulk lookup.
+            self.assertEqual(self.adb.batches, 1)
+
+            self.assertEqual(self.wait(self.adb.get('k3')), 'v3')
+            self.assertEqual(self.adb.batches, 2)
+
+            self.adb.max_batch = 2
+            lookups = [self.adb.get('k%s' % i) for i in range(1, 4)]
+            self.assertEqual(self.wait(asyncio.gather(*lookups)), [
+                'v1', 'v2', 'v3'])
+            self.assertEqual(self.adb.batches, 4)
+
+        def test_writes(self):
+            self.wait(self.adb.set('k1', 'v1'))
+            self.wait(self.adb.update({'k2': 'v2'}, k3='v3'))
+            self.wait(self.adb.delete('k3'))
+            self.assertEqual(self.wait(self.adb.incr('ct', 2)), 2)
+            self.assertEqual(self.wait(self.adb.contains('k1')), True)
+            self.assertEqual(self.wait(self.adb.get_many(['k1', 'k2', 'k3'])),
+                             {'k1': 'v1', 'k2': 'v2'})
+            self.assertEqual(self.wait(self.adb.get_prefix('k')), [
+                ('k1', 'v1'), ('k2', 'v2')])
+
+        def test_slices(self):
+            self.db.update(dict(('k%02d' % i, str(i)) for i in range(10)))
+            self.assertEqual(self.collect(self.adb['k02':'k08']), [
+                ('k%02d' % i, str(i)) for i in range(2, 9)])
+            self.assertEqual(self.collect(self.adb['k05':'k00']), [
+                ('k%02d' % i, str(i)) for i in range(5, -1, -1)])
+            self.assertEqual(self.collect(self.adb['k10':'k20']), [])
+
+            aslice = self.adb[:]
+            self.assertEqual(self.wait(aslice.__anext__()), ('k00', '0'))
+            self.wait(aslice.close())
+            self.assertRaises(StopAsyncIteration, self.wait,
+                              aslice.__anext__())
+
+        def test_model(self):
+            # Ages are zero-padded strings, since on Python 3 the index keys of
+            # a LongField mix text and bytes.
+            class Person(Model):
+                name = Field(index=True)
+                age = Field(index=True)
+
+                class Meta:
+                    database = self.db
+                    serialize = False
+
+            class Note(Model):
+                content = Field(index=True)
+
+                class Meta:
+                    database = self.db
+
+            people = AsyncModel(Person, self.adb)
+            for name, age in (('huey', '09'), ('mickey', '05'),
+                              ('zaizee', '04')):
+                self.wait(people.create(name=name, age=age))
+            self.wait(AsyncModel(Note, self.adb).create(content='note'))
+
+            batches = self.adb.batches
+            huey, zaizee = self.wait(asyncio.gather(
+                people.load(1), people.load(3)))
+            self.assertEqual((huey.name, huey.age), ('huey', '09'))
+            self.assertEqual((zaizee.name, zaizee.age), ('zaizee', '04'))
+            self.assertEqual(self.adb.batches, batches + 1)
+            self.assertRaises(KeyError, self.wait, people.load(4))
+
+            note = self.wait(AsyncModel(Note, self.adb).load(1))
+            self.assertEqual(note.content, 'note')
+
+            young = self.wait(people.query(Person.age < '06'))
+            self.assertEqual([p.name for p in young], ['mickey', 'zaizee'])
+            self.assertEqual(self.wait(people.query(Person.age > '09')), [])
+            self.assertEqual(
+                self.wait(people.get(Person.name == 'huey')).age, '09')
+            self.assertEqual(self.wait(people.get(Person.name == 'x')), None)
+
+            self.wait(people.delete(huey))
+            self.assertEqual(self.wait(people.get(Person.name == 'huey')),
+                             None)
+
+        def test_query_snapshot(self):
+            class Item(Model):
+                name = Field(index=True)
+                size = Field()
 
+                class Meta:
+                    database = self.db
+                    serialize = False
 
-class TreeTests(KVKitTests, GraphTests, ModelTests, SliceTests, BaseTestCase):
-    database_class = TreeDB
+            item = Item.create(name='a', size='1')
 
+            # Change the item between reading the index and loading it.
+            def update():
+                item.name, item.size = 'b', '2'
+                item.save()
 
-class CacheHashTests(KVKitTests, BaseTestCase):
-    database_class = CacheHashDB
+            query_ids = Item._query_ids
 
+            def racing_query_ids(expr):
+                ids = query_ids(expr)
+                thread = threading.Thread(target=update)
+                thread.start()
+                thread.join()
+                return ids
 
-class CacheTreeTests(KVKitTests, GraphTests, ModelTests, SliceTests,
-                     BaseTestCase):
-    database_class = CacheTreeDB
+            Item._query_ids = staticmethod(racing_query_ids)
+            results = self.wait(AsyncModel(Item, self.adb).query(
+                Item.name == 'a'))
+            self.assertEqual([(r.name, r.size) for r in results],
+                             [('a', '1')])
+            self.assertEqual(Item.load(item.id).name, 'b')
 
 
 if BerkeleyDB:
-    class BerkeleyDBTests(SliceTests, GraphTests, ModelTests, BaseTestCase):
+    class BerkeleyDBTests(SliceTests, CursorTests, GraphTests, ModelTests,
+                          AtomicTests, BaseTestCase):
         database_class = BerkeleyDB
 
 
 if LevelDB:
-    class LevelDBTests(SliceTests, GraphTests, ModelTests, BaseTestCase):
+    class LevelDBTests(SliceTests, CursorTests, GraphTests, ModelTests,
+                       AtomicTests, SnapshotTests, BaseTestCase):
         database_class = LevelDB
 
 
@@ -821,7 +2810,8 @@ if RocksDB:
     # reliably re-use the same database file due to locks hanging around.
     # For that reason, each test needs to either re-use the same DB or use
     # a new db file. I opted for the latter.
-    class RocksDBTests(SliceTests, GraphTests, ModelTests, BaseTestCase):
+    class RocksDBTests(SliceTests, CursorTests, GraphTests, ModelTests,
+                       AtomicTests, SnapshotTests, BaseTestCase):
         database_class = RocksDB
 
         def create_db(self):
@@ -22,12 +22,15 @@ if __name__ == '__main__':
     parser = optparse.OptionParser()
     opt = parser.add_option
     opt('-b', '--berkeleydb', dest='berkeleydb', action='store_true')
+    opt('-B', '--bitcask', dest='bitcask', action='store_true')
     opt('-H', '--kyoto-hash', dest='kyoto_hash', action='store_true')
     opt('-k', '--kyoto', dest='kyoto', action='store_true')
     opt('-l', '--lsm', dest='lsm', action='store_true')
     opt('-m', '--minimal', dest='minimal', action='store_true')
+    opt('-M', '--memory', dest='memory', action='store_true')
     opt('-r', '--rocksdb', dest='rocksdb', action='store_true')
     opt('-s', '--sophia', dest='sophia', action='store_true')
+    opt('-S', '--sqlite', dest='sqlite', action='store_true')
     opt('-T', '--kyoto-tree', dest='kyoto_tree', action='store_true')
     opt('-v', '--leveldb', dest='leveldb', action='store_true')
 
@@ -38,6 +41,8 @@ if __name__ == '__main__':
     else:
         if options.berkeleydb:
             cases.add('BerkeleyDBTests')
+        if options.bitcask:
+            cases.add('BitcaskTests')
         if options.kyoto:
             cases.update(('HashTests', 'TreeTests', 'CacheHashTests',
                           'CacheTreeTests'))
@@ -49,10 +54,14 @@ if __name__ == '__main__':
             cases.add('LevelDBTests')
         if options.lsm:
             cases.add('LSMTests')
+        if options.memory:
+            cases.add('MemoryTests')
         if options.sophia:
             cases.add('SophiaTests')
         if options.rocksdb:
             cases.add('RocksDBTests')
+        if options.sqlite:
+            cases.add('SqliteTests')
 
     cases = ['kvkit.tests.%s' % case for case in sorted(cases)]
     runtests(cases)
@@ -10,6 +10,13 @@ setup(
     author_email='coleifer@gmail.com',
     url='http://github.com/coleifer/kvkit/',
     packages=find_packages(),
+    extras_require={
+        # kvkit.aio on Python 2.
+        'async': [
+            'futures; python_version < "3"',
+            'trollius; python_version < "3"',
+        ],
+    },
     package_data = {
         'kvkit': [
         ],